@@ -3,11 +3,21 @@ import requests
 import json
 import uuid
 
+BASE_URL = "http://127.0.0.1:8080"
+
+STAGE_LABELS = {
+    "caption_moderator": "Reviewing your idea...",
+    "template_scout": "Picking a meme template...",
+    "trend_captionist": "Writing the caption...",
+    "meme_composer": "Composing the meme...",
+    "meme_publisher": "Publishing to Reddit...",
+}
+
 def generate_meme(prompt):
     my_uuid = uuid.uuid4()
     uuid_str = str(my_uuid)
 
-    url = "http://127.0.0.1:8080/generate_meme"
+    url = "{}/generate_meme".format(BASE_URL)
     json_payload = {
         "user_id": uuid_str,
         "prompt": prompt
@@ -22,6 +32,25 @@ def generate_meme(prompt):
         data = payload)
     return response
 
+def submit_meme_job(prompt, idempotency_key):
+    json_payload = {
+        "user_id": idempotency_key,
+        "prompt": prompt,
+        "idempotency_key": idempotency_key
+    }
+    return requests.post("{}/jobs".format(BASE_URL), json = json_payload, timeout = 10)
+
+def follow_meme_job(job_id, status_placeholder):
+    """Follows the job's progress stream and returns its final status."""
+    with requests.get("{}/jobs/{}/events".format(BASE_URL, job_id), stream = True, timeout = (10, 300)) as response:
+        for line in response.iter_lines(decode_unicode = True):
+            if not line or not line.startswith("data: "):
+                continue
+            event = json.loads(line[len("data: "):])
+            if event["stage"] in STAGE_LABELS:
+                status_placeholder.write(STAGE_LABELS[event["stage"]])
+    return requests.get("{}/jobs/{}".format(BASE_URL, job_id), timeout = 10).json()
+
 def main():
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
@@ -37,18 +66,28 @@ def main():
         if not input_prompt:
             st.error("Note down your idea for a meme before clicking the button.")
         else:
+            # Reusing the key for the same idea lets the backend deduplicate retries.
+            if st.session_state.get("job_prompt") != input_prompt:
+                st.session_state.job_prompt = input_prompt
+                st.session_state.job_key = str(uuid.uuid4())
+
             with st.spinner("Generating your meme...", show_time = True):
-                response = generate_meme(input_prompt)
-                response_data = response.json()
-                if response.status_code == 200:
-                    st.link_button("Go to  Meme", response_data["meme_url"], use_container_width = True)
-                    st.write("Here is the generated meme! In case the posted meme was taken down by the subreddit moderators, you can still view it here.")
-                    st.image(response_data["image"])
-                else:
-                    if response.status_code == 400:
-                        st.error("Error: Your idea violates the moderation policy of Meme Machine. Please try again with a different idea.")
-                    elif response.status_code == 500:
-                        st.error("Error: An internal server error occurred. Please try again later.")
+                status_placeholder = st.empty()
+                response = submit_meme_job(input_prompt, st.session_state.job_key)
+                if response.status_code != 202:
+                    st.error("Error: Meme Machine is busy right now. Please try again later.")
+                    return
+                job = follow_meme_job(response.json()["job_id"], status_placeholder)
+                status_placeholder.empty()
+
+            if job["status"] == "succeeded":
+                st.link_button("Go to  Meme", job["meme_url"], use_container_width = True)
+                st.write("Here is the generated meme! In case the posted meme was taken down by the subreddit moderators, you can still view it here.")
+                st.image(requests.get("{}{}".format(BASE_URL, job["image_url"]), timeout = 30).content)
+            elif job["status"] == "rejected":
+                st.error("Error: Your idea violates the moderation policy of Meme Machine. Please try again with a different idea.")
+            else:
+                st.error("Error: An internal server error occurred. Please try again later.")
 
 def about():
     col1, col2, col3 = st.columns([1, 4, 1])
@@ -0,0 +1,36 @@
+from google.adk.agents import ParallelAgent
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event
+from typing import AsyncGenerator
+import asyncio
+
+class CancellableParallelAgent(ParallelAgent):
+    """
+    ParallelAgent whose in-flight sub-agent runs are cancelled as soon as its own
+    run is cancelled or closed, instead of being left to finish in the background.
+    """
+
+    def branch_context(self, sub_agent, ctx: InvocationContext):
+        ctx = ctx.model_copy()
+        branch_suffix = "{}.{}".format(self.name, sub_agent.name)
+        ctx.branch = "{}.{}".format(ctx.branch, branch_suffix) if ctx.branch else branch_suffix
+        return ctx
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        agent_runs = [sub_agent.run_async(self.branch_context(sub_agent, ctx)) for sub_agent in self.sub_agents]
+        pending = {asyncio.ensure_future(run.__anext__()): run for run in agent_runs}
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+                for task in done:
+                    run = pending.pop(task)
+                    try:
+                        event = task.result()
+                    except StopAsyncIteration:
+                        continue
+                    yield event
+                    pending[asyncio.ensure_future(run.__anext__())] = run
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions = True)
@@ -1,12 +1,10 @@
 from google.adk.agents import LlmAgent
 from google.adk.tools import google_search
 from google.genai import types
-from dotenv import load_dotenv
-import os
 
-load_dotenv()
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = os.getenv("GOOGLE_GENAI_USE_VERTEXAI")
+from config import load_config
+
+load_config()
 
 agent_instruction = """You are a creative content writer specializing in short, funny, and sarcastic captions for meme posts. Your voice is witty, clever, and embraces modern internet humor. For the state key 'prompt', your task is to generate a fitting caption. Do not write captions longer than 20 words. You must follow the rules mentioned in <RULES> tag:
 
@@ -0,0 +1,276 @@
+"""
+Process pool that composes memes away from the event loop and the agents.
+
+Drawing and encoding are CPU-bound and hold the GIL for much of their run, so
+with COMPOSE_WORKERS > 0 they run in worker processes instead (off by default).
+Templates are decoded once, in the service process, into
+`multiprocessing.shared_memory` blocks; workers map those blocks instead of each
+keeping copies of every template, and only the caption, the template's layout
+and the encoded meme cross process boundaries. Every task also carries the
+blocks evicted lately, so workers unmap them and their memory is freed.
+
+At most COMPOSE_QUEUE_SIZE composes are running or waiting for a worker; more
+callers block until a slot frees up and fail with `ComposePoolBusyError` after
+COMPOSE_QUEUE_TIMEOUT seconds.
+"""
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+import multiprocessing
+import threading
+import logging
+import os
+import numpy as np
+
+from agents.meme_drawing import draw_meme
+from metrics import COMPOSE_POOL_PENDING, COMPOSE_POOL_REJECTED, COMPOSE_SHARED_TEMPLATE_BYTES
+from config import load_config
+
+load_config()
+
+logger = logging.getLogger(__name__)
+
+# Worker processes composing memes; 0 (the default) composes in the calling thread.
+# The batch CLI uses one per core when COMPOSE_WORKERS is not set.
+COMPOSE_WORKERS = int(os.getenv("COMPOSE_WORKERS", 0))
+# 0 allows four composes per worker.
+COMPOSE_QUEUE_SIZE = int(os.getenv("COMPOSE_QUEUE_SIZE", 0))
+COMPOSE_QUEUE_TIMEOUT = float(os.getenv("COMPOSE_QUEUE_TIMEOUT", 30))
+COMPOSE_SHARED_MAX_BYTES = int(os.getenv("COMPOSE_SHARED_MAX_BYTES", 256 * 1024 * 1024))
+# forkserver workers start from a clean process rather than a fork of the threaded service.
+COMPOSE_START_METHOD = os.getenv("COMPOSE_START_METHOD", "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+# Evictions sent along with every task. A worker that missed more than this
+# many since its last task unmaps every block but the one it needs.
+EVICTION_LOG_SIZE = 64
+
+_compose_pool = None
+_compose_pool_lock = threading.Lock()
+
+class ComposePoolBusyError(Exception):
+    """Raised when no compose slot frees up within the queue timeout."""
+
+class SharedTemplate:
+    def __init__(self, url: str, memory: SharedMemory, shape, layout: dict):
+        self.url = url
+        self.memory = memory
+        self.shape = shape
+        self.layout = layout
+        self.nbytes = int(np.prod(shape))
+        # Composes using the block; it is only unlinked once none are left.
+        self.users = 0
+
+    def destroy(self):
+        self.memory.close()
+        try:
+            self.memory.unlink()
+        except FileNotFoundError:
+            pass
+
+class SharedTemplates:
+    """Decoded templates in shared memory, bounded by total size; blocks in use are never evicted."""
+
+    def __init__(self, max_bytes: int = COMPOSE_SHARED_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        # Number of blocks evicted so far, and the names of the latest ones.
+        self.generation = 0
+        self.evicted = deque(maxlen = EVICTION_LOG_SIZE)
+
+    def load(self, url: str):
+        # Imported here so worker processes never load the template index and caches.
+        from agents.template_cache import get_template_cache
+        from agents.template_layout import get_template_layout
+
+        # Shared memory holds the decoded copy, so the cache's own LRU does not keep one.
+        img = get_template_cache().get_image(url, keep = False)
+        layout = get_template_layout(url, img)
+        memory = SharedMemory(create = True, size = img.nbytes)
+        view = np.ndarray(img.shape, dtype = np.uint8, buffer = memory.buf)
+        view[:] = img
+        del view
+        return SharedTemplate(url, memory, img.shape, layout)
+
+    def acquire(self, url: str):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+                entry.users += 1
+                return entry
+
+        loaded = self.load(url)
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                entry = self.entries[url] = loaded
+                self.size += entry.nbytes
+                loaded = None
+            entry.users += 1
+            self.evict()
+        if loaded is not None:
+            # Another caller loaded the same template first.
+            loaded.destroy()
+        return entry
+
+    def release(self, entry: SharedTemplate):
+        with self.lock:
+            entry.users -= 1
+            if entry.users == 0 and self.entries.get(entry.url) is not entry:
+                self.destroy(entry)
+            self.evict()
+
+    def destroy(self, entry: SharedTemplate):
+        self.generation += 1
+        self.evicted.append((self.generation, entry.memory.name))
+        entry.destroy()
+
+    def evictions(self):
+        """The eviction generation and the latest evicted block names, for a task to carry."""
+        with self.lock:
+            return self.generation, tuple(self.evicted)
+
+    def evict(self):
+        for url, entry in list(self.entries.items()):
+            if self.size <= self.max_bytes:
+                break
+            if entry.users > 0:
+                continue
+            del self.entries[url]
+            self.size -= entry.nbytes
+            self.destroy(entry)
+
+    def close(self):
+        with self.lock:
+            for entry in self.entries.values():
+                entry.destroy()
+            self.entries.clear()
+            self.size = 0
+
+# Worker side: shared memory blocks mapped by this process, and the last
+# eviction generation it has seen.
+_attached = {}
+_generation = 0
+
+def detach_evicted(generation: int, evicted, keep: str):
+    """Unmaps the blocks the service evicted since this worker's last task."""
+    global _generation
+    if generation > _generation:
+        missed = [name for evicted_generation, name in evicted if evicted_generation > _generation]
+        if not evicted or evicted[0][0] > _generation + 1:
+            # Some evictions fell out of the log; only the block needed now is known to be live.
+            missed = [name for name in _attached if name != keep]
+        for name in missed:
+            memory = _attached.pop(name, None)
+            if memory is not None:
+                memory.close()
+        _generation = generation
+
+def attach(name: str):
+    memory = _attached.get(name)
+    if memory is None:
+        memory = _attached[name] = SharedMemory(name = name)
+    return memory
+
+def compose_shared(name: str, shape, layout: dict, text: str, generation: int = 0, evicted = ()):
+    """Runs in a worker: draws the caption on a private copy of the shared template."""
+    detach_evicted(generation, evicted, name)
+    img = np.ndarray(shape, dtype = np.uint8, buffer = attach(name).buf).copy()
+    return draw_meme(img, layout, text)
+
+def worker_ready():
+    return os.getpid()
+
+class ComposePool:
+    def __init__(self, workers: Optional[int] = None, queue_size: Optional[int] = None, queue_timeout: float = COMPOSE_QUEUE_TIMEOUT, shared_bytes: int = COMPOSE_SHARED_MAX_BYTES, start_method: str = COMPOSE_START_METHOD):
+        # The settings are read here rather than at import, as the batch CLI changes COMPOSE_WORKERS.
+        self.workers = max(1, COMPOSE_WORKERS if workers is None else workers)
+        self.queue_size = max(queue_size or COMPOSE_QUEUE_SIZE or 4 * self.workers, self.workers)
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(self.queue_size)
+        self.templates = SharedTemplates(shared_bytes)
+        self.context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            self.context.set_forkserver_preload(["agents.compose_pool"])
+        self.lock = threading.Lock()
+        self.executor = None
+        COMPOSE_SHARED_TEMPLATE_BYTES.set_function(lambda: self.templates.size)
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers = self.workers, mp_context = self.context)
+            return self.executor
+
+    def start(self):
+        """Starts the worker processes ahead of the first meme and returns their pids."""
+        executor = self.get_executor()
+        futures = [executor.submit(worker_ready) for _ in range(self.workers)]
+        return {future.result() for future in futures}
+
+    def preload(self, urls):
+        """Decodes templates into shared memory until it is full. Returns the number loaded."""
+        loaded = []
+        for url in urls:
+            try:
+                self.templates.release(self.templates.acquire(url))
+            except Exception as e:
+                logger.warning("Failed to preload template %s: %s", url, e)
+                continue
+            loaded.append(url)
+            if loaded[0] not in self.templates.entries:
+                # Shared memory is full and preloading started evicting itself.
+                return len(self.templates.entries)
+        return len(loaded)
+
+    def compose(self, image_url: str, text: str):
+        """Composes a meme in a worker and returns the encoded `MemeImage`, or None if the caption does not fit."""
+        if not self.slots.acquire(timeout = self.queue_timeout):
+            COMPOSE_POOL_REJECTED.inc()
+            raise ComposePoolBusyError("No compose worker became free within {:g}s".format(self.queue_timeout))
+        COMPOSE_POOL_PENDING.inc()
+        try:
+            template = self.templates.acquire(image_url)
+            try:
+                executor = self.get_executor()
+                try:
+                    generation, evicted = self.templates.evictions()
+                    return executor.submit(compose_shared, template.memory.name, template.shape, template.layout, text, generation, evicted).result()
+                except BrokenProcessPool:
+                    # A worker died; the next compose starts a fresh pool.
+                    with self.lock:
+                        if self.executor is executor:
+                            self.executor = None
+                    raise
+            finally:
+                self.templates.release(template)
+        finally:
+            COMPOSE_POOL_PENDING.dec()
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait = True, cancel_futures = True)
+        self.templates.close()
+
+def get_compose_pool():
+    """The shared compose pool, or None when COMPOSE_WORKERS is 0."""
+    global _compose_pool
+    if _compose_pool is None and COMPOSE_WORKERS > 0:
+        with _compose_pool_lock:
+            if _compose_pool is None:
+                _compose_pool = ComposePool()
+    return _compose_pool
+
+def close_compose_pool():
+    global _compose_pool
+    with _compose_pool_lock:
+        pool, _compose_pool = _compose_pool, None
+    if pool is not None:
+        pool.close()
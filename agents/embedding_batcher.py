@@ -0,0 +1,73 @@
+from concurrent.futures import Future
+from typing import Callable
+import threading
+import queue
+import time
+import os
+
+from config import load_config
+
+load_config()
+
+# How long the batcher waits for more prompts after the first one arrives, and
+# the largest batch it encodes at once. Even without a window, prompts queued
+# while a batch is encoding form the next batch.
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", 0))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 32))
+
+class EmbeddingBatcher:
+    """
+    Collects prompts submitted by concurrent callers and hands them to `process`
+    as one batch on a background thread. A batch closes when the window after its
+    first prompt has passed or it holds `max_batch` prompts. Prompts arriving while
+    a batch is being processed wait for the next one, so batches grow with load.
+    """
+
+    def __init__(self, process: Callable, window_ms: float = EMBEDDING_BATCH_WINDOW_MS, max_batch: int = EMBEDDING_BATCH_SIZE):
+        self.process = process
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.run, name = "embedding-batcher", daemon = True)
+                self.thread.start()
+
+    def submit(self, prompt: str):
+        future = Future()
+        self.queue.put((prompt, future))
+        if self.thread is None:
+            self.start()
+        return future
+
+    def __call__(self, prompt: str):
+        return self.submit(prompt).result()
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                timeout = deadline - time.monotonic()
+                batch.append(self.queue.get(timeout = timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            # Concurrent requests for the same prompt share one slot of the batch.
+            prompts = list(dict.fromkeys(prompt for prompt, _ in batch))
+            try:
+                results = dict(zip(prompts, self.process(prompts)))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for prompt, future in batch:
+                future.set_result(results[prompt])
@@ -1,105 +1,70 @@
 from google.adk.agents import Agent
 from google.genai import types
-import cv2
-import numpy as np
-import requests
-import datetime
-from dotenv import load_dotenv
-import os
+import functools
+import asyncio
+import logging
 
-load_dotenv()
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = os.getenv("GOOGLE_GENAI_USE_VERTEXAI")
+from config import load_config
+from agents.compose_pool import get_compose_pool
+from agents.meme_drawing import draw_meme
+from agents.meme_store import meme_store
+from agents.template_cache import get_template_cache
+from agents.template_layout import get_template_layout
+from agents.tool_agent import StateToolAgent
+from observability import traced_tool
+
+load_config()
+
+logger = logging.getLogger(__name__)
 
 agent_instruction = """You are an agent whose task is to execute the 'generate_meme_image' tool with state key 'image_url' as first argument and state key 'caption' as second argument. Strictly, just provide the output from tool as response, DO NOT add any prefixes, explanations, hashtags, or any other extra text."""
 
 def read_image_from_url(url):
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        img_array = np.asarray(bytearray(response.content), dtype=np.uint8)
-        img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-        return img
+        return get_template_cache().get_image(url)
     except Exception as e:
-        print(f"Failed to fetch image: {e}")
+        logger.warning("Failed to fetch template image", extra = {"url": url, "error": str(e)})
         return None
     
-def wrap_text(text, font, font_scale, thickness, max_width):
-    words = text.split()
-    if not words:
-        return []
-    
-    lines = []
-    current_line = words[0]
-    for word in words[1:]:
-        test_line = "{} {}".format(current_line, word)
-        (w, _), _ = cv2.getTextSize(test_line, font, font_scale, thickness)
-        if w <= max_width:
-            current_line = test_line
-        else:
-            lines.append(current_line)
-            current_line = word
-    lines.append(current_line)
-    return lines
+def compose_meme_image(image_url: str, text: str):
+    """Draws the caption on the template and returns the encoded `MemeImage`, or None if it does not fit."""
+    pool = get_compose_pool()
+    if pool is not None:
+        return pool.compose(image_url, text)
 
-def generate_meme_image(image_url: str, text: str):
     img = read_image_from_url(image_url)
     if img is None:
         raise FileNotFoundError("Image not found")
-    
-    h, w, c = img.shape
-
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    _, mask = cv2.threshold(gray, 250, 255, cv2.THRESH_BINARY)
-
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return draw_meme(img, get_template_layout(image_url, img), text)
 
-    white_region = None
-    max_area = 0
-    for cnt in contours:
-        area = cv2.contourArea(cnt)
-        if area >= 5000 and area > max_area:
-            max_area = area
-            white_region = cnt
-
-    if white_region is not None:
-        x, y, rw, rh = cv2.boundingRect(white_region)
-        region_x, region_y, region_w, region_h = x + 10, y + 10, rw - 20, rh - 20
-        text_color = (0, 0, 0)
-    else:
-        region_x, region_y = 10, 10
-        region_w, region_h = w - 20, h - 20
-        region_y = h - 10 - region_h
-        text_color = (255, 255, 255)
-
-    lines = wrap_text(text, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 2, region_w)
-    if not lines:
+@traced_tool
+def generate_meme_image(image_url: str, text: str):
+    image = compose_meme_image(image_url, text)
+    if image is None:
         return None
-    
-    sizes = [cv2.getTextSize(line, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 2)[0] for line in lines]
-    line_height = sizes[0][1] + 5
-    total_text_height = line_height * len(lines) - 5
-    start_y = region_y + (region_h - total_text_height) // 2 + sizes[0][1]
-
-    for i, line in enumerate(lines):
-        text_w, text_h = sizes[i]
-        text_x = region_x + (region_w - text_w) // 2
-        text_y = start_y + i * line_height
-        cv2.putText(img, line, (text_x, text_y), cv2.FONT_HERSHEY_SIMPLEX, 1.0, text_color, 2, cv2.LINE_AA)
+    return meme_store.put(image)
 
-    output_path = "images/{}.jpg".format(datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
-    cv2.imwrite(output_path, img)
-    return output_path
+@functools.wraps(generate_meme_image)
+async def generate_meme_image_in_thread(image_url: str, text: str):
+    # The LLM agent calls plain function tools on the event loop, and composing
+    # can block on a free compose slot.
+    return await asyncio.to_thread(generate_meme_image, image_url, text)
 
 MemeComposerAgent = Agent(
     name = "meme_composer",
     model = "gemini-2.0-flash",
     instruction = agent_instruction,
-    output_key = "meme_file_path",
-    tools = [generate_meme_image],
+    output_key = "meme_image_id",
+    tools = [generate_meme_image_in_thread],
     generate_content_config = types.GenerateContentConfig(
         temperature = 0.1
     )
 )
 
-# output_path = "images/{}.jpg".format(datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
\ No newline at end of file
+MemeComposerToolAgent = StateToolAgent(
+    name = "meme_composer",
+    description = "Composes the meme image from the template and caption without an LLM call.",
+    tool = generate_meme_image,
+    input_keys = ["image_url", "caption"],
+    output_key = "meme_image_id"
+)
\ No newline at end of file
@@ -0,0 +1,77 @@
+"""
+Drawing captions onto decoded templates and encoding the result. Only needs
+OpenCV, so compose worker processes can import it without the agent stack.
+"""
+import cv2
+import os
+
+from agents.meme_store import MemeImage
+from agents.text_layout import fit_text, draw_text
+from config import load_config
+
+load_config()
+
+# Black outline around white captions drawn on the template; off keeps the classic look.
+CAPTION_OUTLINE = os.getenv("CAPTION_OUTLINE", "false").lower() == "true"
+MEME_IMAGE_FORMAT = os.getenv("MEME_IMAGE_FORMAT", "jpeg")
+MEME_IMAGE_QUALITY = int(os.getenv("MEME_IMAGE_QUALITY", 90))
+
+# format -> (extension, media type, quality flag)
+IMAGE_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+    "png": (".png", "image/png", None),
+}
+
+def draw_caption(img, text, region, text_color, outline_color = None):
+    _, _, region_w, region_h = region
+    layout = fit_text(text, region_w, region_h)
+    if layout is None:
+        return False
+    draw_text(img, layout, region, text_color, outline_color)
+    return True
+
+def caption_regions(layout, text):
+    """
+    Pairs caption parts with template boxes. A caption split with '|' is spread
+    over the boxes of multi-panel templates top to bottom; otherwise the whole
+    caption goes into the largest box.
+    """
+    boxes = layout["boxes"]
+    parts = [part.strip() for part in text.split("|") if part.strip()]
+    if len(parts) > 1 and len(boxes) >= len(parts):
+        return list(zip(parts, boxes))
+    return [(" ".join(parts), boxes[layout["primary"]])]
+
+def encode_image(img, image_format = None, quality = None):
+    image_format = (image_format or MEME_IMAGE_FORMAT).lower()
+    quality = MEME_IMAGE_QUALITY if quality is None else quality
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError("Unsupported meme image format: {}".format(image_format))
+
+    extension, media_type, quality_flag = IMAGE_FORMATS[image_format]
+    params = [quality_flag, quality] if quality_flag is not None else []
+    ok, buffer = cv2.imencode(extension, img, params)
+    if not ok:
+        raise ValueError("Failed to encode meme image as {}".format(image_format))
+    return MemeImage(data = buffer.tobytes(), media_type = media_type, extension = extension)
+
+def draw_meme(img, layout, text: str):
+    """Draws the caption onto `img` in place and returns the encoded `MemeImage`, or None if it does not fit."""
+    h, w = img.shape[:2]
+    if layout["boxes"]:
+        placements = caption_regions(layout, text)
+        text_color = (0, 0, 0)
+    else:
+        # Without a caption box the text goes over the bottom third of the picture,
+        # so auto-fitting cannot blow it up over the whole template.
+        placements = [(text, (10, h - h // 3, w - 20, h // 3 - 10))]
+        text_color = (255, 255, 255)
+
+    # White text drawn straight onto the picture gets a dark stroke to stay readable.
+    outline_color = (0, 0, 0) if CAPTION_OUTLINE and text_color == (255, 255, 255) else None
+    drawn = [draw_caption(img, part, region, text_color, outline_color) for part, region in placements]
+    if not any(drawn):
+        return None
+
+    return encode_image(img)
@@ -1,36 +1,110 @@
-from google.adk.agents import Agent
+from google.adk.agents import Agent, BaseAgent
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event, EventActions
 from google.adk.tools import LongRunningFunctionTool
 from google.genai import types
-from dotenv import load_dotenv
-import praw
+from typing import AsyncGenerator
+import functools
+import threading
+import asyncio
+import logging
 import os
 
-load_dotenv()
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = os.getenv("GOOGLE_GENAI_USE_VERTEXAI")
+from config import load_config
+from agents.meme_store import meme_store
+from agents.publish_queue import PublishQueue
+from agents.publish_targets import MultiTargetPublisher, load_publish_targets
+from metrics import PUBLISH_QUEUE_DEPTH, TOOL_DURATION
+from observability import timed_span, traced_tool
 
-reddit = praw.Reddit(
-    client_id = os.getenv("CLIENT_ID"),
-    client_secret = os.getenv("CLIENT_SECRET"),
-    user_agent = os.getenv("REDDIT_USER_AGENT"),
-    username = os.getenv("REDDIT_USERNAME"),
-    password = os.getenv("REDDIT_PASSWORD")
-)
+load_config()
 
-agent_instruction = """You are an agent whose task is to execute the 'publish_to_reddit' tool with state key 'meme_file_path' as first argument and state key 'caption' as second argument. Strictly, just provide the output from tool as response, DO NOT add any prefixes, explanations, hashtags, or any other extra text."""
+logger = logging.getLogger(__name__)
 
-def publish_to_reddit(meme_file_path: str, title: str):
-    try:
-        sub = reddit.subreddit("memes")
-        submission = sub.submit_image(
-            title = title,
-            image_path = meme_file_path
-        )
-        return "https://www.reddit.com{}".format(submission.permalink)
-    except Exception as e:
-        print(f"Failed to publish to Reddit: {e}")
+agent_instruction = """You are an agent whose task is to execute the 'publish_to_reddit' tool with state key 'meme_image_id' as first argument and state key 'caption' as second argument. Strictly, just provide the output from tool as response, DO NOT add any prefixes, explanations, hashtags, or any other extra text."""
+
+# How long a synchronous publish waits on the queue before returning without a URL.
+PUBLISH_WAIT_TIMEOUT = float(os.getenv("PUBLISH_WAIT_TIMEOUT", 30))
+
+_publish_queue = None
+_publish_queue_lock = threading.Lock()
+
+def get_publish_queue():
+    global _publish_queue
+    if _publish_queue is None:
+        with _publish_queue_lock:
+            if _publish_queue is None:
+                _publish_queue = PublishQueue(MultiTargetPublisher(load_publish_targets()))
+                PUBLISH_QUEUE_DEPTH.set_function(_publish_queue.depths)
+    return _publish_queue
+
+@traced_tool
+def publish_to_reddit(meme_image_id: str, title: str):
+    image = meme_store.get(meme_image_id.strip())
+    if image is None:
+        logger.warning("Meme image not found", extra = {"meme_image_id": meme_image_id})
         return None
-    
+
+    queue = get_publish_queue()
+    publication = queue.wait(queue.enqueue(image, title), PUBLISH_WAIT_TIMEOUT)
+    return publication["meme_url"] if publication is not None else None
+
+@functools.wraps(publish_to_reddit)
+async def publish_to_reddit_in_thread(meme_image_id: str, title: str):
+    # The LLM agent calls plain function tools on the event loop, and the
+    # publish waits on the queue for up to PUBLISH_WAIT_TIMEOUT.
+    return await asyncio.to_thread(publish_to_reddit, meme_image_id, title)
+
+class QueuedPublisherAgent(BaseAgent):
+    """
+    Hands the composed meme to the publish queue instead of posting it inline.
+    Unless 'publish_async' is set in state, it waits up to `wait_timeout` for the
+    post. It writes 'publish_results', the status and URL per publish target,
+    'meme_url' (the first target's URL, None while pending), 'publication_id' and
+    'publication_status'. An existing 'publication_id' in state, e.g. from the
+    result cache, is looked up instead of posting the meme again.
+    """
+
+    wait_timeout: float = PUBLISH_WAIT_TIMEOUT
+
+    async def publish(self, state):
+        queue = get_publish_queue()
+
+        publication = None
+        if state.get("publication_id"):
+            publication = await asyncio.to_thread(queue.get, state["publication_id"])
+        if publication is None:
+            image = meme_store.get((state.get("meme_image_id") or "").strip())
+            if image is None:
+                raise ValueError("Meme image {} not found".format(state.get("meme_image_id")))
+            publication_id = await asyncio.to_thread(queue.enqueue, image, state.get("caption") or "")
+        else:
+            publication_id = publication["id"]
+
+        if state.get("publish_async"):
+            return publication_id, await asyncio.to_thread(queue.get, publication_id)
+        return publication_id, await queue.wait_async(publication_id, self.wait_timeout)
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        # Timed as the publish_to_reddit tool it replaces.
+        with timed_span("tool publish_to_reddit", TOOL_DURATION, tool = "publish_to_reddit"):
+            publication_id, publication = await self.publish(ctx.session.state)
+        meme_url = publication["meme_url"] if publication is not None else None
+        publish_results = publication["results"] if publication is not None else {}
+
+        yield Event(
+            invocation_id = ctx.invocation_id,
+            author = self.name,
+            branch = ctx.branch,
+            content = types.Content(role = "model", parts = [types.Part(text = meme_url or "")]),
+            actions = EventActions(state_delta = {
+                "meme_url": meme_url,
+                "publish_results": publish_results,
+                "publication_id": publication_id,
+                "publication_status": publication["status"] if publication is not None else None
+            })
+        )
+
 # long_running_function_tool = LongRunningFunctionTool(
 #     func = publish_to_reddit
 # )
@@ -40,8 +114,13 @@ MemePublisherAgent = Agent(
     model = "gemini-2.0-flash",
     instruction = agent_instruction,
     output_key = "meme_url",
-    tools = [publish_to_reddit],
+    tools = [publish_to_reddit_in_thread],
     generate_content_config = types.GenerateContentConfig(
         temperature = 0.1
     )
+)
+
+MemePublisherToolAgent = QueuedPublisherAgent(
+    name = "meme_publisher",
+    description = "Publishes the composed meme to every publish target through the publish queue without an LLM call."
 )
\ No newline at end of file
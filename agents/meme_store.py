@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from typing import NamedTuple
+import threading
+import time
+import uuid
+import os
+
+from config import load_config
+
+load_config()
+
+MEME_STORE_TTL = float(os.getenv("MEME_STORE_TTL", 600))
+MEME_STORE_MAX_BYTES = int(os.getenv("MEME_STORE_MAX_BYTES", 128 * 1024 * 1024))
+
+class MemeImage(NamedTuple):
+    data: bytes
+    media_type: str
+    extension: str
+
+class MemeImageStore:
+    """
+    Side channel for composed meme images. Session state only carries the image id,
+    while the encoded bytes stay in memory until the response is built. Entries
+    left behind by failed requests expire after a TTL and the store is bounded
+    by total size.
+    """
+
+    def __init__(self, ttl = MEME_STORE_TTL, max_bytes = MEME_STORE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.images = OrderedDict()
+        self.total_bytes = 0
+
+    def _remove(self, image_id):
+        image, _ = self.images.pop(image_id)
+        self.total_bytes -= len(image.data)
+        return image
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.images:
+            image_id, (image, stored_at) = next(iter(self.images.items()))
+            if now - stored_at <= self.ttl and self.total_bytes <= self.max_bytes:
+                break
+            self._remove(image_id)
+
+    def put(self, image: MemeImage):
+        image_id = uuid.uuid4().hex
+        with self.lock:
+            self.images[image_id] = (image, time.monotonic())
+            self.total_bytes += len(image.data)
+            self._evict()
+        return image_id
+
+    def get(self, image_id: str):
+        with self.lock:
+            self._evict()
+            entry = self.images.get(image_id)
+            return entry[0] if entry is not None else None
+
+    def pop(self, image_id: str):
+        with self.lock:
+            self._evict()
+            return self._remove(image_id) if image_id in self.images else None
+
+meme_store = MemeImageStore()
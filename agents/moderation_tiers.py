@@ -0,0 +1,233 @@
+"""
+Local moderation tier that runs in front of the LLM moderator.
+
+A regex blocklist denies obvious cases and sends ambiguous ones (lines starting
+with "?") straight to the LLM moderator, then a logistic-regression classifier
+on the MiniLM prompt embedding allows or denies prompts it is confident about.
+Everything in between escalates to the LLM moderator.
+
+    python -m agents.moderation_tiers label prompts.txt labels.jsonl   # record LLM verdicts
+    python -m agents.moderation_tiers train labels.jsonl               # fit the classifier
+    python -m agents.moderation_tiers evaluate labels.jsonl            # agreement with the LLM tier
+"""
+from google.adk.agents import BaseAgent
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event, EventActions
+from google.adk.runners import Runner
+from google.adk.sessions import InMemorySessionService
+from google.genai import types
+from typing import AsyncGenerator, NamedTuple, Optional
+import argparse
+import asyncio
+import logging
+import json
+import re
+import os
+import numpy as np
+
+from agents.template_index import DATA_DIR, EMBEDDING_MODEL_NAME, embed_prompt, embed_prompts
+from config import load_config
+
+load_config()
+
+logger = logging.getLogger(__name__)
+
+MODERATION_BLOCKLIST_PATH = DATA_DIR / "moderation_blocklist.txt"
+MODERATION_CLASSIFIER_PATH = DATA_DIR / "moderation_classifier.npz"
+
+# The classifier decides on its own only outside [allow, deny].
+MODERATION_ALLOW_THRESHOLD = float(os.getenv("MODERATION_ALLOW_THRESHOLD", 0.05))
+MODERATION_DENY_THRESHOLD = float(os.getenv("MODERATION_DENY_THRESHOLD", 0.95))
+
+class ModerationDecision(NamedTuple):
+    verdict: Optional[str]
+    tier: str
+    score: Optional[float] = None
+
+def load_blocklist(path = MODERATION_BLOCKLIST_PATH):
+    """Returns the deny patterns and the patterns that escalate to the LLM moderator."""
+    if not os.path.isfile(path):
+        return [], []
+    with open(path, "r") as file:
+        lines = [line.strip() for line in file]
+    lines = [line for line in lines if line and not line.startswith("#")]
+    deny = [re.compile(line, re.IGNORECASE) for line in lines if not line.startswith("?")]
+    review = [re.compile(line[1:].strip(), re.IGNORECASE) for line in lines if line.startswith("?")]
+    return deny, review
+
+class LocalModerator:
+    """Blocklist and embedding classifier that decide the obvious prompts without an LLM call."""
+
+    def __init__(self, blocklist, weights = None, bias = 0.0, allow_threshold = MODERATION_ALLOW_THRESHOLD, deny_threshold = MODERATION_DENY_THRESHOLD, reviewlist = ()):
+        self.blocklist = blocklist
+        self.reviewlist = reviewlist
+        self.weights = weights
+        self.bias = bias
+        self.allow_threshold = allow_threshold
+        self.deny_threshold = deny_threshold
+
+    @classmethod
+    def load(cls, blocklist_path = MODERATION_BLOCKLIST_PATH, classifier_path = MODERATION_CLASSIFIER_PATH):
+        weights, bias = None, 0.0
+        if os.path.isfile(classifier_path):
+            classifier = np.load(classifier_path)
+            if str(classifier["model_name"]) == EMBEDDING_MODEL_NAME:
+                weights, bias = classifier["weights"].astype(np.float32), float(classifier["bias"])
+            else:
+                logger.warning("Ignoring moderation classifier trained on %s", classifier["model_name"])
+        blocklist, reviewlist = load_blocklist(blocklist_path)
+        return cls(blocklist, weights, bias, reviewlist = reviewlist)
+
+    def score(self, prompt: str, embedding = None):
+        """Probability that the LLM moderator would flag the prompt."""
+        if embedding is None:
+            embedding = embed_prompt(prompt)
+        return float(1.0 / (1.0 + np.exp(-(embedding @ self.weights + self.bias))))
+
+    def classify(self, prompt: str, embedding = None):
+        """Decides the prompt locally if it can; `embedding` skips encoding the prompt again."""
+        for pattern in self.blocklist:
+            if pattern.search(prompt):
+                return ModerationDecision("yes", "blocklist")
+        for pattern in self.reviewlist:
+            if pattern.search(prompt):
+                # Often an idiom ("bomb the interview"); the LLM moderator has the context.
+                return ModerationDecision(None, "blocklist")
+
+        if self.weights is None:
+            return ModerationDecision(None, "classifier")
+
+        score = self.score(prompt, embedding)
+        if score >= self.deny_threshold:
+            return ModerationDecision("yes", "classifier", score)
+        if score <= self.allow_threshold:
+            return ModerationDecision("no", "classifier", score)
+        return ModerationDecision(None, "classifier", score)
+
+class TieredModerationAgent(BaseAgent):
+    """
+    Runs the local moderator first and only escalates uncertain prompts to its
+    LLM sub-agent. Writes 'moderator_response' like the LLM moderator, plus
+    'moderation_tier' recording which tier made the decision.
+    """
+
+    local_moderator: LocalModerator
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        prompt = ctx.session.state.get("prompt") or ""
+        decision = await asyncio.to_thread(self.local_moderator.classify, prompt)
+
+        if decision.verdict is not None:
+            yield Event(
+                invocation_id = ctx.invocation_id,
+                author = self.name,
+                branch = ctx.branch,
+                content = types.Content(role = "model", parts = [types.Part(text = decision.verdict)]),
+                actions = EventActions(state_delta = {
+                    "moderator_response": decision.verdict,
+                    "moderation_tier": decision.tier,
+                    "moderation_score": decision.score
+                })
+            )
+            return
+
+        async for event in self.sub_agents[0].run_async(ctx):
+            yield event
+
+        yield Event(
+            invocation_id = ctx.invocation_id,
+            author = self.name,
+            branch = ctx.branch,
+            actions = EventActions(state_delta = {
+                "moderation_tier": "llm",
+                "moderation_score": decision.score
+            })
+        )
+
+def read_labels(path):
+    with open(path, "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def train_classifier(embeddings, labels, epochs = 500, learning_rate = 0.5, l2 = 1e-3):
+    """Fits logistic regression with full-batch gradient descent."""
+    weights = np.zeros(embeddings.shape[1], dtype = np.float32)
+    bias = 0.0
+    for _ in range(epochs):
+        probabilities = 1.0 / (1.0 + np.exp(-(embeddings @ weights + bias)))
+        error = probabilities - labels
+        weights -= learning_rate * (embeddings.T @ error / len(labels) + l2 * weights)
+        bias -= learning_rate * float(error.mean())
+    return weights, bias
+
+async def label_prompts(prompts):
+    # prompt_moderator builds the tiered agent from this module.
+    from agents.prompt_moderator import PromptModerationAgent
+
+    session_service = InMemorySessionService()
+    runner = Runner(agent = PromptModerationAgent, app_name = "moderation_eval", session_service = session_service)
+    verdicts = []
+    for prompt in prompts:
+        session = await session_service.create_session(app_name = "moderation_eval", user_id = "eval", state = {"prompt": prompt})
+        content = types.Content(role = "user", parts = [types.Part(text = prompt)])
+        async for _ in runner.run_async(user_id = "eval", session_id = session.id, new_message = content):
+            pass
+        session = await session_service.get_session(app_name = "moderation_eval", user_id = "eval", session_id = session.id)
+        verdicts.append((session.state.get("moderator_response") or "").strip().lower())
+    return verdicts
+
+def evaluate(moderator: LocalModerator, records):
+    decided = agreed = denied_by_llm_allowed_locally = 0
+    tiers = {}
+    for record in records:
+        decision = moderator.classify(record["prompt"])
+        tier = decision.tier if decision.verdict is not None else "llm"
+        tiers[tier] = tiers.get(tier, 0) + 1
+        if decision.verdict is None:
+            continue
+        decided += 1
+        agreed += decision.verdict == record["label"]
+        denied_by_llm_allowed_locally += decision.verdict == "no" and record["label"] == "yes"
+
+    total = len(records)
+    print("prompts: {}".format(total))
+    for tier, count in sorted(tiers.items()):
+        print("  decided by {:<10} {:6d} ({:.1%})".format(tier, count, count / max(total, 1)))
+    print("local agreement with LLM: {:.1%} of {} locally decided prompts".format(agreed / max(decided, 1), decided))
+    print("allowed locally but flagged by LLM: {}".format(denied_by_llm_allowed_locally))
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+    label_parser = subparsers.add_parser("label", help = "Record LLM moderator verdicts for a file of prompts, one per line.")
+    label_parser.add_argument("prompts")
+    label_parser.add_argument("output")
+    train_parser = subparsers.add_parser("train", help = "Fit the classifier on JSONL records with 'prompt' and 'label' (yes/no).")
+    train_parser.add_argument("labels")
+    evaluate_parser = subparsers.add_parser("evaluate", help = "Report how the local tiers agree with recorded LLM verdicts.")
+    evaluate_parser.add_argument("labels")
+    evaluate_parser.add_argument("--allow-threshold", type = float, default = MODERATION_ALLOW_THRESHOLD)
+    evaluate_parser.add_argument("--deny-threshold", type = float, default = MODERATION_DENY_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.command == "label":
+        with open(args.prompts, "r") as file:
+            prompts = [line.strip() for line in file if line.strip()]
+        verdicts = asyncio.run(label_prompts(prompts))
+        with open(args.output, "w") as file:
+            for prompt, verdict in zip(prompts, verdicts):
+                file.write(json.dumps({"prompt": prompt, "label": verdict}) + "\n")
+    elif args.command == "train":
+        records = read_labels(args.labels)
+        embeddings = embed_prompts([record["prompt"] for record in records])
+        labels = np.array([record["label"] == "yes" for record in records], dtype = np.float32)
+        weights, bias = train_classifier(embeddings, labels)
+        np.savez(MODERATION_CLASSIFIER_PATH, weights = weights, bias = bias, model_name = EMBEDDING_MODEL_NAME)
+        print("Saved moderation classifier trained on {} prompts to {}".format(len(records), MODERATION_CLASSIFIER_PATH))
+    elif args.command == "evaluate":
+        moderator = LocalModerator.load()
+        moderator.allow_threshold = args.allow_threshold
+        moderator.deny_threshold = args.deny_threshold
+        evaluate(moderator, read_labels(args.labels))
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,11 @@
 from google.adk.agents import LlmAgent
 from google.genai import types
-from dotenv import load_dotenv
-import os
+import json
 
-load_dotenv()
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = os.getenv("GOOGLE_GENAI_USE_VERTEXAI")
+from agents.moderation_tiers import LocalModerator, TieredModerationAgent
+from config import load_config
+
+load_config()
 
 agent_instruction = """You are a highly vigilant and accurate prompt moderator. Your sole responsibility is to analyze the state key 'prompt' and determine if it contains any form of hate speech (racism, gender bias, blasphemy, casteism, communal hate), violence (self-harm, fighting, hitting, accident, terrorism), sexual content, unethical content, medical suggestions or any other inappropriate content. You must respond with only 'yes' or 'no', no prefixes, explanations, hashtags, or any other extra text.
     - 'yes' if the prompt contains any of the aforementioned inappropriate content.
@@ -20,4 +20,44 @@ PromptModerationAgent = LlmAgent(
         temperature = 0.1,
         max_output_tokens = 1
     )
-)
\ No newline at end of file
+)
+
+def build_tiered_moderation_agent():
+    """
+    Wraps `PromptModerationAgent` in the local tier. Only call this when the tiered
+    agent is used, since it makes the LLM moderator its sub-agent.
+    """
+    return TieredModerationAgent(
+        name = "tiered_moderator",
+        description = "Decides obvious prompts locally and escalates the rest to the LLM moderator.",
+        local_moderator = LocalModerator.load(),
+        sub_agents = [PromptModerationAgent]
+    )
+
+batch_agent_instruction = """You are a highly vigilant and accurate prompt moderator. The user message is a JSON array of prompts. For every prompt, determine if it contains any form of hate speech (racism, gender bias, blasphemy, casteism, communal hate), violence (self-harm, fighting, hitting, accident, terrorism), sexual content, unethical content, medical suggestions or any other inappropriate content. You must respond with only a JSON array holding one 'yes' or 'no' per prompt, in the same order, no prefixes, explanations, hashtags, or any other extra text.
+    - 'yes' if the prompt contains any of the aforementioned inappropriate content.
+    - 'no' if the prompt is clean and free of such content."""
+
+BatchPromptModerationAgent = LlmAgent(
+    name = "batch_moderator",
+    model = "gemini-2.0-flash",
+    instruction = batch_agent_instruction,
+    output_key = "moderator_responses",
+    generate_content_config = types.GenerateContentConfig(
+        temperature = 0.1,
+        response_mime_type = "application/json"
+    )
+)
+
+def parse_batch_verdicts(response: str, count: int):
+    """The 'yes'/'no' verdicts of a batch moderator response, or None if it is not one verdict per prompt."""
+    try:
+        verdicts = json.loads(response)
+    except ValueError:
+        return None
+    if not isinstance(verdicts, list) or len(verdicts) != count:
+        return None
+    verdicts = [str(verdict).strip().lower() for verdict in verdicts]
+    if any(verdict not in ("yes", "no") for verdict in verdicts):
+        return None
+    return verdicts
@@ -0,0 +1,336 @@
+"""
+Durable queue of meme publications, drained by background worker threads.
+
+Publications are stored in SQLite together with the image, so queued posts
+survive a restart. Each publication is fanned out to every publish target at
+once, with the outcome recorded per target. Workers space publications by a
+minimum interval, pause the whole queue while a platform's rate limit is
+exhausted or it asked to back off, and retry the targets that failed with
+exponential backoff. Targets that timed out may still have posted, so they
+are not retried.
+"""
+from typing import Optional
+import threading
+import asyncio
+import logging
+import random
+import json
+import sqlite3
+import time
+import uuid
+import os
+
+from agents.meme_store import MemeImage
+from agents.publish_targets import MultiTargetPublisher
+from agents.template_index import DATA_DIR
+from metrics import PUBLICATIONS, PUBLISH_TARGET_DURATION, PUBLISH_TARGET_RESULTS
+from config import load_config
+
+load_config()
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_QUEUE_PATH = os.getenv("PUBLISH_QUEUE_PATH", str(DATA_DIR / "publish_queue.sqlite3"))
+PUBLISH_WORKERS = int(os.getenv("PUBLISH_WORKERS", 2))
+PUBLISH_MIN_INTERVAL = float(os.getenv("PUBLISH_MIN_INTERVAL", 1.0))
+PUBLISH_MAX_ATTEMPTS = int(os.getenv("PUBLISH_MAX_ATTEMPTS", 5))
+PUBLISH_RETRY_BASE = float(os.getenv("PUBLISH_RETRY_BASE", 30))
+PUBLISH_RETRY_MAX = float(os.getenv("PUBLISH_RETRY_MAX", 3600))
+# Pause when fewer API requests than this are left in the rate-limit window;
+# one image post takes several requests.
+PUBLISH_RATE_LIMIT_RESERVE = int(os.getenv("PUBLISH_RATE_LIMIT_RESERVE", 10))
+# Finished publications are kept this long for status lookups.
+PUBLISH_RETENTION = float(os.getenv("PUBLISH_RETENTION", 7 * 24 * 3600))
+
+# 'partial' publications were posted to some targets and gave up on the others.
+FINISHED_STATUSES = ("published", "partial", "failed")
+
+def resolve_waiter(finished):
+    if not finished.done():
+        finished.set_result(None)
+
+class PublishRateLimiter:
+    """Hands out submission slots at least `min_interval` apart and honours rate-limit pauses."""
+
+    def __init__(self, min_interval = PUBLISH_MIN_INTERVAL, reserve = PUBLISH_RATE_LIMIT_RESERVE):
+        self.min_interval = min_interval
+        self.reserve_requests = reserve
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+
+    def reserve(self):
+        """Claims the next submission slot and returns how long to wait for it."""
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot, self.paused_until)
+            self.next_slot = slot + self.min_interval
+            return slot - now
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def observe(self, limits: Optional[dict]):
+        """Pauses until the window resets when the remaining request budget runs low."""
+        if not limits or limits.get("remaining") is None or limits.get("reset_timestamp") is None:
+            return
+        if float(limits["remaining"]) < self.reserve_requests:
+            with self.lock:
+                self.paused_until = max(self.paused_until, float(limits["reset_timestamp"]))
+
+class PublishQueue:
+    """
+    Publishes through `publisher`, whose targets' current limits (`remaining`,
+    `reset_timestamp`) and requested retry delays steer the rate limiter.
+    """
+
+    def __init__(self, publisher: MultiTargetPublisher, path = PUBLISH_QUEUE_PATH, workers: int = PUBLISH_WORKERS, rate_limiter: Optional[PublishRateLimiter] = None, max_attempts: int = PUBLISH_MAX_ATTEMPTS):
+        self.publisher = publisher
+        self.rate_limiter = rate_limiter or PublishRateLimiter()
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.changed = threading.Condition()
+        self.stopping = threading.Event()
+        self.threads = []
+        # Futures of `wait_async` callers, resolved on their event loops.
+        self.waiters = {}
+
+        self.connection = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+        self.connection.row_factory = sqlite3.Row
+        if path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS publications (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                title TEXT NOT NULL,
+                image BLOB,
+                media_type TEXT,
+                extension TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                meme_url TEXT,
+                error TEXT,
+                results TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(publications)")}
+        if "results" not in columns:
+            self.connection.execute("ALTER TABLE publications ADD COLUMN results TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS publications_due ON publications (status, next_attempt_at)")
+
+    def execute(self, sql, params = ()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def start(self):
+        if self.threads:
+            return
+        # Publications a previous process was working on are picked up again.
+        self.execute("UPDATE publications SET status = 'queued' WHERE status = 'publishing'")
+        self.prune()
+        self.stopping.clear()
+        self.threads = [threading.Thread(target = self.worker, name = "publisher-{}".format(i), daemon = True) for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self.stopping.set()
+        with self.changed:
+            self.changed.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def enqueue(self, image: MemeImage, title: str, not_before: Optional[float] = None):
+        """Queues a publication, to be posted as soon as possible or not before the `not_before` timestamp."""
+        publication_id = uuid.uuid4().hex
+        now = time.time()
+        self.execute(
+            "INSERT INTO publications (id, status, title, image, media_type, extension, next_attempt_at, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?)",
+            (publication_id, title, image.data, image.media_type, image.extension, max(now, not_before or now), now, now)
+        )
+        with self.changed:
+            self.changed.notify_all()
+        return publication_id
+
+    def get(self, publication_id: str):
+        rows = self.execute(
+            "SELECT id, status, title, attempts, next_attempt_at, meme_url, error, results, created_at, updated_at FROM publications WHERE id = ?",
+            (publication_id,)
+        )
+        if not rows:
+            return None
+        publication = dict(rows[0])
+        publication["results"] = json.loads(publication["results"] or "{}")
+        return publication
+
+    def wait(self, publication_id: str, timeout: float):
+        """Blocks until the publication is finished or `timeout` passes, and returns it."""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while True:
+                publication = self.get(publication_id)
+                remaining = deadline - time.monotonic()
+                if publication is None or publication["status"] in FINISHED_STATUSES or remaining <= 0:
+                    return publication
+                self.changed.wait(remaining)
+
+    async def wait_async(self, publication_id: str, timeout: float):
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+        waiter = (loop, finished)
+        with self.changed:
+            self.waiters.setdefault(publication_id, []).append(waiter)
+        try:
+            publication = self.get(publication_id)
+            if publication is None or publication["status"] in FINISHED_STATUSES:
+                return publication
+            try:
+                await asyncio.wait_for(finished, timeout)
+            except asyncio.TimeoutError:
+                pass
+            return self.get(publication_id)
+        finally:
+            with self.changed:
+                waiters = self.waiters.get(publication_id, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    self.waiters.pop(publication_id, None)
+
+    def claim(self):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM publications WHERE status = 'queued' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE publications SET status = 'publishing', updated_at = ? WHERE id = ?", (now, row["id"]))
+        return row
+
+    def depths(self):
+        """Number of publications per unfinished status, for the queue depth gauge."""
+        depths = {("queued",): 0, ("publishing",): 0}
+        for status, count in self.execute("SELECT status, COUNT(*) FROM publications WHERE status IN ('queued', 'publishing') GROUP BY status"):
+            depths[(status,)] = count
+        return depths
+
+    def next_due(self):
+        return self.execute("SELECT MIN(next_attempt_at) FROM publications WHERE status = 'queued'")[0][0]
+
+    def finish(self, publication_id: str, status: str, results: dict, meme_url: Optional[str] = None, error: Optional[str] = None, next_attempt_at: Optional[float] = None):
+        if status in FINISHED_STATUSES:
+            self.execute(
+                "UPDATE publications SET status = ?, meme_url = ?, error = ?, results = ?, image = NULL, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (status, meme_url, error, json.dumps(results), time.time(), publication_id)
+            )
+        else:
+            self.execute(
+                "UPDATE publications SET status = 'queued', meme_url = ?, error = ?, results = ?, attempts = attempts + 1, next_attempt_at = ?, updated_at = ? WHERE id = ?",
+                (meme_url, error, json.dumps(results), next_attempt_at, time.time(), publication_id)
+            )
+        PUBLICATIONS.inc(outcome = "retried" if status == "queued" else status)
+        with self.changed:
+            self.changed.notify_all()
+            waiters = self.waiters.pop(publication_id, []) if status in FINISHED_STATUSES else []
+        for loop, finished in waiters:
+            loop.call_soon_threadsafe(resolve_waiter, finished)
+
+    def backoff(self, attempts: int):
+        delay = min(PUBLISH_RETRY_MAX, PUBLISH_RETRY_BASE * 2 ** (attempts - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    def publish(self, row):
+        """Posts to the targets that have not published this meme yet; retries only retry those that failed."""
+        image = MemeImage(bytes(row["image"]), row["media_type"], row["extension"])
+        attempts = row["attempts"] + 1
+        results = json.loads(row["results"] or "{}")
+        pending = [name for name in self.publisher.targets if results.get(name, {}).get("status") not in ("published", "timeout")]
+        try:
+            outcomes = self.publisher.publish(image, row["title"], pending)
+        finally:
+            # Best effort: MultiTargetPublisher skips targets whose limits cannot be read.
+            for limits in self.publisher.rate_limits():
+                self.rate_limiter.observe(limits)
+
+        retry_after = 0.0
+        for name, outcome in outcomes.items():
+            results[name] = {"status": outcome.status, "url": outcome.url, "error": outcome.error}
+            PUBLISH_TARGET_RESULTS.inc(target = name, status = outcome.status)
+            if outcome.status == "published":
+                PUBLISH_TARGET_DURATION.observe(outcome.seconds, target = name)
+            else:
+                logger.warning("Failed to publish", extra = {"publication_id": row["id"], "target": name, "attempt": attempts, "error": outcome.error})
+            if outcome.retry_after is not None:
+                self.rate_limiter.pause(outcome.retry_after)
+                retry_after = max(retry_after, outcome.retry_after)
+
+        published = [name for name in self.publisher.targets if results.get(name, {}).get("status") == "published"]
+        # A timed-out post may still go through; retrying it could post the meme twice.
+        unknown = [name for name in self.publisher.targets if results.get(name, {}).get("status") == "timeout"]
+        failed = [name for name in self.publisher.targets if name not in published and name not in unknown]
+        # The URL of the first configured target that has one stands in as the meme's URL.
+        meme_url = next((results[name]["url"] for name in published if results[name]["url"]), None)
+        error = "; ".join(
+            ["{}: {}".format(name, results[name]["error"]) for name in failed] +
+            ["{}: {}, not retried".format(name, results[name]["error"]) for name in unknown]
+        ) or None
+        if not failed and not unknown:
+            self.finish(row["id"], "published", results, meme_url = meme_url)
+        elif not failed or attempts >= self.max_attempts:
+            self.finish(row["id"], "partial" if published else "failed", results, meme_url = meme_url, error = error)
+        else:
+            self.finish(row["id"], "queued", results, meme_url = meme_url, error = error, next_attempt_at = time.time() + max(retry_after, self.backoff(attempts)))
+
+    def give_up_attempt(self, row, error: Exception):
+        """Counts a publish attempt that raised as failed, so the row is retried or finished rather than left 'publishing'."""
+        attempts = row["attempts"] + 1
+        results = json.loads(row["results"] or "{}")
+        error = str(error) or type(error).__name__
+        published = [name for name in self.publisher.targets if results.get(name, {}).get("status") == "published"]
+        meme_url = next((results[name]["url"] for name in published if results[name]["url"]), None)
+        if attempts >= self.max_attempts:
+            self.finish(row["id"], "partial" if published else "failed", results, meme_url = meme_url, error = error)
+        else:
+            self.finish(row["id"], "queued", results, meme_url = meme_url, error = error, next_attempt_at = time.time() + self.backoff(attempts))
+
+    def prune(self):
+        self.execute(
+            "DELETE FROM publications WHERE status IN ({}) AND updated_at < ?".format(", ".join("?" * len(FINISHED_STATUSES))),
+            (*FINISHED_STATUSES, time.time() - PUBLISH_RETENTION)
+        )
+
+    def worker(self):
+        last_pruned = time.time()
+        while not self.stopping.is_set():
+            with self.changed:
+                row = self.claim()
+                if row is None:
+                    next_due = self.next_due()
+                    self.changed.wait(5.0 if next_due is None else min(5.0, max(0.0, next_due - time.time())))
+            if row is None:
+                if time.time() - last_pruned > 3600:
+                    self.prune()
+                    last_pruned = time.time()
+                continue
+
+            delay = self.rate_limiter.reserve()
+            if delay > 0 and self.stopping.wait(delay):
+                self.execute("UPDATE publications SET status = 'queued' WHERE id = ?", (row["id"],))
+                return
+            try:
+                self.publish(row)
+            except Exception as e:
+                logger.exception("Publish attempt failed", extra = {"publication_id": row["id"]})
+                try:
+                    self.give_up_attempt(row, e)
+                except Exception:
+                    # Left 'publishing'; start() requeues it after a restart.
+                    logger.exception("Failed to record publish attempt", extra = {"publication_id": row["id"]})
@@ -0,0 +1,335 @@
+"""
+Publish targets: the places a composed meme is posted to. Each target type is a
+plugin registered under a short name, and `PUBLISH_TARGETS` lists the targets
+to publish to as `type:argument` entries, e.g.
+
+    PUBLISH_TARGETS=reddit:memes,reddit:dankmemes,filesystem:data/published,webhook:https://example.com/hook
+
+`PUBLISH_TARGETS_FILE` can instead name a JSON list of
+`{"type": ..., "name": ..., "timeout": ..., <constructor options>}` objects,
+where a `type` that is not registered is imported as `package.module:Class`.
+
+`MultiTargetPublisher` posts one image to several targets at the same time, each
+with its own timeout, and reports a result per target.
+"""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+import importlib
+import threading
+import logging
+import hashlib
+import tempfile
+import json
+import time
+import re
+import os
+import cv2
+import numpy as np
+import requests
+
+from agents.meme_store import MemeImage
+from config import load_config
+
+load_config()
+
+logger = logging.getLogger(__name__)
+
+PUBLISH_SUBREDDIT = os.getenv("PUBLISH_SUBREDDIT", "memes")
+PUBLISH_TARGETS = os.getenv("PUBLISH_TARGETS", "reddit:{}".format(PUBLISH_SUBREDDIT))
+PUBLISH_TARGETS_FILE = os.getenv("PUBLISH_TARGETS_FILE")
+# Seconds a single target may take before its result is reported as a timeout.
+PUBLISH_TARGET_TIMEOUT = float(os.getenv("PUBLISH_TARGET_TIMEOUT", 60))
+PUBLISH_FANOUT_WORKERS = int(os.getenv("PUBLISH_FANOUT_WORKERS", 16))
+
+# Image types Reddit accepts for image posts; anything else is re-encoded as JPEG.
+REDDIT_IMAGE_TYPES = ("image/jpeg", "image/png")
+
+RATELIMIT_DELAY = re.compile(r"(\d+)\s*(second|minute|hour)")
+
+PUBLISH_TARGET_TYPES = {}
+
+def register_publish_target(kind: str):
+    def register(cls):
+        PUBLISH_TARGET_TYPES[kind] = cls
+        return cls
+    return register
+
+class TargetResult(NamedTuple):
+    status: str
+    url: Optional[str] = None
+    error: Optional[str] = None
+    seconds: Optional[float] = None
+    # Delay the platform asked for before the next attempt, for rate-limited failures.
+    retry_after: Optional[float] = None
+
+class UploadBuffer:
+    """
+    The image being published, shared by every target of one publication. Re-encoded
+    copies and the temporary file PRAW uploads from are made once, on first use,
+    and removed by `close()`.
+    """
+
+    def __init__(self, image: MemeImage):
+        self.image = image
+        self.lock = threading.Lock()
+        self.converted = {}
+        self.paths = {}
+
+    def as_types(self, media_types):
+        """Returns `(data, extension)` in one of `media_types`, re-encoding as JPEG if needed."""
+        if self.image.media_type in media_types:
+            return self.image.data, self.image.extension
+        with self.lock:
+            if "image/jpeg" not in self.converted:
+                img = cv2.imdecode(np.frombuffer(self.image.data, dtype = np.uint8), cv2.IMREAD_COLOR)
+                ok, buffer = cv2.imencode(".jpg", img)
+                if not ok:
+                    raise ValueError("Failed to re-encode meme image as JPEG")
+                self.converted["image/jpeg"] = (buffer.tobytes(), ".jpg")
+            return self.converted["image/jpeg"]
+
+    def path(self, media_types):
+        data, extension = self.as_types(media_types)
+        with self.lock:
+            if extension not in self.paths:
+                with tempfile.NamedTemporaryFile(prefix = "meme_", suffix = extension, delete = False) as file:
+                    file.write(data)
+                self.paths[extension] = file.name
+            return self.paths[extension]
+
+    def close(self):
+        with self.lock:
+            for path in self.paths.values():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.paths.clear()
+
+class PublishTarget:
+    """
+    A place memes are posted to. `publish(upload, title)` posts the shared
+    `UploadBuffer` and returns the post's URL, raising on failure. Targets with a
+    platform rate limit also override `rate_limits()` and `retry_after(error)`.
+    """
+
+    def __init__(self, name: str, timeout: float = PUBLISH_TARGET_TIMEOUT):
+        self.name = name
+        self.timeout = timeout
+
+    def publish(self, upload: UploadBuffer, title: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def rate_limits(self) -> Optional[dict]:
+        return None
+
+    def retry_after(self, error: Exception) -> Optional[float]:
+        return None
+
+_reddit = None
+_reddit_lock = threading.Lock()
+
+def get_reddit():
+    """The PRAW client, created on first use from the Reddit credentials in the environment."""
+    global _reddit
+    if _reddit is None:
+        with _reddit_lock:
+            if _reddit is None:
+                # Imported here so the service starts without loading PRAW.
+                import praw
+                _reddit = praw.Reddit(
+                    client_id = os.getenv("CLIENT_ID"),
+                    client_secret = os.getenv("CLIENT_SECRET"),
+                    user_agent = os.getenv("REDDIT_USER_AGENT"),
+                    username = os.getenv("REDDIT_USERNAME"),
+                    password = os.getenv("REDDIT_PASSWORD")
+                )
+    return _reddit
+
+@register_publish_target("reddit")
+class RedditTarget(PublishTarget):
+    def __init__(self, subreddit: str = PUBLISH_SUBREDDIT, name: Optional[str] = None, timeout: float = PUBLISH_TARGET_TIMEOUT, reddit = None):
+        super().__init__(name or "reddit:{}".format(subreddit), timeout)
+        self.subreddit = subreddit
+        self.reddit = reddit
+
+    @property
+    def client(self):
+        return self.reddit if self.reddit is not None else get_reddit()
+
+    def publish(self, upload: UploadBuffer, title: str):
+        # PRAW only uploads from a path.
+        submission = self.client.subreddit(self.subreddit).submit_image(
+            title = title,
+            image_path = upload.path(REDDIT_IMAGE_TYPES)
+        )
+        return "https://www.reddit.com{}".format(submission.permalink)
+
+    def rate_limits(self):
+        # Before the first post there is no client, and no limits to report.
+        reddit = self.reddit if self.reddit is not None else _reddit
+        return reddit.auth.limits if reddit is not None else None
+
+    def retry_after(self, error: Exception):
+        """Seconds Reddit asked us to wait before submitting again, if it did."""
+        from praw.exceptions import RedditAPIException
+        from prawcore.exceptions import TooManyRequests
+
+        if isinstance(error, TooManyRequests) and error.retry_after:
+            return float(error.retry_after)
+        if isinstance(error, RedditAPIException):
+            for item in error.items:
+                if item.error_type == "RATELIMIT":
+                    match = RATELIMIT_DELAY.search(item.message or "")
+                    if match is None:
+                        return 60.0
+                    return float(match.group(1)) * {"second": 1, "minute": 60, "hour": 3600}[match.group(2)]
+        return None
+
+@register_publish_target("filesystem")
+class FilesystemTarget(PublishTarget):
+    """
+    Writes memes into a directory under a content-addressed key, like an object
+    store bucket. URLs are `base_url` + key, or `file://` URIs without one.
+    """
+
+    def __init__(self, directory: str, name: Optional[str] = None, timeout: float = PUBLISH_TARGET_TIMEOUT, base_url: Optional[str] = None):
+        super().__init__(name or "filesystem:{}".format(directory), timeout)
+        self.directory = Path(directory)
+        self.base_url = base_url
+
+    def publish(self, upload: UploadBuffer, title: str):
+        data = upload.image.data
+        key = hashlib.sha256(data).hexdigest()[:32] + upload.image.extension
+        self.directory.mkdir(parents = True, exist_ok = True)
+        path = self.directory / key
+        if not path.exists():
+            temp_path = path.with_name(path.name + ".tmp")
+            temp_path.write_bytes(data)
+            os.replace(temp_path, path)
+        if self.base_url:
+            return self.base_url.rstrip("/") + "/" + key
+        return path.resolve().as_uri()
+
+@register_publish_target("webhook")
+class WebhookTarget(PublishTarget):
+    """
+    POSTs the image and title as multipart form data. The post URL is taken from a
+    JSON `url` field in the response or its `Location` header.
+    """
+
+    def __init__(self, url: str, name: Optional[str] = None, timeout: float = PUBLISH_TARGET_TIMEOUT, headers: Optional[dict] = None):
+        super().__init__(name or "webhook:{}".format(url), timeout)
+        self.url = url
+        self.headers = headers or {}
+        self.session = requests.Session()
+
+    def publish(self, upload: UploadBuffer, title: str):
+        image = upload.image
+        response = self.session.post(
+            self.url,
+            data = {"title": title},
+            files = {"image": ("meme" + image.extension, image.data, image.media_type)},
+            headers = self.headers,
+            timeout = self.timeout
+        )
+        response.raise_for_status()
+        if response.headers.get("Content-Type", "").startswith("application/json"):
+            url = response.json().get("url")
+            if url:
+                return url
+        return response.headers.get("Location")
+
+def target_class(kind: str):
+    if kind in PUBLISH_TARGET_TYPES:
+        return PUBLISH_TARGET_TYPES[kind]
+    if ":" not in kind:
+        raise ValueError("Unknown publish target type: {}".format(kind))
+    module_name, class_name = kind.split(":", 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+def build_publish_target(config: dict):
+    options = dict(config)
+    cls = target_class(options.pop("type"))
+    return cls(**options)
+
+# Constructor argument given by the part after the colon of a `type:argument` entry.
+TARGET_ARGUMENTS = {"reddit": "subreddit", "filesystem": "directory", "webhook": "url"}
+
+def load_publish_targets(spec: str = PUBLISH_TARGETS, path: Optional[str] = PUBLISH_TARGETS_FILE) -> List[PublishTarget]:
+    if path:
+        with open(path, "r") as file:
+            targets = [build_publish_target(config) for config in json.load(file)]
+    else:
+        targets = []
+        for entry in filter(None, (entry.strip() for entry in spec.split(","))):
+            kind, _, argument = entry.partition(":")
+            if kind not in TARGET_ARGUMENTS or not argument:
+                raise ValueError("Invalid publish target in PUBLISH_TARGETS: {}".format(entry))
+            targets.append(build_publish_target({"type": kind, TARGET_ARGUMENTS[kind]: argument}))
+    names = [target.name for target in targets]
+    if len(set(names)) != len(names):
+        raise ValueError("Publish target names must be unique: {}".format(", ".join(names)))
+    return targets
+
+class MultiTargetPublisher:
+    """
+    Publishes to all targets concurrently, so a publication takes as long as its
+    slowest target rather than the sum of them. A target that runs past its
+    timeout is reported as `timeout`; its thread is left to finish on its own,
+    so the post may still appear and the outcome is unknown.
+    """
+
+    def __init__(self, targets: List[PublishTarget], workers: int = PUBLISH_FANOUT_WORKERS):
+        if not targets:
+            raise ValueError("At least one publish target is required")
+        self.targets = {target.name: target for target in targets}
+        self.executor = ThreadPoolExecutor(max_workers = max(workers, len(targets)), thread_name_prefix = "publish-target")
+
+    def publish_one(self, target: PublishTarget, upload: UploadBuffer, title: str):
+        started = time.perf_counter()
+        url = target.publish(upload, title)
+        return url, time.perf_counter() - started
+
+    def publish(self, image: MemeImage, title: str, names: Optional[List[str]] = None) -> Dict[str, TargetResult]:
+        targets = [self.targets[name] for name in (self.targets if names is None else names)]
+        upload = UploadBuffer(image)
+        pending = [len(targets)]
+        pending_lock = threading.Lock()
+
+        def release(_):
+            # The shared buffer outlives timed-out targets that are still uploading from it.
+            with pending_lock:
+                pending[0] -= 1
+                last = pending[0] == 0
+            if last:
+                upload.close()
+
+        started = time.monotonic()
+        futures = []
+        for target in targets:
+            future = self.executor.submit(self.publish_one, target, upload, title)
+            future.add_done_callback(release)
+            futures.append((target, future))
+
+        results = {}
+        for target, future in futures:
+            try:
+                url, seconds = future.result(timeout = max(0.0, started + target.timeout - time.monotonic()))
+                results[target.name] = TargetResult("published", url, seconds = seconds)
+            except FutureTimeoutError:
+                results[target.name] = TargetResult("timeout", error = "Timed out after {:g}s".format(target.timeout), seconds = target.timeout)
+            except Exception as e:
+                results[target.name] = TargetResult("failed", error = str(e) or type(e).__name__, seconds = time.monotonic() - started, retry_after = target.retry_after(e))
+        return results
+
+    def rate_limits(self):
+        """Current limits of the targets that report them; a target failing to is skipped."""
+        limits = []
+        for target in self.targets.values():
+            try:
+                limits.append(target.rate_limits())
+            except Exception as e:
+                logger.warning("Failed to read rate limits", extra = {"target": target.name, "error": str(e)})
+        return limits
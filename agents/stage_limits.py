@@ -0,0 +1,74 @@
+from google.adk.agents import BaseAgent
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event
+from typing import AsyncGenerator, Optional
+import asyncio
+import time
+import os
+
+from metrics import STAGE_DURATION, STAGE_IN_FLIGHT, STAGE_WAIT, STAGE_WAITING
+from observability import timed_span
+from config import load_config
+
+load_config()
+
+# Maximum number of concurrent runs per pipeline stage, overridable with
+# STAGE_LIMIT_<STAGE> environment variables (e.g. STAGE_LIMIT_COMPOSE=2).
+DEFAULT_STAGE_LIMITS = {
+    "moderation": 32,
+    "scout": 8,
+    "caption": 32,
+    "compose": 4,
+    "publish": 8,
+}
+
+_stage_semaphores = {}
+
+def get_stage_limit(stage: str):
+    default = DEFAULT_STAGE_LIMITS.get(stage, 8)
+    return max(1, int(os.getenv("STAGE_LIMIT_{}".format(stage.upper()), default)))
+
+def get_stage_semaphore(stage: str):
+    semaphore = _stage_semaphores.get(stage)
+    if semaphore is None:
+        semaphore = _stage_semaphores[stage] = asyncio.Semaphore(get_stage_limit(stage))
+    return semaphore
+
+class StageLimitedAgent(BaseAgent):
+    """
+    Runs its single sub-agent while holding the concurrency slot of a pipeline stage.
+    The stage is skipped when its `output_key` is already set, e.g. from the result cache.
+    The wait for the slot and the sub-agent's run are recorded as stage metrics.
+    """
+
+    stage: str
+    output_key: Optional[str] = None
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        if self.output_key and ctx.session.state.get(self.output_key) is not None:
+            return
+        agent = self.sub_agents[0]
+        waiting = time.perf_counter()
+        STAGE_WAITING.inc(stage = self.stage)
+        try:
+            await get_stage_semaphore(self.stage).acquire()
+        finally:
+            STAGE_WAITING.dec(stage = self.stage)
+        STAGE_WAIT.observe(time.perf_counter() - waiting, stage = self.stage)
+        STAGE_IN_FLIGHT.inc(stage = self.stage)
+        try:
+            with timed_span("stage {}".format(self.stage), STAGE_DURATION, stage = self.stage, agent = agent.name):
+                async for event in agent.run_async(ctx):
+                    yield event
+        finally:
+            STAGE_IN_FLIGHT.dec(stage = self.stage)
+            get_stage_semaphore(self.stage).release()
+
+def limit_stage(stage: str, agent: BaseAgent, output_key: Optional[str] = None):
+    return StageLimitedAgent(
+        name = "{}_stage".format(stage),
+        description = "Concurrency-limited {} stage.".format(stage),
+        stage = stage,
+        output_key = output_key,
+        sub_agents = [agent]
+    )
@@ -0,0 +1,187 @@
+"""
+Cache for meme template images: a content-addressed on-disk store of the raw
+bytes plus an in-memory LRU of decoded images bounded by their size.
+
+Pull every template in the dataset into the disk store with
+
+    python -m agents.template_cache warm
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import hashlib
+import threading
+import logging
+import json
+import os
+import cv2
+import numpy as np
+import requests
+
+from agents.template_index import DATA_DIR, get_template_index
+from metrics import TEMPLATE_IMAGE_CACHE_LOOKUPS
+from config import load_config
+
+load_config()
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_CACHE_DIR = Path(os.getenv("TEMPLATE_CACHE_DIR", DATA_DIR / "template_cache"))
+TEMPLATE_CACHE_MAX_BYTES = int(os.getenv("TEMPLATE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+TEMPLATE_CACHE_OFFLINE = os.getenv("TEMPLATE_CACHE_OFFLINE", "false").lower() == "true"
+TEMPLATE_FETCH_TIMEOUT = float(os.getenv("TEMPLATE_FETCH_TIMEOUT", 10))
+
+_cache_lock = threading.Lock()
+_template_cache = None
+
+class TemplateNotCachedError(Exception):
+    """Raised in offline mode when a template is not in the disk store."""
+
+class TemplateImageCache:
+    def __init__(self, cache_dir = TEMPLATE_CACHE_DIR, max_bytes = TEMPLATE_CACHE_MAX_BYTES, offline = TEMPLATE_CACHE_OFFLINE, timeout = TEMPLATE_FETCH_TIMEOUT):
+        self.cache_dir = Path(cache_dir)
+        self.index_path = self.cache_dir / "index.json"
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.decoded = OrderedDict()
+        self.decoded_bytes = 0
+        self.index = {}
+        if self.index_path.is_file():
+            with open(self.index_path, "r") as file:
+                self.index = json.load(file)
+
+    def blob_path(self, digest: str):
+        return self.cache_dir / digest[:2] / digest
+
+    def save_index(self):
+        self.cache_dir.mkdir(parents = True, exist_ok = True)
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(self.index, file, indent = 4)
+        os.replace(tmp_path, self.index_path)
+
+    def store(self, url: str, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if not path.is_file():
+            path.parent.mkdir(parents = True, exist_ok = True)
+            tmp_path = path.with_suffix(".tmp{}".format(threading.get_ident()))
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        with self.lock:
+            self.index[url] = digest
+            self.save_index()
+
+    def get_bytes(self, url: str):
+        """Returns the raw template bytes, fetching and storing them on a miss unless offline."""
+        digest = self.index.get(url)
+        if digest is not None:
+            path = self.blob_path(digest)
+            if path.is_file():
+                TEMPLATE_IMAGE_CACHE_LOOKUPS.inc(source = "disk")
+                return path.read_bytes()
+
+        if self.offline:
+            raise TemplateNotCachedError("Template {} is not cached and offline mode is enabled.".format(url))
+
+        TEMPLATE_IMAGE_CACHE_LOOKUPS.inc(source = "fetch")
+        response = self.session.get(url, timeout = self.timeout)
+        response.raise_for_status()
+        self.store(url, response.content)
+        return response.content
+
+    def get_image(self, url: str, keep: bool = True):
+        """
+        Returns a decoded BGR copy of the template that the caller may draw on.
+        With `keep=False` a template decoded here is not added to the LRU, for
+        callers that hold on to the decoded image themselves.
+        """
+        with self.lock:
+            img = self.decoded.get(url)
+            if img is not None:
+                self.decoded.move_to_end(url)
+                TEMPLATE_IMAGE_CACHE_LOOKUPS.inc(source = "memory")
+                return img.copy()
+
+        img = cv2.imdecode(np.frombuffer(self.get_bytes(url), dtype = np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("Template {} could not be decoded.".format(url))
+
+        if not keep:
+            return img
+
+        with self.lock:
+            if url not in self.decoded and img.nbytes <= self.max_bytes:
+                self.decoded[url] = img
+                self.decoded_bytes += img.nbytes
+                while self.decoded_bytes > self.max_bytes:
+                    _, evicted = self.decoded.popitem(last = False)
+                    self.decoded_bytes -= evicted.nbytes
+        return img.copy()
+
+    def warm(self, urls, workers = 8, decode = False):
+        """Pulls the given templates into the disk store (and optionally the decoded LRU)."""
+        fetch = self.get_image if decode else self.get_bytes
+        failed = []
+
+        def warm_one(url):
+            try:
+                fetch(url)
+            except Exception as e:
+                logger.warning("Failed to cache template %s: %s", url, e)
+                failed.append(url)
+
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            list(executor.map(warm_one, urls))
+        return failed
+
+    def preload(self, urls = None, workers = 4):
+        """
+        Decodes templates that are already in the disk store into the LRU, without
+        fetching anything, until the LRU is full. Returns the number decoded.
+        """
+        urls = [url for url in (self.index if urls is None else urls) if url in self.index]
+        decoded = [0]
+
+        def preload_one(url):
+            if self.decoded_bytes >= self.max_bytes:
+                return
+            try:
+                self.get_image(url)
+                decoded[0] += 1
+            except Exception as e:
+                logger.warning("Failed to preload template %s: %s", url, e)
+
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            list(executor.map(preload_one, urls))
+        return decoded[0]
+
+def get_template_cache():
+    global _template_cache
+    if _template_cache is None:
+        with _cache_lock:
+            if _template_cache is None:
+                _template_cache = TemplateImageCache()
+    return _template_cache
+
+def dataset_template_urls():
+    return [template["url"] for template in get_template_index().templates]
+
+def main():
+    parser = argparse.ArgumentParser(description = "Manage the meme template image cache.")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+    warm_parser = subparsers.add_parser("warm", help = "Download every template in the dataset into the disk store.")
+    warm_parser.add_argument("--workers", type = int, default = 8)
+    args = parser.parse_args()
+
+    if args.command == "warm":
+        urls = dataset_template_urls()
+        failed = get_template_cache().warm(urls, workers = args.workers)
+        print("Cached {} of {} templates in {}".format(len(urls) - len(failed), len(urls), TEMPLATE_CACHE_DIR))
+
+if __name__ == "__main__":
+    main()
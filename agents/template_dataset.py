@@ -0,0 +1,183 @@
+"""
+Builds the binary template dataset read by the template index: a `.npy` matrix
+of normalized embeddings plus `data/templates.json` with the model name, format
+version and per-template metadata.
+
+    python -m agents.template_dataset build                            # imgflip's popular templates
+    python -m agents.template_dataset build --source templates.jsonl   # local metadata (JSON list or JSONL)
+    python -m agents.template_dataset import-json                      # convert meme_data_with_embeddings.json
+    python -m agents.template_dataset info
+
+Source records need 'name' and 'url' and may carry 'id' and 'description'.
+Rebuilds are incremental: templates whose embedded text is unchanged keep
+their embedding and only new or changed ones are sent to the model.
+"""
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import time
+import uuid
+import os
+import numpy as np
+import requests
+
+from agents.template_index import (
+    EMBEDDING_MODEL_NAME, TEMPLATE_DATA_PATH, TEMPLATE_DATASET_FORMAT, TEMPLATE_DATASET_PATH,
+    TEMPLATE_DATASET_VERSION, get_embedding_model, normalize_rows
+)
+from config import load_config
+
+load_config()
+
+IMGFLIP_MEMES_URL = "https://api.imgflip.com/get_memes"
+TEMPLATE_FETCH_TIMEOUT = float(os.getenv("TEMPLATE_FETCH_TIMEOUT", 10))
+
+def template_key(record):
+    return str(record.get("id") or record["url"])
+
+def template_text(record):
+    description = (record.get("description") or "").strip()
+    return "{}: {}".format(record["name"], description) if description else record["name"]
+
+def text_hash(text: str):
+    return hashlib.sha256("{}\n{}".format(EMBEDDING_MODEL_NAME, text).encode("utf-8")).hexdigest()[:16]
+
+def fetch_imgflip_templates(timeout = TEMPLATE_FETCH_TIMEOUT):
+    response = requests.get(IMGFLIP_MEMES_URL, timeout = timeout)
+    response.raise_for_status()
+    payload = response.json()
+    if not payload.get("success"):
+        raise RuntimeError("imgflip returned an error: {}".format(payload.get("error_message")))
+    return [{"id": meme["id"], "name": meme["name"], "url": meme["url"]} for meme in payload["data"]["memes"]]
+
+def read_source(path):
+    with open(path, "r") as file:
+        if str(path).endswith(".jsonl"):
+            return [json.loads(line) for line in file if line.strip()]
+        return json.load(file)
+
+def unique_records(records):
+    seen = {}
+    for record in records:
+        seen.setdefault(template_key(record), record)
+    return list(seen.values())
+
+def load_existing(path = TEMPLATE_DATASET_PATH):
+    """Maps template keys of the current dataset to their text hash and embedding."""
+    path = Path(path)
+    if not path.is_file():
+        return {}
+    try:
+        with open(path, "r") as file:
+            metadata = json.load(file)
+        if metadata.get("format") != TEMPLATE_DATASET_FORMAT or metadata.get("model_name") != EMBEDDING_MODEL_NAME:
+            return {}
+        matrix = np.load(path.parent / metadata["matrix"], mmap_mode = "r")
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Ignoring existing template dataset: {e}")
+        return {}
+    return {template["key"]: (template["text_hash"], matrix[row]) for row, template in enumerate(metadata["templates"])}
+
+def write_dataset(records, hashes, embeddings, path = TEMPLATE_DATASET_PATH, dtype = "float32"):
+    """
+    Writes the matrix under a fresh name before replacing the metadata that points
+    at it, so readers never see a metadata file and a matrix from different builds.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    matrix_name = "{}-{}.npy".format(path.stem, uuid.uuid4().hex[:12])
+    matrix = np.ascontiguousarray(embeddings, dtype = dtype)
+    np.save(path.parent / matrix_name, matrix)
+
+    metadata = {
+        "format": TEMPLATE_DATASET_FORMAT,
+        "version": TEMPLATE_DATASET_VERSION,
+        "model_name": EMBEDDING_MODEL_NAME,
+        "dtype": dtype,
+        "count": matrix.shape[0],
+        "dim": matrix.shape[1],
+        "matrix": matrix_name,
+        "built_at": time.time(),
+        "templates": [
+            {"key": template_key(record), "name": record["name"], "url": record["url"], "text_hash": text_hash}
+            for record, text_hash in zip(records, hashes)
+        ]
+    }
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "w") as file:
+        json.dump(metadata, file)
+    os.replace(temp_path, path)
+
+    for old_matrix in path.parent.glob("{}-*.npy".format(path.stem)):
+        if old_matrix.name != matrix_name:
+            old_matrix.unlink()
+    return metadata
+
+def build_dataset(records, path = TEMPLATE_DATASET_PATH, dtype = "float32", batch_size = 64, full = False, embed = None):
+    """Embeds new or changed templates in batches and writes the dataset. Returns the number embedded."""
+    records = unique_records(records)
+    existing = {} if full else load_existing(path)
+    texts = [template_text(record) for record in records]
+    hashes = [text_hash(text) for text in texts]
+
+    rows = [None] * len(records)
+    pending = []
+    for i, record in enumerate(records):
+        previous = existing.get(template_key(record))
+        if previous is not None and previous[0] == hashes[i]:
+            rows[i] = np.asarray(previous[1], dtype = np.float32)
+        else:
+            pending.append(i)
+
+    if pending:
+        embed = embed or (lambda batch: get_embedding_model().encode(batch, batch_size = batch_size, convert_to_numpy = True))
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            for i, embedding in zip(batch, normalize_rows(embed([texts[i] for i in batch]))):
+                rows[i] = embedding
+            print("Embedded {}/{} templates".format(min(start + batch_size, len(pending)), len(pending)))
+
+    write_dataset(records, hashes, np.stack(rows), path, dtype)
+    return len(pending)
+
+def import_legacy_json(json_path = TEMPLATE_DATA_PATH, path = TEMPLATE_DATASET_PATH, dtype = "float32"):
+    """Converts the legacy JSON dataset, whose embeddings are of the template names."""
+    with open(json_path, "r") as file:
+        meme_data = unique_records(json.load(file))
+    records = [{"name": meme["name"], "url": meme["url"]} for meme in meme_data]
+    hashes = [text_hash(template_text(record)) for record in records]
+    return write_dataset(records, hashes, normalize_rows([meme["embedding"] for meme in meme_data]), path, dtype)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+    build_parser = subparsers.add_parser("build", help = "Embed template metadata and write the binary dataset.")
+    build_parser.add_argument("--source", default = "imgflip", help = "'imgflip' or a JSON/JSONL file of template records.")
+    build_parser.add_argument("--dtype", choices = ["float32", "float16"], default = "float32")
+    build_parser.add_argument("--batch-size", type = int, default = 64)
+    build_parser.add_argument("--full", action = "store_true", help = "Re-embed every template instead of only new or changed ones.")
+    import_parser = subparsers.add_parser("import-json", help = "Convert the legacy JSON dataset without re-embedding.")
+    import_parser.add_argument("--json", default = str(TEMPLATE_DATA_PATH))
+    import_parser.add_argument("--dtype", choices = ["float32", "float16"], default = "float32")
+    subparsers.add_parser("info", help = "Describe the current binary dataset.")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        records = fetch_imgflip_templates() if args.source == "imgflip" else read_source(args.source)
+        embedded = build_dataset(records, TEMPLATE_DATASET_PATH, args.dtype, args.batch_size, args.full)
+        print("Wrote {} templates ({} embedded) to {}".format(len(unique_records(records)), embedded, TEMPLATE_DATASET_PATH))
+    elif args.command == "import-json":
+        metadata = import_legacy_json(args.json, TEMPLATE_DATASET_PATH, args.dtype)
+        print("Converted {} templates to {}".format(metadata["count"], TEMPLATE_DATASET_PATH))
+    elif args.command == "info":
+        with open(TEMPLATE_DATASET_PATH, "r") as file:
+            metadata = json.load(file)
+        matrix_size = (TEMPLATE_DATASET_PATH.parent / metadata["matrix"]).stat().st_size
+        print("{} templates, {} x {} {} matrix ({:.1f} KB), model {}, format version {}, built {}".format(
+            metadata["count"], metadata["count"], metadata["dim"], metadata["dtype"], matrix_size / 1024,
+            metadata["model_name"], metadata["version"], time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(metadata["built_at"]))
+        ))
+
+if __name__ == "__main__":
+    main()
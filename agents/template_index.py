@@ -0,0 +1,198 @@
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple
+import threading
+import logging
+import json
+import os
+import numpy as np
+
+from agents.vector_index import TEMPLATE_INDEX_BACKEND, build_vector_index
+from metrics import EMBEDDING_QUEUE_DEPTH
+from config import load_config
+
+load_config()
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+TEMPLATE_DATA_PATH = DATA_DIR / "meme_data_with_embeddings.json"
+# Metadata of the binary dataset written by `python -m agents.template_dataset build`.
+TEMPLATE_DATASET_PATH = DATA_DIR / "templates.json"
+TEMPLATE_DATASET_FORMAT = "meme-machine-templates"
+TEMPLATE_DATASET_VERSION = 1
+
+# Number of best-matching templates kept per prompt for re-ranking.
+TEMPLATE_CANDIDATES = int(os.getenv("TEMPLATE_CANDIDATES", 20))
+
+# Encode prompts of concurrent requests together instead of one at a time.
+EMBEDDING_BATCHING = os.getenv("EMBEDDING_BATCHING", "true").lower() != "false"
+
+# Separate locks so the model and the index can be loaded at the same time.
+_model_lock = threading.Lock()
+_index_lock = threading.Lock()
+_batcher_lock = threading.Lock()
+_embedding_model = None
+_template_index = None
+_embedding_batcher = None
+
+class PromptMatch(NamedTuple):
+    embedding: np.ndarray
+    # `(template index, score)` pairs, best first.
+    templates: list
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+class TemplateIndex:
+    """
+    Pre-normalized float32 matrix of template embeddings answering top-k cosine
+    queries through an exact or approximate vector index (see agents.vector_index).
+    """
+
+    def __init__(self, templates, embeddings, backend = TEMPLATE_INDEX_BACKEND):
+        if len(templates) != len(embeddings):
+            raise ValueError("Template metadata and embedding matrix have different lengths.")
+        self.templates = templates
+        self.embeddings = embeddings
+        self.backend = backend
+        self._vector_index = None
+
+    def __len__(self):
+        return len(self.templates)
+
+    @classmethod
+    def from_json(cls, path = TEMPLATE_DATA_PATH, use_sidecar = True):
+        """
+        Loads the template dataset once. The normalized matrix is cached in a `.npy`
+        sidecar next to the JSON file and memory-mapped on later loads.
+        """
+        path = Path(path)
+        with open(path, "r") as file:
+            meme_data = json.load(file)
+        templates = [{"name": meme["name"], "url": meme["url"]} for meme in meme_data]
+
+        sidecar_path = path.with_suffix(".npy")
+        if use_sidecar and sidecar_path.is_file() and sidecar_path.stat().st_mtime >= path.stat().st_mtime:
+            embeddings = np.load(sidecar_path, mmap_mode = "r")
+            if embeddings.shape[0] == len(templates) and embeddings.dtype == np.float32:
+                return cls(templates, embeddings)
+
+        embeddings = normalize_rows([meme["embedding"] for meme in meme_data])
+        if use_sidecar:
+            try:
+                np.save(sidecar_path, embeddings)
+            except OSError as e:
+                logger.warning("Failed to write embedding sidecar: %s", e)
+        return cls(templates, embeddings)
+
+    @property
+    def vector_index(self):
+        # Built on first search, so loading the dataset stays cheap.
+        if self._vector_index is None:
+            self._vector_index = build_vector_index(self.embeddings, self.backend)
+        return self._vector_index
+
+    @classmethod
+    def from_dataset(cls, path = TEMPLATE_DATASET_PATH):
+        """
+        Loads the binary dataset: a metadata JSON file naming a `.npy` matrix of
+        normalized embeddings, which is memory-mapped (float16 matrices are
+        widened to float32 in memory).
+        """
+        path = Path(path)
+        with open(path, "r") as file:
+            metadata = json.load(file)
+        if metadata.get("format") != TEMPLATE_DATASET_FORMAT or metadata.get("version") != TEMPLATE_DATASET_VERSION:
+            raise ValueError("Unsupported template dataset format {} version {}.".format(metadata.get("format"), metadata.get("version")))
+        if metadata.get("model_name") != EMBEDDING_MODEL_NAME:
+            raise ValueError("Template dataset was embedded with {}, expected {}.".format(metadata.get("model_name"), EMBEDDING_MODEL_NAME))
+
+        embeddings = np.load(path.parent / metadata["matrix"], mmap_mode = "r")
+        if embeddings.shape != (metadata["count"], metadata["dim"]):
+            raise ValueError("Template matrix has shape {}, metadata expects ({}, {}).".format(embeddings.shape, metadata["count"], metadata["dim"]))
+        if embeddings.dtype != np.float32:
+            embeddings = embeddings.astype(np.float32)
+        templates = [{"name": template["name"], "url": template["url"]} for template in metadata["templates"]]
+        return cls(templates, embeddings)
+
+    def search(self, query_embedding, k = 1):
+        """Returns `(index, score)` pairs for the `k` most similar templates, best first."""
+        return self.search_batch(np.reshape(query_embedding, (1, -1)), k)[0]
+
+    def search_batch(self, query_embeddings, k = 1):
+        """Runs `search` for a batch of queries at once."""
+        return self.vector_index.search_batch(normalize_rows(query_embeddings), k)
+
+def get_embedding_model():
+    global _embedding_model
+    if _embedding_model is None:
+        with _model_lock:
+            if _embedding_model is None:
+                from sentence_transformers import SentenceTransformer
+                _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    return _embedding_model
+
+def embed_prompts(prompts):
+    """Encodes a list of prompts as one batch."""
+    return get_embedding_model().encode(list(prompts), batch_size = max(len(prompts), 1), convert_to_numpy = True).astype(np.float32)
+
+def match_prompts(prompts):
+    """Encodes a batch of prompts and matches all of them against the template index at once."""
+    embeddings = embed_prompts(prompts)
+    matches = get_template_index().search_batch(embeddings, k = TEMPLATE_CANDIDATES)
+    results = []
+    for embedding, top in zip(embeddings, matches):
+        embedding.flags.writeable = False
+        results.append(PromptMatch(embedding, top))
+    return results
+
+def get_embedding_batcher():
+    global _embedding_batcher
+    if _embedding_batcher is None:
+        with _batcher_lock:
+            if _embedding_batcher is None:
+                from agents.embedding_batcher import EmbeddingBatcher
+                _embedding_batcher = EmbeddingBatcher(match_prompts)
+                EMBEDDING_QUEUE_DEPTH.set_function(_embedding_batcher.queue.qsize)
+    return _embedding_batcher
+
+@lru_cache(maxsize = 1024)
+def match_prompt(prompt: str):
+    """
+    Embeds a prompt with the shared sentence-transformer and finds its closest
+    templates. Results are cached so the scout and the local moderation tier
+    encode each prompt only once. With EMBEDDING_BATCHING enabled, prompts from
+    concurrent requests are encoded and matched together by the embedding batcher.
+    """
+    if EMBEDDING_BATCHING:
+        return get_embedding_batcher()(prompt)
+    return match_prompts([prompt])[0]
+
+def embed_prompt(prompt: str):
+    return match_prompt(prompt).embedding
+
+def get_template_index():
+    global _template_index
+    if _template_index is None:
+        with _index_lock:
+            if _template_index is None:
+                if TEMPLATE_DATASET_PATH.is_file():
+                    try:
+                        _template_index = TemplateIndex.from_dataset(TEMPLATE_DATASET_PATH)
+                    except (OSError, KeyError, ValueError) as e:
+                        logger.warning("Falling back to the JSON template dataset: %s", e)
+                if _template_index is None:
+                    use_sidecar = os.getenv("TEMPLATE_EMBEDDING_SIDECAR", "true").lower() != "false"
+                    _template_index = TemplateIndex.from_json(TEMPLATE_DATA_PATH, use_sidecar = use_sidecar)
+    return _template_index
+
+def load_template_index():
+    """Loads the embedding model and template index so the first request does not pay for it."""
+    get_embedding_model()
+    get_template_index().vector_index
@@ -0,0 +1,150 @@
+"""
+Precomputed caption regions for meme templates.
+
+The white caption boxes of a template never change, so they are detected once
+and stored in `data/template_layouts.json`. Warm-up adds the templates in the
+disk cache that are missing from it, and templates first seen by a request are
+added as they are detected. Rebuild the index for every template in the dataset
+with
+
+    python -m agents.template_layout build
+"""
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import threading
+import logging
+import json
+import os
+import cv2
+import numpy as np
+
+from agents.template_cache import get_template_cache
+from agents.template_index import DATA_DIR, get_template_index
+from config import load_config
+
+load_config()
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_LAYOUT_PATH = DATA_DIR / "template_layouts.json"
+
+MIN_REGION_AREA = 5000
+REGION_PADDING = 10
+
+_layout_lock = threading.Lock()
+_layout_index = None
+
+def detect_layout(img):
+    """
+    Finds the white caption boxes of a template. Boxes are `[x, y, w, h]` already
+    inset by the padding, ordered top to bottom then left to right; `primary` is
+    the index of the largest box, or None when the template has no white box.
+    """
+    h, w = img.shape[:2]
+
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    _, mask = cv2.threshold(gray, 250, 255, cv2.THRESH_BINARY)
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    regions = []
+    for cnt in contours:
+        area = cv2.contourArea(cnt)
+        if area >= MIN_REGION_AREA:
+            x, y, rw, rh = cv2.boundingRect(cnt)
+            regions.append((area, [x + REGION_PADDING, y + REGION_PADDING, rw - 2 * REGION_PADDING, rh - 2 * REGION_PADDING]))
+
+    regions.sort(key = lambda region: (region[1][1], region[1][0]))
+    boxes = [box for _, box in regions]
+    primary = max(range(len(regions)), key = lambda i: regions[i][0]) if regions else None
+    return {"width": w, "height": h, "boxes": boxes, "primary": primary}
+
+class TemplateLayoutIndex:
+    def __init__(self, path = TEMPLATE_LAYOUT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.layouts = {}
+        if os.path.isfile(path):
+            with open(path, "r") as file:
+                self.layouts = json.load(file)
+
+    def get(self, url: str, img):
+        """Returns the stored layout for the template, detecting it if missing or stale."""
+        h, w = img.shape[:2]
+        layout = self.layouts.get(url)
+        if layout is None or layout["width"] != w or layout["height"] != h:
+            layout = detect_layout(img)
+            with self.lock:
+                self.layouts[url] = layout
+                self.save_quietly()
+        return layout
+
+    def build_missing(self, urls):
+        """Detects and saves the layouts of the given cached templates that are not in the index yet."""
+        built = {}
+        for url in urls:
+            if url in self.layouts:
+                continue
+            try:
+                built[url] = detect_layout(get_template_cache().get_image(url, keep = False))
+            except Exception as e:
+                logger.warning("Failed to build layout for %s: %s", url, e)
+        if built:
+            with self.lock:
+                self.layouts.update(built)
+                self.save_quietly()
+        return len(built)
+
+    def save_quietly(self):
+        # Layouts are also kept in memory, so a read-only data directory only costs detecting them again after a restart.
+        try:
+            self.save()
+        except OSError as e:
+            logger.warning("Failed to save template layouts to %s: %s", self.path, e)
+
+    def save(self):
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as file:
+            json.dump(self.layouts, file, indent = 4, sort_keys = True)
+        os.replace(tmp_path, self.path)
+
+def get_layout_index():
+    global _layout_index
+    if _layout_index is None:
+        with _layout_lock:
+            if _layout_index is None:
+                _layout_index = TemplateLayoutIndex()
+    return _layout_index
+
+def get_template_layout(url: str, img):
+    return get_layout_index().get(url, img)
+
+def build_layout(url: str):
+    try:
+        data = get_template_cache().get_bytes(url)
+        img = cv2.imdecode(np.frombuffer(data, dtype = np.uint8), cv2.IMREAD_COLOR)
+        return url, detect_layout(img)
+    except Exception as e:
+        logger.warning("Failed to build layout for %s: %s", url, e)
+        return url, None
+
+def main():
+    parser = argparse.ArgumentParser(description = "Manage the template caption layout index.")
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+    build_parser = subparsers.add_parser("build", help = "Detect the caption boxes of every template in the dataset.")
+    build_parser.add_argument("--workers", type = int, default = os.cpu_count())
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO, format = "%(message)s")
+
+    if args.command == "build":
+        urls = [template["url"] for template in get_template_index().templates]
+        index = TemplateLayoutIndex()
+        with ProcessPoolExecutor(max_workers = args.workers) as executor:
+            for url, layout in executor.map(build_layout, urls):
+                if layout is not None:
+                    index.layouts[url] = layout
+        index.save()
+        logger.info("Stored layouts for %d of %d templates in %s", sum(url in index.layouts for url in urls), len(urls), index.path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Top-k template retrieval on top of the template index.
+
+Candidates closest to the prompt embedding are re-ranked with maximal marginal
+relevance (MMR), so the results are not all near-identical templates, and
+templates a user got recently are skipped in favour of an alternative that
+scores almost as well.
+"""
+from collections import OrderedDict, deque
+from typing import NamedTuple, Optional
+import threading
+import os
+import numpy as np
+
+from agents.template_index import PromptMatch, get_template_index, match_prompt
+from config import load_config
+
+load_config()
+
+# Weight of relevance against novelty in MMR; 1.0 ranks by similarity alone.
+TEMPLATE_MMR_LAMBDA = float(os.getenv("TEMPLATE_MMR_LAMBDA", 0.7))
+# Templates remembered per user, and how many users are remembered.
+TEMPLATE_RECENT_SIZE = int(os.getenv("TEMPLATE_RECENT_SIZE", 5))
+TEMPLATE_RECENT_USERS = int(os.getenv("TEMPLATE_RECENT_USERS", 10000))
+# A recently used template is only skipped for one scoring at most this much lower.
+TEMPLATE_RECENT_MARGIN = float(os.getenv("TEMPLATE_RECENT_MARGIN", 0.05))
+
+class TemplateCandidate(NamedTuple):
+    index: int
+    name: str
+    url: str
+    score: float
+
+class RecentTemplates:
+    """Templates recently picked for each user, bounded per user and in the number of users."""
+
+    def __init__(self, size = TEMPLATE_RECENT_SIZE, max_users = TEMPLATE_RECENT_USERS):
+        self.size = size
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.users = OrderedDict()
+
+    def get(self, user_id: str):
+        with self.lock:
+            return set(self.users.get(user_id, ()))
+
+    def add(self, user_id: str, template_index: int):
+        with self.lock:
+            recent = self.users.get(user_id)
+            if recent is None:
+                recent = self.users[user_id] = deque(maxlen = self.size)
+            self.users.move_to_end(user_id)
+            recent.append(template_index)
+            while len(self.users) > self.max_users:
+                self.users.popitem(last = False)
+
+recent_templates = RecentTemplates()
+
+def mmr(scores, embeddings, k, relevance = TEMPLATE_MMR_LAMBDA):
+    """Orders candidates by maximal marginal relevance and returns the first `k` positions."""
+    similarity = embeddings @ embeddings.T
+    remaining = list(range(len(scores)))
+    selected = []
+    while remaining and len(selected) < k:
+        if selected:
+            redundancy = similarity[np.ix_(remaining, selected)].max(axis = 1)
+        else:
+            redundancy = np.zeros(len(remaining), dtype = np.float32)
+        values = relevance * scores[remaining] - (1.0 - relevance) * redundancy
+        selected.append(remaining.pop(int(np.argmax(values))))
+    return selected
+
+def suppress_recent(candidates, recent, margin = TEMPLATE_RECENT_MARGIN):
+    if not recent or not candidates:
+        return candidates
+    best = candidates[0][1]
+    fresh = [candidate for candidate in candidates if candidate[0] not in recent]
+    if fresh and fresh[0][1] >= best - margin:
+        return fresh
+    return candidates
+
+def retrieve_templates(prompt: str, k: int = 5, user_id: Optional[str] = None, diversity: float = TEMPLATE_MMR_LAMBDA, match: Optional[PromptMatch] = None):
+    """Returns up to `k` templates for the prompt, best first. `match` reuses an already computed `PromptMatch`."""
+    index = get_template_index()
+    candidates = (match or match_prompt(prompt)).templates
+    if user_id:
+        candidates = suppress_recent(candidates, recent_templates.get(user_id))
+    if not candidates:
+        return []
+
+    ids = np.array([idx for idx, _ in candidates])
+    scores = np.array([score for _, score in candidates], dtype = np.float32)
+    order = mmr(scores, np.asarray(index.embeddings[ids]), k, diversity) if diversity < 1.0 else range(min(k, len(ids)))
+    return [
+        TemplateCandidate(int(ids[pos]), index.templates[ids[pos]]["name"], index.templates[ids[pos]]["url"], float(scores[pos]))
+        for pos in order
+    ]
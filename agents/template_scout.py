@@ -1,13 +1,14 @@
 from google.adk.agents import BaseAgent, Agent
 from google.genai import types
-from sentence_transformers import SentenceTransformer
-import json
-from dotenv import load_dotenv
-import os
+import functools
+import asyncio
 
-load_dotenv()
-os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
-os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = os.getenv("GOOGLE_GENAI_USE_VERTEXAI")
+from agents.template_retrieval import recent_templates, retrieve_templates
+from agents.tool_agent import StateToolAgent
+from config import load_config
+from observability import traced_tool
+
+load_config()
 
 # class TemplateScoutAgent(BaseAgent):
 #     class Config:
@@ -39,25 +40,39 @@ os.environ["GOOGLE_GENAI_USE_VERTEXAI"] = os.getenv("GOOGLE_GENAI_USE_VERTEXAI")
 
 agent_instruction = """You are an agent whose task is to execute the 'get_template_url' tool with state key 'prompt' as argument. Strictly, just provide the output from tool as response, DO NOT add any prefixes, explanations, hashtags, or any other extra text."""
 
+@traced_tool
 def get_template_url(prompt: str):
-    model = SentenceTransformer("all-MiniLM-L6-v2")
-    with open("data/meme_data_with_embeddings.json", "r") as file:
-        meme_data = json.load(file)
+    [template] = retrieve_templates(prompt, k = 1)
+    return template.url
+
+@functools.wraps(get_template_url)
+async def get_template_url_in_thread(prompt: str):
+    # The LLM agent calls plain function tools on the event loop, and the
+    # retrieval blocks on the embedding batcher.
+    return await asyncio.to_thread(get_template_url, prompt)
 
-    prompt_embedding = model.encode([prompt])
-    meme_embeddings = [meme["embedding"] for meme in meme_data]
-    similarities = model.similarity(meme_embeddings, prompt_embedding).tolist()
-    flattened_similarities = [sim[0] for sim in similarities]
-    idx = flattened_similarities.index(max(flattened_similarities))
-    return meme_data[idx]["url"]
+@traced_tool(name = "get_template_url")
+def scout_template_for_user(prompt: str, user_id: str):
+    """Like `get_template_url`, but avoids the templates this user got recently."""
+    [template] = retrieve_templates(prompt, k = 1, user_id = user_id)
+    recent_templates.add(user_id, template.index)
+    return template.url
 
 TemplateScoutAgent = Agent(
     name = "template_scout",
     model = "gemini-2.0-flash",
     instruction = agent_instruction,
     output_key = "image_url",
-    tools = [get_template_url],
+    tools = [get_template_url_in_thread],
     generate_content_config = types.GenerateContentConfig(
         temperature = 0.1
     )
-)
\ No newline at end of file
+)
+
+TemplateScoutToolAgent = StateToolAgent(
+    name = "template_scout",
+    description = "Selects the meme template closest to the prompt without an LLM call.",
+    tool = scout_template_for_user,
+    input_keys = ["prompt", "user_id"],
+    output_key = "image_url"
+)
@@ -0,0 +1,122 @@
+from functools import lru_cache
+from typing import NamedTuple
+import os
+import cv2
+
+from config import load_config
+
+load_config()
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+# Font scales are searched on a fixed grid so word widths cached for one caption
+# are reused by the next one.
+FONT_SCALE_STEP = 0.05
+MIN_FONT_SCALE = float(os.getenv("CAPTION_MIN_FONT_SCALE", 0.4))
+MAX_FONT_SCALE = float(os.getenv("CAPTION_MAX_FONT_SCALE", 2.5))
+
+class TextLayout(NamedTuple):
+    lines: list
+    line_widths: list
+    font_scale: float
+    thickness: int
+    text_height: int
+    line_height: int
+    font: int = FONT
+
+    @property
+    def total_height(self):
+        return self.line_height * len(self.lines) - (self.line_height - self.text_height)
+
+def thickness_for_scale(font_scale):
+    return max(1, round(2 * font_scale))
+
+@lru_cache(maxsize = 65536)
+def word_width(word, font, font_scale, thickness):
+    (w, _), _ = cv2.getTextSize(word, font, font_scale, thickness)
+    return w
+
+@lru_cache(maxsize = 1024)
+def font_metrics(font, font_scale, thickness):
+    """Returns the width added by a space between two words and the text height."""
+    (w, h), _ = cv2.getTextSize("x x", font, font_scale, thickness)
+    return w - 2 * word_width("x", font, font_scale, thickness), h
+
+def break_lines(widths, space_width, max_width):
+    """Greedy line breaking from cached word widths, returns `(start, end, width)` per line."""
+    lines = []
+    start, line_width = 0, widths[0]
+    for i in range(1, len(widths)):
+        candidate = line_width + space_width + widths[i]
+        if candidate <= max_width:
+            line_width = candidate
+        else:
+            lines.append((start, i, line_width))
+            start, line_width = i, widths[i]
+    lines.append((start, len(widths), line_width))
+    return lines
+
+def layout_words(words, font, font_scale, thickness, max_width):
+    widths = [word_width(word, font, font_scale, thickness) for word in words]
+    space_width, text_height = font_metrics(font, font_scale, thickness)
+    breaks = break_lines(widths, space_width, max_width)
+    line_height = text_height + max(5, round(5 * font_scale))
+    return TextLayout(
+        lines = [" ".join(words[start:end]) for start, end, _ in breaks],
+        line_widths = [width for _, _, width in breaks],
+        font_scale = font_scale,
+        thickness = thickness,
+        text_height = text_height,
+        line_height = line_height,
+        font = font
+    )
+
+def wrap_text(text, font, font_scale, thickness, max_width):
+    words = text.split()
+    if not words:
+        return []
+    return layout_words(words, font, font_scale, thickness, max_width).lines
+
+def fits(layout, max_width, max_height):
+    return max(layout.line_widths) <= max_width and layout.total_height <= max_height
+
+def fit_text(text, max_width, max_height, font = FONT, min_scale = MIN_FONT_SCALE, max_scale = MAX_FONT_SCALE):
+    """
+    Wraps the text at the largest font scale on the grid whose lines fit inside
+    the region, falling back to the smallest scale when nothing fits.
+    """
+    words = text.split()
+    if not words:
+        return None
+
+    low, high = 0, max(0, int(round((max_scale - min_scale) / FONT_SCALE_STEP)))
+
+    def layout_at(step):
+        font_scale = round(min_scale + step * FONT_SCALE_STEP, 2)
+        return layout_words(words, font, font_scale, thickness_for_scale(font_scale), max_width)
+
+    best = layout_at(low)
+    while low <= high:
+        mid = (low + high) // 2
+        layout = layout_at(mid)
+        if fits(layout, max_width, max_height):
+            best = layout
+            low = mid + 1
+        else:
+            high = mid - 1
+    return best
+
+def draw_text(img, layout, region, text_color, outline_color = None):
+    """
+    Draws the lines of the layout centered in the region. With `outline_color` the
+    text gets a stroke in that color so it stays readable on busy backgrounds.
+    """
+    region_x, region_y, region_w, region_h = region
+    start_y = region_y + (region_h - layout.total_height) // 2 + layout.text_height
+
+    for i, line in enumerate(layout.lines):
+        text_x = region_x + (region_w - layout.line_widths[i]) // 2
+        text_y = start_y + i * layout.line_height
+        if outline_color is not None:
+            cv2.putText(img, line, (text_x, text_y), layout.font, layout.font_scale, outline_color, layout.thickness * 3, cv2.LINE_AA)
+        cv2.putText(img, line, (text_x, text_y), layout.font, layout.font_scale, text_color, layout.thickness, cv2.LINE_AA)
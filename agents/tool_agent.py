@@ -0,0 +1,33 @@
+from google.adk.agents import BaseAgent
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event, EventActions
+from google.genai import types
+from typing import AsyncGenerator, Callable
+import asyncio
+
+class StateToolAgent(BaseAgent):
+    """
+    Deterministic agent that calls a single Python tool with values read from session
+    state and writes the result back to state, without an LLM round trip. It can be
+    used in place of an LLM agent whose only job is to call that tool.
+    """
+
+    tool: Callable
+    input_keys: list[str]
+    output_key: str
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        args = [ctx.session.state.get(key) for key in self.input_keys]
+        missing = [key for key, value in zip(self.input_keys, args) if value is None]
+        if missing:
+            raise ValueError("Missing state keys for {}: {}".format(self.name, ", ".join(missing)))
+
+        result = await asyncio.to_thread(self.tool, *args)
+
+        yield Event(
+            invocation_id = ctx.invocation_id,
+            author = self.name,
+            branch = ctx.branch,
+            content = types.Content(role = "model", parts = [types.Part(text = "" if result is None else str(result))]),
+            actions = EventActions(state_delta = {self.output_key: result})
+        )
@@ -0,0 +1,97 @@
+"""
+Nearest-neighbour backends for the template index, both over L2-normalized rows
+so that the inner product is the cosine similarity.
+
+`ExactVectorIndex` scans the whole matrix and suits the ~100 imgflip templates.
+`IVFVectorIndex` clusters the rows with spherical k-means and only scans the
+`n_probe` clusters closest to each query, for datasets of tens of thousands of
+templates.
+"""
+import math
+import os
+import numpy as np
+
+from config import load_config
+
+load_config()
+
+# "auto" picks IVF from TEMPLATE_IVF_MIN_SIZE templates on.
+TEMPLATE_INDEX_BACKEND = os.getenv("TEMPLATE_INDEX_BACKEND", "auto").lower()
+TEMPLATE_IVF_MIN_SIZE = int(os.getenv("TEMPLATE_IVF_MIN_SIZE", 20000))
+TEMPLATE_IVF_PROBES = int(os.getenv("TEMPLATE_IVF_PROBES", 16))
+
+def top_k(scores, k):
+    """Indices of the `k` largest scores of each row, best first."""
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        top = np.argpartition(-scores, k - 1, axis = 1)[:, :k]
+    else:
+        top = np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+    order = np.argsort(-np.take_along_axis(scores, top, axis = 1), axis = 1)
+    return np.take_along_axis(top, order, axis = 1)
+
+class ExactVectorIndex:
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def search_batch(self, queries, k):
+        """Returns `(index, score)` pairs of the `k` best rows for every normalized query."""
+        scores = queries @ self.embeddings.T
+        top = top_k(scores, k)
+        return [[(int(idx), float(row[idx])) for idx in candidates] for row, candidates in zip(scores, top)]
+
+class IVFVectorIndex:
+    def __init__(self, embeddings, n_lists = None, n_probe = TEMPLATE_IVF_PROBES, iterations = 10, sample_size = 50000, seed = 0):
+        self.embeddings = embeddings
+        self.n_lists = n_lists or max(1, int(math.sqrt(len(embeddings))))
+        self.n_probe = min(n_probe, self.n_lists)
+        self.centroids = self.train(iterations, sample_size, np.random.default_rng(seed))
+
+        assignments = self.assign(embeddings)
+        order = np.argsort(assignments, kind = "stable")
+        self.ids = order.astype(np.int64)
+        self.offsets = np.searchsorted(assignments[order], np.arange(self.n_lists + 1))
+
+    def train(self, iterations, sample_size, rng):
+        sample = self.embeddings
+        if len(sample) > sample_size:
+            sample = sample[np.sort(rng.choice(len(sample), sample_size, replace = False))]
+        sample = np.asarray(sample, dtype = np.float32)
+        centroids = sample[rng.choice(len(sample), self.n_lists, replace = False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis = 1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis = 1, keepdims = True)
+            # Empty clusters keep their previous centroid.
+            filled = norms[:, 0] > 0
+            centroids[filled] = sums[filled] / norms[filled]
+        return centroids
+
+    def assign(self, embeddings, chunk_size = 8192):
+        labels = np.empty(len(embeddings), dtype = np.int64)
+        for start in range(0, len(embeddings), chunk_size):
+            labels[start:start + chunk_size] = np.argmax(np.asarray(embeddings[start:start + chunk_size]) @ self.centroids.T, axis = 1)
+        return labels
+
+    def search_batch(self, queries, k):
+        probes = top_k(queries @ self.centroids.T, self.n_probe)
+        results = []
+        for query, lists in zip(queries, probes):
+            candidates = np.concatenate([self.ids[self.offsets[i]:self.offsets[i + 1]] for i in lists])
+            if len(candidates) == 0:
+                results.append([])
+                continue
+            scores = self.embeddings[candidates] @ query
+            top = top_k(scores[None, :], k)[0]
+            results.append([(int(candidates[idx]), float(scores[idx])) for idx in top])
+        return results
+
+def build_vector_index(embeddings, backend = TEMPLATE_INDEX_BACKEND):
+    if backend == "auto":
+        backend = "ivf" if len(embeddings) >= TEMPLATE_IVF_MIN_SIZE else "exact"
+    if backend == "exact":
+        return ExactVectorIndex(embeddings)
+    if backend == "ivf":
+        return IVFVectorIndex(embeddings)
+    raise ValueError("Unknown template index backend: {}".format(backend))
@@ -1,23 +1,46 @@
-from fastapi import FastAPI, BackgroundTasks
+import time
+
+# Measured from here, the first line, to report how long importing the service takes.
+IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from google.adk.agents import ParallelAgent, SequentialAgent
-from google.adk.sessions import InMemorySessionService
-from google.adk.events import Event, EventActions
-from google.adk.runners import Runner
-from google.genai import types
+from typing import Optional
+from google.adk.agents import SequentialAgent
 import uvicorn
-import time
+import asyncio
+import logging
 import os
+import json
 import base64
-from pathlib import Path
+import re
 
-from agents.template_scout import TemplateScoutAgent
+from agents.template_scout import TemplateScoutAgent, TemplateScoutToolAgent
 from agents.caption_generator import CaptionGenerationAgent
-from agents.prompt_moderator import PromptModerationAgent
-from agents.meme_composer import MemeComposerAgent
-from agents.meme_publisher import MemePublisherAgent
+from agents.prompt_moderator import BatchPromptModerationAgent, PromptModerationAgent, build_tiered_moderation_agent
+from agents.meme_composer import MemeComposerAgent, MemeComposerToolAgent
+from agents.compose_pool import ComposePoolBusyError, close_compose_pool
+from agents.meme_publisher import MemePublisherAgent, MemePublisherToolAgent, get_publish_queue
+from agents.template_retrieval import retrieve_templates
+from agents.stage_limits import limit_stage
+from agents.cancellable_parallel import CancellableParallelAgent
+from pipeline import MemePipeline, PromptRejectedError, take_meme_image
+from batch import BATCH_DIR, BATCH_PUBLISH_MODES, BatchCheckpoint, BatchRunner, parse_batch_items
+from jobs import JobManager, JobQueueFullError
+from result_cache import build_result_cache
+from session_store import build_session_service
+from metrics import JOB_QUEUE_DEPTH, REQUEST_DURATION, STARTUP_SECONDS, registry
+from observability import REQUEST_ID_HEADER, configure_logging, configure_tracing, instrument_agents, new_request_id, request_id_var
+from warmup import Warmup
+from config import load_config
+
+load_config()
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 app.add_middleware(
@@ -28,32 +51,149 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    """Tags the request with an id for logs and spans and records its latency."""
+    request_id = request.headers.get(REQUEST_ID_HEADER) or new_request_id()
+    token = request_id_var.set(request_id)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        route = request.scope.get("route")
+        REQUEST_DURATION.observe(
+            time.perf_counter() - started,
+            route = route.path if route is not None else "unmatched",
+            method = request.method,
+            status = status
+        )
+        request_id_var.reset(token)
+    response.headers[REQUEST_ID_HEADER] = request_id
+    return response
+
 class MemeRequest(BaseModel):
     user_id: str
     prompt: str
+    # Reuse the cached moderation verdict and template but write a new caption.
+    fresh_caption: bool = False
+    # Respond once the meme is composed and queued; poll /publications/{id} for the post.
+    publish_async: bool = False
+
+class MemeJobRequest(MemeRequest):
+    idempotency_key: Optional[str] = None
 
-session_service = InMemorySessionService()
+session_service = build_session_service()
+
+warmup = Warmup()
+warmup_task = None
+
+# Tool-only stages call their tool directly instead of going through an LLM.
+FAST_TOOL_AGENTS = os.getenv("FAST_TOOL_AGENTS", "true").lower() != "false"
+# Blocklist and embedding classifier decide obvious prompts before the LLM moderator.
+MODERATION_LOCAL_TIER = os.getenv("MODERATION_LOCAL_TIER", "true").lower() != "false"
+# Start template scouting and captioning while moderation is still running.
+SPECULATIVE_MODERATION = os.getenv("SPECULATIVE_MODERATION", "false").lower() == "true"
 
 @app.on_event("startup")
 def build_agents():
-    global ParallelMemeAgent, SequentialMemeAgent
+    global ParallelMemeAgent, SequentialMemeAgent, meme_pipeline, job_manager, batch_runner
+
+    configure_logging()
+    configure_tracing()
+    started = time.perf_counter()
 
-    ParallelMemeAgent = ParallelAgent(
+    if FAST_TOOL_AGENTS:
+        scout_agent, composer_agent, publisher_agent = TemplateScoutToolAgent, MemeComposerToolAgent, MemePublisherToolAgent
+    else:
+        scout_agent, composer_agent, publisher_agent = TemplateScoutAgent, MemeComposerAgent, MemePublisherAgent
+
+    moderation_agent = build_tiered_moderation_agent() if MODERATION_LOCAL_TIER else PromptModerationAgent
+    caption_stage = limit_stage("caption", CaptionGenerationAgent, output_key="caption")
+    ParallelMemeAgent = CancellableParallelAgent(
         name="parallel_meme_agent",
-        sub_agents=[TemplateScoutAgent, CaptionGenerationAgent],
+        sub_agents=[
+            limit_stage("scout", scout_agent, output_key="image_url"),
+            caption_stage
+        ],
         description="Parallel agent to scout meme templates and generate caption."
     )
 
     SequentialMemeAgent = SequentialAgent(
         name="sequential_meme_agent",
         sub_agents=[
-            ParallelMemeAgent,
-            MemeComposerAgent,
-            MemePublisherAgent
+            limit_stage("compose", composer_agent, output_key="meme_image_id"),
+            limit_stage("publish", publisher_agent, output_key="meme_url")
         ],
         description="Sequential agent to compose and publish the meme."
     )
 
+    meme_pipeline = MemePipeline(
+        session_service = session_service,
+        moderation_agent = limit_stage("moderation", moderation_agent),
+        prepare_agent = ParallelMemeAgent,
+        finish_agent = SequentialMemeAgent,
+        speculative = SPECULATIVE_MODERATION,
+        result_cache = build_result_cache()
+    )
+    job_manager = JobManager(meme_pipeline)
+    JOB_QUEUE_DEPTH.set_function(job_manager.queue.qsize)
+    batch_runner = BatchRunner(
+        meme_pipeline,
+        moderation_agent = limit_stage("moderation", BatchPromptModerationAgent),
+        caption_agent = caption_stage,
+        local_moderator = moderation_agent.local_moderator if MODERATION_LOCAL_TIER else None
+    )
+    instrument_agents(meme_pipeline.moderation_runner.agent, ParallelMemeAgent, SequentialMemeAgent, batch_runner.moderation_runner.agent)
+
+    STARTUP_SECONDS.set(IMPORT_SECONDS, phase = "import")
+    STARTUP_SECONDS.set(time.perf_counter() - started, phase = "build_agents")
+    logger.info("Imported in %.2fs, built agents in %.2fs", IMPORT_SECONDS, time.perf_counter() - started)
+
+@app.on_event("startup")
+async def start_job_workers():
+    global warmup_task
+    job_manager.start()
+    get_publish_queue().start()
+    # Warm up in the background so the server answers liveness probes right away.
+    warmup_task = asyncio.create_task(warmup.run())
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    if warmup_task is not None:
+        warmup_task.cancel()
+    await job_manager.stop()
+    await asyncio.to_thread(get_publish_queue().stop)
+    await asyncio.to_thread(close_compose_pool)
+
+@app.get("/healthz")
+async def healthz():
+    return {
+        "status": "ok",
+        "uptime_seconds": time.perf_counter() - IMPORT_STARTED
+    }
+
+@app.get("/readyz")
+async def readyz():
+    if not warmup.ready:
+        return JSONResponse(
+            status_code = 503,
+            content = {
+                "status": "warming_up" if not warmup.done else "failed",
+                **warmup.to_dict()
+            }
+        )
+    return {
+        "status": "ready",
+        "import_seconds": IMPORT_SECONDS,
+        **warmup.to_dict()
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content = registry.render(), media_type = "text/plain; version=0.0.4")
+
 @app.get("/")
 async def root():
     return JSONResponse(
@@ -63,15 +203,8 @@ async def root():
         }
     )
 
-def delete_meme_image(meme_image_path: str):
-    try:
-        os.remove(meme_image_path)
-        print("Meme Image has been deleted successfully.")
-    except Exception as e:
-        print("An error occurred: {}".format(e))
-
 @app.post("/generate_meme")
-async def generate_meme(request: MemeRequest, background_tasks: BackgroundTasks):
+async def generate_meme(request: MemeRequest):
     user_id = request.user_id
     text_prompt = request.prompt
     if not text_prompt:
@@ -82,105 +215,196 @@ async def generate_meme(request: MemeRequest, background_tasks: BackgroundTasks)
             }
         )
     
-    session = await session_service.create_session(
-        app_name = "meme_machine",
-        user_id = user_id
-    )
-    # print(f"Initial state: {session.state}")
-    
     try:
-        current_time = time.time()
-        state_change = {
-            "prompt": text_prompt
+        state = await meme_pipeline.run(user_id, text_prompt, fresh_caption = request.fresh_caption, publish_async = request.publish_async)
+
+        meme_image = take_meme_image(state)
+        if meme_image is None:
+            return JSONResponse(
+                status_code = 500,
+                content = {
+                    "error": "Internal Server Error: Please try again later."
+                }
+            )
+        
+        b64_str = base64.b64encode(meme_image.data).decode("ascii")
+        payload = {
+            "image": f"data:{meme_image.media_type};base64,{b64_str}",
+            "meme_url": (state.get("meme_url") or "").strip(),
+            "publish_results": state.get("publish_results") or {},
+            "publication_id": state.get("publication_id"),
+            "publication_status": state.get("publication_status")
         }
-        actions_with_update = EventActions(state_delta = state_change)
-        system_event = Event(
-            invocation_id = "inv_prompt_update",
-            author = "system",
-            actions = actions_with_update,
-            timestamp = current_time
+        return payload
+
+    except PromptRejectedError:
+        return JSONResponse(
+            status_code = 400,
+            content = {
+                "error": "Prompt is not suitable for meme generation."
+            }
         )
-        await session_service.append_event(
-            session,
-            system_event
+    except ComposePoolBusyError:
+        return JSONResponse(
+            status_code = 503,
+            content = {
+                "error": "Too many memes being composed. Please try again later."
+            }
+        )
+    except Exception as e:
+        logger.exception("Meme generation failed")
+        return JSONResponse(
+            status_code = 500,
+            content = {
+                "error": f"An error occurred: {str(e)}"
+            }
         )
 
-        ### PROMPT MODERATOR AGENT ###
-        runner_prompt_moderator = Runner(
-            agent = PromptModerationAgent, 
-            app_name = "meme_machine", 
-            session_service = session_service
+@app.get("/templates")
+async def search_templates(prompt: str, k: int = 5, user_id: Optional[str] = None):
+    if not prompt:
+        return JSONResponse(
+            status_code = 400,
+            content = {
+                "error": "Prompt cannot be empty."
+            }
         )
 
-        content_prompt_moderator = types.Content(role = "user", parts = [types.Part(text = session.state["prompt"])])
-        events_prompt_moderator = runner_prompt_moderator.run(user_id = user_id, session_id = session.id, new_message = content_prompt_moderator)
+    templates = await asyncio.to_thread(retrieve_templates, prompt, k, user_id)
+    return {
+        "templates": [template._asdict() for template in templates]
+    }
 
-        moderator_response = ""
-        for event in events_prompt_moderator:
-            if event.is_final_response() and event.content and event.content.parts:
-                # print(f"Potential final response from [{event.author}]: {event.content.parts[0].text}")
-                moderator_response = event.content.parts[0].text
+@app.get("/publications/{publication_id}")
+async def get_publication(publication_id: str):
+    publication = await asyncio.to_thread(get_publish_queue().get, publication_id)
+    if publication is None:
+        return JSONResponse(
+            status_code = 404,
+            content = {
+                "error": "Publication {} not found.".format(publication_id)
+            }
+        )
+    return publication
 
-        print("Moderator Final Response: ", moderator_response)
+def job_not_found(job_id: str):
+    return JSONResponse(
+        status_code = 404,
+        content = {
+            "error": "Job {} not found.".format(job_id)
+        }
+    )
 
-        new_session = await session_service.get_session(
-            app_name = "meme_machine",
-            user_id = user_id,
-            session_id = session.id
+@app.post("/jobs", status_code = 202)
+async def submit_meme_job(request: MemeJobRequest):
+    if not request.prompt:
+        return JSONResponse(
+            status_code = 400,
+            content = {
+                "error": "Prompt cannot be empty."
+            }
         )
 
-        if new_session.state["moderator_response"].lower() == "yes":
-            return JSONResponse(
-                status_code = 400,
-                content = {
-                    "error": "Prompt is not suitable for meme generation."
-                }
-            )
-
-        runner = Runner(
-            agent = SequentialMemeAgent, 
-            app_name = "meme_machine", 
-            session_service = session_service
+    try:
+        job = job_manager.submit(request.user_id, request.prompt, request.idempotency_key, request.fresh_caption, request.publish_async)
+    except JobQueueFullError:
+        return JSONResponse(
+            status_code = 503,
+            content = {
+                "error": "Too many pending memes. Please try again later."
+            }
         )
+    return job.to_dict()
 
-        content = types.Content(role = "user", parts = [types.Part(text = session.state["prompt"])])
-        events = runner.run(user_id = user_id, session_id = session.id, new_message = content)
+@app.get("/jobs/{job_id}")
+async def get_meme_job(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        return job_not_found(job_id)
+    return job.to_dict()
 
-        for event in events:
-            if event.is_final_response() and event.content and event.content.parts:
-                print(event.content.parts)
+@app.get("/jobs/{job_id}/events")
+async def stream_meme_job_events(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        return job_not_found(job_id)
 
-        updated_session = await session_service.get_session(
-            app_name = "meme_machine",
-            user_id = user_id,
-            session_id = session.id
-        )
+    async def event_stream():
+        async for event in job_manager.stream(job):
+            yield "data: {}\n\n".format(json.dumps(event))
 
-        meme_file_path = Path(updated_session.state["meme_file_path"].strip())
-        if not meme_file_path.is_file():
-            return JSONResponse(
-                status_code = 500,
-                content = {
-                    "error": "Internal Server Error: Please try again later."
-                }
-            )
-        
-        img_bytes = meme_file_path.read_bytes()
-        b64_str = base64.b64encode(img_bytes).decode("ascii")
-        payload = {
-            "image": f"data:image/png;base64,{b64_str}",
-            "meme_url": updated_session.state["meme_url"].strip()
-        }
-        background_tasks.add_task(delete_meme_image, updated_session.state["meme_file_path"].strip())
-        return payload
-    
-    except Exception as e:
+    return StreamingResponse(event_stream(), media_type = "text/event-stream")
+
+@app.get("/jobs/{job_id}/image")
+async def get_meme_job_image(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        return job_not_found(job_id)
+    if job.image is None:
         return JSONResponse(
-            status_code = 500,
+            status_code = 409,
             content = {
-                "error": f"An error occurred: {str(e)}"
+                "error": "Meme is not ready, job status is '{}'.".format(job.status)
             }
         )
-    
+    return Response(content = job.image, media_type = job.media_type)
+
+# Batches currently streaming, so the same checkpoint is never written twice at once.
+running_batches = set()
+BATCH_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+@app.post("/batches")
+async def run_meme_batch(request: Request, batch_id: Optional[str] = None, publish: str = "skip", publish_interval: float = 3600.0):
+    """
+    Takes a JSONL body of prompts and streams a JSONL result per prompt as memes
+    finish. Posting the same `batch_id` again resumes the batch: items that
+    succeeded or were rejected are streamed from its checkpoint and the rest,
+    including failed ones, are run.
+    """
+    batch_id = batch_id or new_request_id()
+    if not BATCH_ID_PATTERN.match(batch_id):
+        return JSONResponse(status_code = 400, content = {"error": "Invalid batch id."})
+    if publish not in BATCH_PUBLISH_MODES:
+        return JSONResponse(status_code = 400, content = {"error": "publish must be one of {}.".format(", ".join(BATCH_PUBLISH_MODES))})
+    try:
+        items = parse_batch_items((await request.body()).decode("utf-8").splitlines())
+    except (UnicodeDecodeError, ValueError) as e:
+        return JSONResponse(status_code = 400, content = {"error": str(e)})
+    if batch_id in running_batches:
+        return JSONResponse(status_code = 409, content = {"error": "Batch {} is already running.".format(batch_id)})
+
+    running_batches.add(batch_id)
+    try:
+        checkpoint = await asyncio.to_thread(BatchCheckpoint, BATCH_DIR / "{}.jsonl".format(batch_id))
+    except Exception:
+        # The stream below never starts, so its `finally` cannot release the id.
+        running_batches.discard(batch_id)
+        logger.exception("Failed to open batch checkpoint", extra = {"batch_id": batch_id})
+        return JSONResponse(status_code = 500, content = {"error": "The checkpoint of batch {} could not be read.".format(batch_id)})
+
+    async def result_stream():
+        try:
+            for item in items:
+                if checkpoint.done(item.id):
+                    yield json.dumps({**checkpoint.records[item.id], "resumed": True}) + "\n"
+            async for record in batch_runner.run(items, checkpoint, publish, publish_interval):
+                yield json.dumps(record) + "\n"
+        finally:
+            checkpoint.close()
+            running_batches.discard(batch_id)
+
+    return StreamingResponse(result_stream(), media_type = "application/x-ndjson", headers = {"X-Batch-ID": batch_id})
+
+@app.get("/batches/{batch_id}/items/{item_id}/image")
+async def get_meme_batch_image(batch_id: str, item_id: str):
+    path = BATCH_DIR / "{}.jsonl".format(batch_id)
+    if not BATCH_ID_PATTERN.match(batch_id) or not path.is_file():
+        return JSONResponse(status_code = 404, content = {"error": "Batch {} not found.".format(batch_id)})
+    checkpoint = await asyncio.to_thread(BatchCheckpoint, path)
+    record = checkpoint.records.get(item_id)
+    if record is None or not record.get("image_path"):
+        return JSONResponse(status_code = 404, content = {"error": "No meme for item {} of batch {}.".format(item_id, batch_id)})
+    return FileResponse(record["image_path"], media_type = record.get("media_type"))
+
 if __name__ == "__main__":
-    uvicorn.run("app:app", port = 8080, reload = True)
\ No newline at end of file
+    uvicorn.run("app:app", port = 8080, reload = True)
@@ -0,0 +1,352 @@
+"""
+Batch meme generation from a JSONL file of prompts.
+
+Every line is a JSON object with a `prompt` and optionally an `id` and a
+`user_id` (or just a JSON string, the prompt). Prompts are handled in chunks of
+BATCH_CHUNK_SIZE: each chunk is embedded in one `encode` call, decided by the
+local moderation tier where possible and by one batch LLM moderation call for
+the rest. Captions are then generated with at most BATCH_CAPTION_CONCURRENCY in
+flight and memes composed in compose worker processes, one per core unless
+COMPOSE_WORKERS is set (0 composes in threads instead).
+
+Results are appended to a JSONL checkpoint as items finish, so rerunning the
+same batch skips every item that succeeded or was rejected and runs the failed
+ones again:
+
+    python -m batch prompts.jsonl --output results.jsonl
+    python -m batch prompts.jsonl --output results.jsonl --publish schedule --publish-interval 900
+
+The service runs batches with `POST /batches` and streams the results back.
+"""
+from pathlib import Path
+from typing import NamedTuple, Optional
+import argparse
+import asyncio
+import logging
+import json
+import time
+import re
+import os
+
+from agents import compose_pool
+from agents.compose_pool import close_compose_pool
+from agents.meme_composer import compose_meme_image
+from agents.meme_publisher import get_publish_queue
+from agents.moderation_tiers import LocalModerator, ModerationDecision
+from agents.prompt_moderator import parse_batch_verdicts
+from agents.template_index import DATA_DIR, match_prompts
+from agents.template_retrieval import recent_templates, retrieve_templates
+from metrics import BATCH_ITEMS
+from pipeline import MemePipeline, PromptRejectedError
+from config import load_config
+
+load_config()
+
+logger = logging.getLogger(__name__)
+
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", 32))
+BATCH_CAPTION_CONCURRENCY = int(os.getenv("BATCH_CAPTION_CONCURRENCY", 8))
+# A batch spends most of its time composing, so the CLI uses a compose worker per
+# core; the service keeps COMPOSE_WORKERS, which is off by default.
+BATCH_COMPOSE_WORKERS = int(os.getenv("COMPOSE_WORKERS", os.cpu_count() or 1))
+# Checkpoints and images of batches run through the API.
+BATCH_DIR = Path(os.getenv("BATCH_DIR", DATA_DIR / "batches"))
+
+# skip: compose only; queue: publish right away; schedule: one publication every `publish_interval` seconds.
+BATCH_PUBLISH_MODES = ("skip", "queue", "schedule")
+
+BATCH_USER_ID = "batch"
+
+UNSAFE_FILENAME_CHARACTERS = re.compile(r"[^A-Za-z0-9_.-]")
+
+class BatchItem(NamedTuple):
+    id: str
+    prompt: str
+    user_id: str = BATCH_USER_ID
+
+def parse_batch_items(lines, user_id: str = BATCH_USER_ID):
+    """Reads `BatchItem`s from JSONL lines. Items without an `id` are numbered by line."""
+    items = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError("Line {} is not valid JSON: {}".format(number, e))
+        if isinstance(record, str):
+            record = {"prompt": record}
+        if not isinstance(record, dict):
+            raise ValueError("Line {} is neither an object nor a string".format(number))
+        items.append(BatchItem(str(record.get("id", number)), str(record.get("prompt") or "").strip(), str(record.get("user_id") or user_id)))
+    ids = [item.id for item in items]
+    if len(set(ids)) != len(ids):
+        raise ValueError("Batch item ids must be unique")
+    return items
+
+class BatchCheckpoint:
+    """
+    The records of finished items, appended to a JSONL file (and flushed to disk)
+    as each item finishes. Images are written next to it, in a directory named
+    after the file unless `images_dir` is given.
+    """
+
+    def __init__(self, path, images_dir = None):
+        self.path = Path(path)
+        self.images_dir = Path(images_dir) if images_dir else self.path.with_suffix("")
+        self.records = {}
+        self.file = None
+        # Length of the complete records, when a crash left a partial one after them.
+        self.valid_size = None
+        if self.path.is_file():
+            self.load()
+
+    def load(self):
+        data = self.path.read_bytes()
+        if data and not data.endswith(b"\n"):
+            # The last record was cut short by a crash; it is cut off before the
+            # next write, so the item runs again.
+            data = data[:data.rfind(b"\n") + 1]
+            self.valid_size = len(data)
+        for line in data.decode("utf-8").splitlines():
+            if line.strip():
+                record = json.loads(line)
+                self.records[record["id"]] = record
+
+    def done(self, item_id: str):
+        """Whether the item needs no further run: it succeeded or its prompt was rejected. Failed items run again."""
+        return self.records.get(item_id, {}).get("status") in ("succeeded", "rejected")
+
+    def save_image(self, item_id: str, image):
+        self.images_dir.mkdir(parents = True, exist_ok = True)
+        path = self.images_dir / (UNSAFE_FILENAME_CHARACTERS.sub("_", item_id) + image.extension)
+        temp_path = path.with_name(path.name + ".tmp")
+        temp_path.write_bytes(image.data)
+        os.replace(temp_path, path)
+        return str(path)
+
+    def write(self, record: dict):
+        if self.file is None:
+            self.path.parent.mkdir(parents = True, exist_ok = True)
+            self.file = open(self.path, "a")
+            if self.valid_size is not None:
+                self.file.truncate(self.valid_size)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records[record["id"]] = record
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class BatchRunner:
+    """
+    Runs batches of prompts through the pipeline's stages. Sessions, runners and
+    moderation go through `pipeline`; `moderation_agent` must answer a JSON array
+    of prompts with a JSON array of verdicts and `caption_agent` writes 'caption'.
+    """
+
+    def __init__(self, pipeline: MemePipeline, moderation_agent, caption_agent, local_moderator: Optional[LocalModerator] = None, chunk_size: int = BATCH_CHUNK_SIZE, caption_concurrency: int = BATCH_CAPTION_CONCURRENCY):
+        self.pipeline = pipeline
+        self.moderation_runner = pipeline.build_runner(moderation_agent)
+        self.caption_runner = pipeline.build_runner(caption_agent)
+        self.local_moderator = local_moderator
+        self.chunk_size = max(1, chunk_size)
+        self.caption_semaphore = asyncio.Semaphore(max(1, caption_concurrency))
+
+    async def run_in_session(self, runner, user_id: str, message: str, state: dict):
+        """Runs an agent in a session of its own and returns the final state."""
+        session = await self.pipeline.session_service.create_session(app_name = self.pipeline.app_name, user_id = user_id, state = state)
+        try:
+            await self.pipeline.run_agent(runner, user_id, session.id, message)
+            return dict(await self.pipeline.get_state(user_id, session.id))
+        finally:
+            await self.pipeline.release_session(user_id, session.id)
+
+    async def moderate_one(self, item: BatchItem):
+        session = await self.pipeline.session_service.create_session(app_name = self.pipeline.app_name, user_id = item.user_id, state = {"prompt": item.prompt})
+        try:
+            await self.pipeline.moderate(item.user_id, session.id, item.prompt)
+            return "no"
+        except PromptRejectedError:
+            return "yes"
+        finally:
+            await self.pipeline.release_session(item.user_id, session.id)
+
+    async def moderate(self, items, matches):
+        """Moderation decisions for a chunk: local tier first, then one LLM call for the undecided prompts."""
+        if self.local_moderator is not None:
+            decisions = await asyncio.to_thread(lambda: [self.local_moderator.classify(item.prompt, match.embedding) for item, match in zip(items, matches)])
+        else:
+            decisions = [ModerationDecision(None, "llm") for _ in items]
+
+        undecided = [i for i, decision in enumerate(decisions) if decision.verdict is None]
+        if not undecided:
+            return decisions
+        prompts = [items[i].prompt for i in undecided]
+        state = await self.run_in_session(self.moderation_runner, BATCH_USER_ID, json.dumps(prompts), {"prompts": prompts})
+        verdicts = parse_batch_verdicts(state.get("moderator_responses") or "", len(prompts))
+        tier = "llm_batch"
+        if verdicts is None:
+            logger.warning("Unusable batch moderation response, moderating %d prompts one by one", len(prompts))
+            verdicts = await asyncio.gather(*(self.moderate_one(items[i]) for i in undecided))
+            tier = "llm"
+        for i, verdict in zip(undecided, verdicts):
+            decisions[i] = ModerationDecision(verdict, tier, decisions[i].score)
+        return decisions
+
+    def pick_template(self, item: BatchItem, match):
+        [template] = retrieve_templates(item.prompt, k = 1, user_id = item.user_id, match = match)
+        recent_templates.add(item.user_id, template.index)
+        return template
+
+    async def make_meme(self, item: BatchItem, record: dict, checkpoint: BatchCheckpoint, publish_at: Optional[float]):
+        async with self.caption_semaphore:
+            state = await self.run_in_session(self.caption_runner, item.user_id, item.prompt, {"prompt": item.prompt, "user_id": item.user_id})
+        caption = (state.get("caption") or "").strip()
+        if not caption:
+            raise ValueError("No caption was generated")
+        record["caption"] = caption
+
+        image = await asyncio.to_thread(compose_meme_image, record["image_url"], caption)
+        if image is None:
+            raise ValueError("The caption does not fit on the template")
+        record["image_path"] = await asyncio.to_thread(checkpoint.save_image, item.id, image)
+        record["media_type"] = image.media_type
+
+        if publish_at is not None:
+            record["publication_id"] = await asyncio.to_thread(get_publish_queue().enqueue, image, caption, publish_at)
+            record["publish_at"] = publish_at
+
+    async def process(self, item: BatchItem, record: dict, checkpoint: BatchCheckpoint, publish_at: Optional[float]):
+        try:
+            await self.make_meme(item, record, checkpoint, publish_at)
+            record["status"] = "succeeded"
+        except Exception as e:
+            logger.exception("Batch item %s failed", item.id)
+            record.update(status = "failed", error = str(e) or type(e).__name__)
+        return record
+
+    async def prepare(self, chunk, checkpoint: BatchCheckpoint, publish_times):
+        """Embeds, moderates and picks templates for a chunk; returns finished records and started tasks."""
+        records, tasks = [], []
+        valid = []
+        for item in chunk:
+            record = {"id": item.id, "prompt": item.prompt, "user_id": item.user_id}
+            if item.prompt:
+                valid.append((item, record))
+            else:
+                records.append({**record, "status": "failed", "error": "Prompt cannot be empty."})
+        if not valid:
+            return records, tasks
+
+        items = [item for item, _ in valid]
+        matches = await asyncio.to_thread(match_prompts, [item.prompt for item in items])
+        decisions = await self.moderate(items, matches)
+        for (item, record), match, decision in zip(valid, matches, decisions):
+            record["moderation_tier"] = decision.tier
+            if decision.verdict == "yes":
+                records.append({**record, "status": "rejected", "error": "Prompt is not suitable for meme generation."})
+                continue
+            try:
+                template = await asyncio.to_thread(self.pick_template, item, match)
+            except Exception as e:
+                records.append({**record, "status": "failed", "error": str(e) or type(e).__name__})
+                continue
+            record["image_url"] = template.url
+            tasks.append(asyncio.create_task(self.process(item, record, checkpoint, next(publish_times))))
+        return records, tasks
+
+    def finish(self, record: dict, checkpoint: BatchCheckpoint, started: float):
+        record["seconds"] = time.perf_counter() - started
+        checkpoint.write(record)
+        BATCH_ITEMS.inc(status = record["status"])
+        return record
+
+    async def run(self, items, checkpoint: BatchCheckpoint, publish: str = "skip", publish_interval: float = 0.0):
+        """
+        Yields a record per item not yet done in the checkpoint, in the order
+        items finish. Memes of a chunk are made while the next chunk is moderated.
+        """
+        if publish not in BATCH_PUBLISH_MODES:
+            raise ValueError("Unknown publish mode: {}".format(publish))
+        pending = [item for item in items if not checkpoint.done(item.id)]
+
+        def publish_times():
+            start = time.time()
+            position = 0
+            while True:
+                if publish == "skip":
+                    yield None
+                else:
+                    yield start + position * publish_interval if publish == "schedule" else start
+                    position += 1
+
+        times = publish_times()
+        # Tasks making memes -> when their chunk started.
+        in_flight = {}
+        try:
+            for offset in range(0, len(pending) + self.chunk_size, self.chunk_size):
+                chunk = pending[offset:offset + self.chunk_size]
+                if chunk:
+                    chunk_started = time.perf_counter()
+                    records, tasks = await self.prepare(chunk, checkpoint, times)
+                    for record in records:
+                        yield self.finish(record, checkpoint, chunk_started)
+                    in_flight.update((task, chunk_started) for task in tasks)
+                # Keep at most about two chunks of memes in the making; after the last chunk, wait for all of them.
+                while len(in_flight) > (self.chunk_size if chunk else 0):
+                    done, _ = await asyncio.wait(in_flight, return_when = asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield self.finish(task.result(), checkpoint, in_flight.pop(task))
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+async def run_file(args):
+    import app as meme_app
+
+    with open(args.input, "r") as file:
+        items = parse_batch_items(file, args.user_id)
+    output = Path(args.output or Path(args.input).with_suffix(".results.jsonl"))
+    if args.restart and output.exists():
+        output.unlink()
+    checkpoint = BatchCheckpoint(output, args.images_dir)
+    skipped = sum(checkpoint.done(item.id) for item in items)
+    if skipped:
+        print("Resuming {}: {} of {} items already done".format(output, skipped, len(items)))
+
+    compose_pool.COMPOSE_WORKERS = BATCH_COMPOSE_WORKERS
+    meme_app.build_agents()
+    if args.publish != "skip":
+        # Publications still queued when the batch ends are posted by the service's publish workers.
+        get_publish_queue().start()
+    runner = meme_app.batch_runner
+    counts = {}
+    try:
+        async for record in runner.run(items, checkpoint, args.publish, args.publish_interval):
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+            print("{id}: {status}".format(**record), record.get("image_path") or record.get("error") or "")
+    finally:
+        checkpoint.close()
+        close_compose_pool()
+        if args.publish != "skip":
+            await asyncio.to_thread(get_publish_queue().stop)
+    print("Wrote {} to {}".format(", ".join("{} {}".format(count, status) for status, count in sorted(counts.items())) or "nothing", output))
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help = "JSONL file of prompts.")
+    parser.add_argument("--output", help = "JSONL results and checkpoint (default: <input>.results.jsonl).")
+    parser.add_argument("--images-dir", help = "Directory for the composed memes (default: next to the output).")
+    parser.add_argument("--user-id", default = BATCH_USER_ID, help = "User id for items without one.")
+    parser.add_argument("--publish", choices = BATCH_PUBLISH_MODES, default = "skip")
+    parser.add_argument("--publish-interval", type = float, default = 3600.0, help = "Seconds between scheduled publications.")
+    parser.add_argument("--restart", action = "store_true", help = "Discard the results of a previous run.")
+    asyncio.run(run_file(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Throughput of generating memes for a file of prompts: one pipeline run per
+prompt, one after another like a script calling /generate_meme, versus the
+batch runner. LLMs are fixed-latency fakes; scouting and composing run for real
+on synthetic templates served locally.
+
+    python -m benchmarks.bench_batch --prompts 64 --llm-latency 0.2
+"""
+from benchmarks.stubs import FakeBatchModerationLlm, TemplateServer, use_offline_env
+
+use_offline_env()
+
+import argparse
+import asyncio
+import tempfile
+import json
+import time
+import os
+
+import app as meme_app
+from agents import compose_pool
+from agents.prompt_moderator import BatchPromptModerationAgent
+from batch import BatchCheckpoint, BatchRunner, parse_batch_items
+from benchmarks.bench_wrap_text import build_corpus
+from benchmarks.load_test import install_stubs
+from benchmarks.results import save_results
+from metrics import LLM_CALLS
+
+def llm_calls():
+    return int(sum(LLM_CALLS.values.values()))
+
+async def run_sequential(prompts):
+    calls = llm_calls()
+    started = time.perf_counter()
+    for i, prompt in enumerate(prompts):
+        await meme_app.meme_pipeline.run("bench-{}".format(i), prompt, publish_async = True)
+    return time.perf_counter() - started, llm_calls() - calls
+
+async def run_batch(runner, prompts, publish):
+    items = parse_batch_items(json.dumps(prompt) for prompt in prompts)
+    calls = llm_calls()
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint = BatchCheckpoint(os.path.join(directory, "results.jsonl"))
+        statuses = [record["status"] async for record in runner.run(items, checkpoint, publish)]
+        checkpoint.close()
+    failed = len(statuses) - statuses.count("succeeded")
+    return time.perf_counter() - started, llm_calls() - calls, failed
+
+async def main(args):
+    prompts = ["batch benchmark {} {}".format(i, caption) for i, caption in enumerate(build_corpus(args.prompts))]
+    results = []
+    with TemplateServer(args.templates) as server:
+        install_stubs(args.llm_latency, 0.0, template_server = server)
+        BatchPromptModerationAgent.model = FakeBatchModerationLlm(model = "gemini-2.0-flash-offline", latency = args.llm_latency)
+        # Scouting and layouts warm up the same way for both runs.
+        await run_sequential(prompts[:2])
+
+        seconds, calls = await run_sequential(prompts)
+        results.append({"mode": "sequential", "items": len(prompts), "seconds_s": seconds, "throughput_rps": len(prompts) / seconds, "llm_calls": calls})
+
+        runner = BatchRunner(
+            meme_app.meme_pipeline,
+            moderation_agent = meme_app.batch_runner.moderation_runner.agent,
+            caption_agent = meme_app.batch_runner.caption_runner.agent,
+            local_moderator = meme_app.batch_runner.local_moderator,
+            chunk_size = args.chunk_size,
+            caption_concurrency = args.caption_concurrency
+        )
+        for workers in args.compose_workers:
+            compose_pool.close_compose_pool()
+            compose_pool.COMPOSE_WORKERS = workers
+            if compose_pool.get_compose_pool() is not None:
+                # Started and filled by the warm-up in the service.
+                compose_pool.get_compose_pool().start()
+            try:
+                seconds, calls, failed = await run_batch(runner, prompts, "queue")
+            finally:
+                compose_pool.close_compose_pool()
+            results.append({"mode": "batch", "compose_workers": workers, "items": len(prompts), "failed": failed, "seconds_s": seconds, "throughput_rps": len(prompts) / seconds, "llm_calls": calls})
+
+    for row in results:
+        print("{:<10} workers={:<3} {:>4} items  {:7.2f}s  {:7.2f} memes/s  {:>4} LLM calls".format(row["mode"], row.get("compose_workers", "-"), row["items"], row["seconds_s"], row["throughput_rps"], row["llm_calls"]))
+    if args.output:
+        save_results(args.output, "batch", results, args)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prompts", type = int, default = 64)
+    parser.add_argument("--templates", type = int, default = 30)
+    parser.add_argument("--llm-latency", type = float, default = 0.2)
+    parser.add_argument("--chunk-size", type = int, default = 32)
+    parser.add_argument("--caption-concurrency", type = int, default = 8)
+    parser.add_argument("--compose-workers", type = int, nargs = "+", default = [0, 4])
+    parser.add_argument("--output", help = "Write the results as JSON to this file.")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,94 @@
+"""
+Throughput of composing memes with different numbers of compose worker
+processes, on synthetic templates served locally and cached on disk. Composes
+are submitted from twice as many threads as there are workers while an asyncio
+ticker measures how late the event loop of the calling process wakes up.
+
+    python -m benchmarks.bench_compose_pool --workers 0 1 2 4 --composes 400
+
+Workers 0 composes in the calling threads, as with COMPOSE_WORKERS=0. Scaling
+beyond that is bounded by the number of cores of the machine running it.
+"""
+from benchmarks.stubs import TemplateServer, install_offline_templates, use_offline_env
+
+use_offline_env()
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import os
+import time
+
+from agents import compose_pool
+from agents.compose_pool import ComposePool
+from agents.meme_composer import compose_meme_image
+from agents.template_cache import get_template_cache
+from benchmarks.bench_wrap_text import build_corpus
+from benchmarks.results import percentiles, save_results
+
+async def measure_lag(stop: asyncio.Event, interval: float = 0.005):
+    lags = []
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected))
+    return lags
+
+async def run(workers: int, jobs, args):
+    pool = ComposePool(workers, queue_size = 4 * workers, shared_bytes = args.shared_bytes) if workers > 0 else None
+    if pool is not None:
+        pool.start()
+        pool.preload(list(get_template_cache().index))
+    compose = (lambda job: pool.compose(*job)) if pool is not None else (lambda job: compose_meme_image(*job))
+
+    def timed(job):
+        started = time.perf_counter()
+        compose(job)
+        return time.perf_counter() - started
+
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(measure_lag(stop))
+    try:
+        with ThreadPoolExecutor(max_workers = 2 * max(workers, 1)) as executor:
+            started = time.perf_counter()
+            latencies = await asyncio.get_running_loop().run_in_executor(None, lambda: list(executor.map(timed, jobs)))
+            seconds = time.perf_counter() - started
+        stop.set()
+        lags = await ticker
+        shared = pool.templates.size if pool is not None else 0
+    finally:
+        if pool is not None:
+            pool.close()
+
+    row = {"name": "compose", "compose_workers": workers, "calls": len(jobs), "seconds_s": seconds, "ops_per_s": len(jobs) / seconds, "shared_bytes": shared}
+    row.update(percentiles(latencies, 1e3, "ms"))
+    row["loop_lag_p99_ms"] = percentiles(lags, 1e3, "ms")["p99_ms"] if lags else 0.0
+    return row
+
+async def main(args):
+    # Rows build their own pools; without one, `compose_meme_image` composes in the calling thread.
+    compose_pool.COMPOSE_WORKERS = 0
+    captions = build_corpus(args.composes)
+    results = []
+    with TemplateServer(args.templates) as server:
+        install_offline_templates(server)
+        get_template_cache().warm(server.urls)
+        jobs = [(server.url(i % args.templates), caption) for i, caption in enumerate(captions)]
+        for workers in args.workers:
+            results.append(await run(workers, jobs, args))
+
+    print("cores: {}".format(os.cpu_count()))
+    for row in results:
+        print("workers={compose_workers:<3} {calls:>6} composes  {ops_per_s:8.1f}/s  p50={p50_ms:7.1f}ms  p95={p95_ms:7.1f}ms  loop lag p99={loop_lag_p99_ms:6.1f}ms  shared={shared_bytes}B".format(**row))
+    if args.output:
+        save_results(args.output, "compose_pool", results, args)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type = int, nargs = "+", default = [0, 1, 2, 4])
+    parser.add_argument("--composes", type = int, default = 400)
+    parser.add_argument("--templates", type = int, default = 30)
+    parser.add_argument("--shared-bytes", type = int, default = 256 * 1024 * 1024)
+    parser.add_argument("--output", help = "Write the results as JSON to this file.")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,83 @@
+"""
+Benchmark of template scouting with and without the embedding micro-batcher.
+
+Each of `concurrency` threads scouts distinct prompts back to back, either
+encoding and matching every prompt on its own or through `EmbeddingBatcher`.
+Reports latency percentiles, throughput and CPU time per prompt.
+
+    python -m benchmarks.bench_embedding_batcher --requests 512 --concurrency 1 4 16 64
+
+Without sentence-transformers installed (or with --synthetic) the encoder is a
+stand-in that runs MiniLM-sized feed-forward matrix products, so the batching
+effect is measured on comparable CPU work.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import time
+
+from agents import template_index
+from agents.embedding_batcher import EMBEDDING_BATCH_SIZE, EMBEDDING_BATCH_WINDOW_MS, EmbeddingBatcher
+from benchmarks.stubs import SyntheticEncoder
+
+def run_level(scout, total, concurrency, offset):
+    latencies = [0.0] * total
+
+    def one(i):
+        started = time.perf_counter()
+        scout("benchmark prompt number {}".format(offset + i))
+        latencies[i] = time.perf_counter() - started
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        list(executor.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "throughput_rps": total / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "cpu_ms_per_prompt": cpu / total * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type = int, default = 512)
+    parser.add_argument("--concurrency", type = int, nargs = "+", default = [1, 4, 16, 64])
+    parser.add_argument("--window-ms", type = float, default = EMBEDDING_BATCH_WINDOW_MS)
+    parser.add_argument("--max-batch", type = int, default = EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--synthetic", action = "store_true", help = "Use the stand-in encoder even if sentence-transformers is installed.")
+    args = parser.parse_args()
+
+    try:
+        if args.synthetic:
+            raise ImportError
+        template_index.get_embedding_model()
+        print("encoder: {}".format(template_index.EMBEDDING_MODEL_NAME))
+    except ImportError:
+        template_index._embedding_model = SyntheticEncoder()
+        print("encoder: synthetic")
+    template_index.get_template_index()
+
+    batcher = EmbeddingBatcher(template_index.match_prompts, window_ms = args.window_ms, max_batch = args.max_batch)
+    modes = [
+        ("unbatched", lambda prompt: template_index.match_prompts([prompt])[0]),
+        ("batched", batcher),
+    ]
+
+    # Warm up BLAS threads and the batcher thread.
+    for _, scout in modes:
+        scout("warm up")
+
+    offset = 0
+    for concurrency in args.concurrency:
+        for mode, scout in modes:
+            result = run_level(scout, args.requests, concurrency, offset)
+            offset += args.requests
+            print("{mode:>9}  concurrency={concurrency:>4}  throughput={throughput_rps:8.1f}/s  p50={p50_ms:7.2f}ms  p99={p99_ms:7.2f}ms  cpu={cpu_ms_per_prompt:6.2f}ms/prompt".format(mode = mode, **result))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Time to publish one meme to several slow stand-in targets, posting to them one
+after another versus fanning out to all of them at once.
+
+    python -m benchmarks.bench_publish_fanout --targets 1 2 4 8 --latency 0.2
+"""
+from benchmarks.stubs import FakeTarget, use_offline_env
+
+use_offline_env()
+
+import argparse
+import time
+
+from agents.meme_store import MemeImage
+from agents.publish_targets import MultiTargetPublisher
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", type = int, nargs = "+", default = [1, 2, 4, 8])
+    parser.add_argument("--latency", type = float, default = 0.2, help = "Seconds each target takes per post.")
+    parser.add_argument("--rounds", type = int, default = 5)
+    args = parser.parse_args()
+
+    image = MemeImage(data = b"\xff\xd8" + bytes(200000) + b"\xff\xd9", media_type = "image/jpeg", extension = ".jpg")
+    for count in args.targets:
+        targets = [FakeTarget("target-{}".format(i), latency = args.latency) for i in range(count)]
+        publisher = MultiTargetPublisher(targets)
+
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            for target in targets:
+                publisher.publish(image, "Benchmark meme", [target.name])
+        sequential = (time.perf_counter() - started) / args.rounds
+
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            results = publisher.publish(image, "Benchmark meme")
+        fanout = (time.perf_counter() - started) / args.rounds
+
+        published = sum(result.status == "published" for result in results.values())
+        print("targets={:<3} sequential {:6.3f}s  fan-out {:6.3f}s  ({}/{} published)".format(count, sequential, fanout, published, count))
+
+if __name__ == "__main__":
+    main()
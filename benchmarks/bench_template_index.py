@@ -0,0 +1,58 @@
+"""
+Recall and latency of the approximate (IVF) template index against the exact
+scan, on synthetic clustered embeddings of growing size.
+
+    python -m benchmarks.bench_template_index --sizes 1000 10000 100000 --probes 4 8 16 32
+"""
+import argparse
+import time
+import numpy as np
+
+from agents.template_index import normalize_rows
+from agents.vector_index import ExactVectorIndex, IVFVectorIndex
+
+def synthetic_embeddings(size, dim, rng, topics = 200, spread = 0.12):
+    """Templates drawn around a few hundred topic directions, like families of meme formats."""
+    topics = normalize_rows(rng.standard_normal((topics, dim)))
+    rows = topics[rng.integers(len(topics), size = size)] + spread * rng.standard_normal((size, dim))
+    return normalize_rows(rows)
+
+def time_search(index, queries, k):
+    started = time.perf_counter()
+    results = [index.search_batch(query[None, :], k)[0] for query in queries]
+    return results, (time.perf_counter() - started) / len(queries) * 1000
+
+def recall(results, truth):
+    hits = sum(len({idx for idx, _ in found} & {idx for idx, _ in expected}) for found, expected in zip(results, truth))
+    return hits / sum(len(expected) for expected in truth)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [1000, 10000, 100000])
+    parser.add_argument("--probes", type = int, nargs = "+", default = [4, 8, 16, 32])
+    parser.add_argument("--queries", type = int, default = 200)
+    parser.add_argument("--dim", type = int, default = 384)
+    parser.add_argument("--k", type = int, default = 10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        embeddings = synthetic_embeddings(size, args.dim, rng)
+        queries = normalize_rows(embeddings[rng.integers(size, size = args.queries)] + 0.5 * rng.standard_normal((args.queries, args.dim)) / np.sqrt(args.dim))
+
+        exact = ExactVectorIndex(embeddings)
+        truth, exact_ms = time_search(exact, queries, args.k)
+        print("size={:>7}  exact        recall@{}=1.000  {:7.3f} ms/query".format(size, args.k, exact_ms))
+
+        started = time.perf_counter()
+        ivf = IVFVectorIndex(embeddings)
+        build_s = time.perf_counter() - started
+        for n_probe in args.probes:
+            ivf.n_probe = min(n_probe, ivf.n_lists)
+            results, ivf_ms = time_search(ivf, queries, args.k)
+            print("size={:>7}  ivf probe={:<3} recall@{}={:.3f}  {:7.3f} ms/query  ({} lists, built in {:.2f}s)".format(
+                size, n_probe, args.k, recall(results, truth), ivf_ms, ivf.n_lists, build_s
+            ))
+
+if __name__ == "__main__":
+    main()
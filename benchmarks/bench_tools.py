@@ -0,0 +1,88 @@
+"""
+Micro-benchmarks of the pipeline's tools, fully offline: `get_template_url` over
+a synthetic template index, `wrap_text` and `fit_text` on random captions, and
+`generate_meme_image` on synthetic templates served by a local HTTP server.
+
+    python -m benchmarks.bench_tools --iterations 200 --output tools.json
+
+Cold rows start from empty caches (prompt embeddings, template images, caption
+layouts); warm rows repeat the same work once everything is cached.
+"""
+from benchmarks.stubs import TemplateServer, install_offline_templates, use_offline_env
+
+use_offline_env()
+
+import argparse
+import random
+import time
+import cv2
+
+from agents import text_layout
+from agents.compose_pool import close_compose_pool
+from agents.meme_composer import generate_meme_image
+from agents.meme_store import meme_store
+from agents.template_scout import get_template_url
+from benchmarks.bench_wrap_text import build_corpus
+from benchmarks.results import percentiles, save_results
+
+def measure(name, function, inputs):
+    latencies = []
+    started = time.perf_counter()
+    for item in inputs:
+        call_started = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    return {"name": name, "calls": len(inputs), "ops_per_s": len(inputs) / elapsed, **percentiles(latencies, 1e6, "us")}
+
+def compose(args):
+    meme_image_id = generate_meme_image(*args)
+    if meme_image_id is not None:
+        meme_store.pop(meme_image_id)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type = int, default = 200)
+    parser.add_argument("--templates", type = int, default = 30)
+    parser.add_argument("--output", help = "Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    captions = build_corpus(args.iterations)
+    prompts = ["benchmark prompt {} {}".format(i, caption) for i, caption in enumerate(captions)]
+
+    with TemplateServer(args.templates) as server:
+        install_offline_templates(server)
+        get_template_url("warm up the encoder")
+
+        results = [
+            measure("get_template_url cold", get_template_url, prompts),
+            measure("get_template_url warm", get_template_url, prompts),
+        ]
+
+        text_layout.word_width.cache_clear()
+        text_layout.font_metrics.cache_clear()
+        widths = [rng.choice([280, 480, 780, 1180]) for _ in captions]
+        wrap = lambda item: text_layout.wrap_text(item[0], cv2.FONT_HERSHEY_SIMPLEX, 1.0, 2, item[1])
+        fit = lambda item: text_layout.fit_text(item[0], item[1], item[1] // 3)
+        results += [
+            measure("wrap_text cold", wrap, list(zip(captions, widths))),
+            measure("wrap_text warm", wrap, list(zip(captions, widths))),
+            measure("fit_text", fit, list(zip(captions, widths))),
+        ]
+
+        jobs = [(server.url(i % args.templates), caption) for i, caption in enumerate(captions)]
+        results += [
+            measure("generate_meme_image cold", compose, jobs[:args.templates]),
+            measure("generate_meme_image warm", compose, jobs),
+        ]
+        close_compose_pool()
+        print("template server requests: {}".format(server.requests))
+
+    for row in results:
+        print("{name:<26} {calls:>6} calls  {ops_per_s:10.1f}/s  p50={p50_us:9.1f}us  p95={p95_us:9.1f}us  p99={p99_us:9.1f}us".format(**row))
+    if args.output:
+        save_results(args.output, "tools", results, args)
+
+if __name__ == "__main__":
+    main()
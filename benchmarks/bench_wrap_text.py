@@ -0,0 +1,83 @@
+"""
+Benchmark of caption wrapping: the original per-word `cv2.getTextSize` on the
+growing line against the cached-width layout engine in `agents.text_layout`.
+
+    python -m benchmarks.bench_wrap_text
+"""
+import argparse
+import random
+import time
+import cv2
+
+from agents import text_layout
+
+VOCABULARY = (
+    "when you finally fix the bug at 3am and realize it was a typo the whole time "
+    "me explaining to my manager why the deadline moved again nobody absolutely "
+    "everyone monday coffee meeting could have been an email production friday deploy"
+).split()
+
+TEMPLATE_WIDTHS = [300, 500, 800, 1200]
+
+def legacy_wrap_text(text, font, font_scale, thickness, max_width):
+    words = text.split()
+    if not words:
+        return []
+
+    lines = []
+    current_line = words[0]
+    for word in words[1:]:
+        test_line = "{} {}".format(current_line, word)
+        (w, _), _ = cv2.getTextSize(test_line, font, font_scale, thickness)
+        if w <= max_width:
+            current_line = test_line
+        else:
+            lines.append(current_line)
+            current_line = word
+    lines.append(current_line)
+    return lines
+
+def build_corpus(size, seed = 0):
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(3, 60))) for _ in range(size)]
+
+def time_wrap(wrap, corpus):
+    started = time.perf_counter()
+    for caption in corpus:
+        for width in TEMPLATE_WIDTHS:
+            wrap(caption, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 2, width - 20)
+    return time.perf_counter() - started
+
+def time_fit(corpus):
+    started = time.perf_counter()
+    for caption in corpus:
+        for width in TEMPLATE_WIDTHS:
+            text_layout.fit_text(caption, width - 20, width // 3)
+    return time.perf_counter() - started
+
+def main(args):
+    corpus = build_corpus(args.captions)
+    calls = len(corpus) * len(TEMPLATE_WIDTHS)
+
+    mismatches = sum(
+        legacy_wrap_text(caption, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 2, width - 20) != text_layout.wrap_text(caption, cv2.FONT_HERSHEY_SIMPLEX, 1.0, 2, width - 20)
+        for caption in corpus for width in TEMPLATE_WIDTHS
+    )
+
+    legacy = time_wrap(legacy_wrap_text, corpus)
+    text_layout.word_width.cache_clear()
+    text_layout.font_metrics.cache_clear()
+    cold = time_wrap(text_layout.wrap_text, corpus)
+    warm = time_wrap(text_layout.wrap_text, corpus)
+    fit = time_fit(corpus)
+
+    print("captions={} widths={} line-break mismatches={}".format(len(corpus), TEMPLATE_WIDTHS, mismatches))
+    print("legacy wrap_text      {:8.1f} us/call".format(legacy / calls * 1e6))
+    print("cached wrap_text cold {:8.1f} us/call".format(cold / calls * 1e6))
+    print("cached wrap_text warm {:8.1f} us/call".format(warm / calls * 1e6))
+    print("fit_text (auto scale) {:8.1f} us/call".format(fit / calls * 1e6))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--captions", type = int, default = 500)
+    main(parser.parse_args())
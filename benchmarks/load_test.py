@@ -0,0 +1,118 @@
+"""
+Load test for POST /generate_meme against stubbed LLM and tool backends.
+
+Every LLM call, tool call and Reddit submission is replaced by a fixed-latency
+stand-in, so the numbers only reflect how well the service overlaps concurrent
+requests. With --real-tools the template scout and composer run for real, on a
+synthetic template index and templates served by a local HTTP server.
+
+    python -m benchmarks.load_test --requests 64 --concurrency 1 4 16 64
+    python -m benchmarks.load_test --real-tools --distinct-prompts --output load.json
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.stubs import FakeReddit, TemplateServer, install_offline_templates, use_offline_env, fake_llm
+
+use_offline_env()
+
+import httpx
+import app as meme_app
+from agents.caption_generator import CaptionGenerationAgent
+from agents.prompt_moderator import PromptModerationAgent
+from agents.template_scout import TemplateScoutToolAgent
+from agents.meme_composer import MemeComposerToolAgent
+from agents import meme_publisher
+from agents.publish_queue import PublishQueue, PublishRateLimiter
+from agents.publish_targets import MultiTargetPublisher, RedditTarget
+from agents.meme_store import MemeImage, meme_store
+from agents.compose_pool import close_compose_pool, get_compose_pool
+from benchmarks.results import percentiles, save_results
+from result_cache import build_result_cache
+
+def install_stubs(llm_latency, tool_latency, speculative = False, result_cache = "off", template_server = None):
+    def scout(prompt, user_id):
+        time.sleep(tool_latency)
+        return "https://i.imgflip.com/30b1gx.jpg"
+
+    def compose(image_url, caption):
+        time.sleep(tool_latency)
+        return meme_store.put(MemeImage(data = b"\xff\xd8\xff\xd9", media_type = "image/jpeg", extension = ".jpg"))
+
+    PromptModerationAgent.model = fake_llm("no", llm_latency)
+    CaptionGenerationAgent.model = fake_llm("When the benchmark finally runs offline", llm_latency)
+    if template_server is None:
+        TemplateScoutToolAgent.tool = scout
+        MemeComposerToolAgent.tool = compose
+    else:
+        install_offline_templates(template_server)
+    publisher = MultiTargetPublisher([RedditTarget("memes", reddit = FakeReddit(latency = tool_latency))])
+    meme_publisher._publish_queue = PublishQueue(publisher, ":memory:", rate_limiter = PublishRateLimiter(min_interval = 0))
+
+    meme_app.FAST_TOOL_AGENTS = True
+    meme_app.SPECULATIVE_MODERATION = speculative
+    meme_app.build_result_cache = lambda: build_result_cache(result_cache)
+    meme_app.build_agents()
+    meme_publisher.get_publish_queue().start()
+
+async def run_level(client, total, concurrency, distinct_prompts = False, offset = 0):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(i):
+        nonlocal failures
+        prompt = "monday mornings {}".format(offset + i) if distinct_prompts else "monday mornings"
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post("/generate_meme", json = {"user_id": "load-{}".format(i), "prompt": prompt})
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "failures": failures,
+        "throughput_rps": total / elapsed,
+        **percentiles(latencies),
+    }
+
+async def main(args):
+    template_server = TemplateServer().start() if args.real_tools else None
+    install_stubs(args.llm_latency, args.tool_latency, args.speculative, args.result_cache, template_server)
+    if template_server is not None and get_compose_pool() is not None:
+        # Started by the warm-up in the service.
+        get_compose_pool().start()
+    transport = httpx.ASGITransport(app = meme_app.app)
+    results = []
+    try:
+        async with httpx.AsyncClient(transport = transport, base_url = "http://meme-machine", timeout = None) as client:
+            for concurrency in args.concurrency:
+                result = await run_level(client, args.requests, concurrency, args.distinct_prompts, offset = len(results) * args.requests)
+                results.append(result)
+                print("concurrency={concurrency:>4}  throughput={throughput_rps:7.2f} req/s  p50={p50_s:.3f}s  p95={p95_s:.3f}s  p99={p99_s:.3f}s  max={max_s:.3f}s  failures={failures}".format(**result))
+    finally:
+        close_compose_pool()
+        if template_server is not None:
+            template_server.stop()
+    if args.output:
+        save_results(args.output, "load_test", results, args)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type = int, default = 64)
+    parser.add_argument("--concurrency", type = int, nargs = "+", default = [1, 4, 16, 64])
+    parser.add_argument("--llm-latency", type = float, default = 0.2)
+    parser.add_argument("--tool-latency", type = float, default = 0.02)
+    parser.add_argument("--speculative", action = "store_true", help = "Run moderation and scout/caption concurrently.")
+    # Every request uses the same prompt, so with a cache all but the first are hits.
+    parser.add_argument("--result-cache", choices = ["off", "memory", "sqlite"], default = "off")
+    parser.add_argument("--real-tools", action = "store_true", help = "Scout and compose for real against local synthetic templates.")
+    parser.add_argument("--distinct-prompts", action = "store_true", help = "Send a different prompt with every request.")
+    parser.add_argument("--output", help = "Write the results as JSON to this file.")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,124 @@
+"""
+Benchmark results as JSON, for comparing runs between commits.
+
+Benchmarks that take `--output results.json` write their rows together with the
+commit, machine and arguments they ran with. Compare two such files with
+
+    python -m benchmarks.results compare base.json head.json --threshold 0.1
+
+which prints the change of every metric and exits with status 1 when any of
+them got worse by more than the threshold.
+"""
+import argparse
+import platform
+import subprocess
+import json
+import time
+import sys
+import os
+
+# Metrics where a larger value is better; every other `*_s`/`*_ms`/`*_us` metric is a latency.
+HIGHER_IS_BETTER = ("throughput_rps", "ops_per_s")
+LATENCY_SUFFIXES = ("_s", "_ms", "_us")
+# Fields that identify a row rather than measure it.
+KEY_FIELDS = ("benchmark", "name", "mode", "concurrency", "targets", "compose_workers")
+
+def percentiles(latencies, scale: float = 1.0, unit: str = "s"):
+    """Mean, p50, p95, p99 and max of `latencies` (in seconds), multiplied by `scale`."""
+    values = sorted(latencies)
+    if not values:
+        return {}
+
+    def at(q):
+        return values[min(len(values) - 1, int(len(values) * q))] * scale
+
+    return {
+        "mean_{}".format(unit): sum(values) / len(values) * scale,
+        "p50_{}".format(unit): at(0.50),
+        "p95_{}".format(unit): at(0.95),
+        "p99_{}".format(unit): at(0.99),
+        "max_{}".format(unit): values[-1] * scale,
+    }
+
+def git(*args):
+    try:
+        return subprocess.run(["git", *args], capture_output = True, text = True, timeout = 10, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+def run_metadata():
+    return {
+        "commit": git("rev-parse", "HEAD") or None,
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def save_results(path, benchmark: str, results, args = None):
+    document = {
+        "benchmark": benchmark,
+        "metadata": run_metadata(),
+        "args": vars(args) if isinstance(args, argparse.Namespace) else (args or {}),
+        "results": results,
+    }
+    with open(path, "w") as file:
+        json.dump(document, file, indent = 2)
+    print("Saved {} results to {}".format(benchmark, path))
+
+def row_key(row):
+    return tuple((field, row[field]) for field in KEY_FIELDS if field in row)
+
+def compare(base, head, threshold: float):
+    """Returns `(lines, regressions)` describing the change of every shared metric."""
+    base_rows = {row_key(row): row for row in base["results"]}
+    lines, regressions = [], 0
+    for row in head["results"]:
+        key = row_key(row)
+        previous = base_rows.get(key)
+        if previous is None:
+            continue
+        label = " ".join("{}={}".format(field, value) for field, value in key)
+        for metric, value in row.items():
+            if metric in KEY_FIELDS or not isinstance(value, (int, float)) or not isinstance(previous.get(metric), (int, float)):
+                continue
+            higher_is_better = metric in HIGHER_IS_BETTER
+            if not higher_is_better and not metric.endswith(LATENCY_SUFFIXES):
+                continue
+            old = previous[metric]
+            change = (value - old) / old if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            elif -worse > threshold:
+                flag = "  improved"
+            lines.append("{:<40} {:<16} {:>12.4g} -> {:>12.4g}  {:+7.1%}{}".format(label, metric, old, value, change, flag))
+    return lines, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest = "command", required = True)
+    compare_parser = subparsers.add_parser("compare", help = "Compare two results files of the same benchmark.")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head")
+    compare_parser.add_argument("--threshold", type = float, default = 0.1, help = "Relative change counted as a regression (default 0.1).")
+    args = parser.parse_args()
+
+    with open(args.base, "r") as file:
+        base = json.load(file)
+    with open(args.head, "r") as file:
+        head = json.load(file)
+    if base["benchmark"] != head["benchmark"]:
+        parser.error("cannot compare {} results with {} results".format(base["benchmark"], head["benchmark"]))
+
+    print("{}: {} -> {}".format(head["benchmark"], (base["metadata"]["commit"] or "?")[:10], (head["metadata"]["commit"] or "?")[:10]))
+    lines, regressions = compare(base, head, args.threshold)
+    print("\n".join(lines))
+    print("{} regression(s) beyond {:.0%}".format(regressions, args.threshold))
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Offline stand-ins for the external services the pipeline talks to."""
+from google.adk.models import BaseLlm, LlmRequest, LlmResponse
+from google.genai import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from praw.exceptions import RedditAPIException
+from types import SimpleNamespace
+from typing import AsyncGenerator
+import threading
+import tempfile
+import asyncio
+import logging
+import json
+import time
+import uuid
+import zlib
+import os
+import cv2
+import numpy as np
+
+# The agent modules read these at import time.
+OFFLINE_ENV = {
+    "GOOGLE_API_KEY": "offline",
+    "GOOGLE_GENAI_USE_VERTEXAI": "FALSE",
+    "CLIENT_ID": "offline",
+    "CLIENT_SECRET": "offline",
+    "REDDIT_USER_AGENT": "meme-machine-benchmark",
+    "REDDIT_USERNAME": "offline",
+    "REDDIT_PASSWORD": "offline",
+    # Keeps the per-request log lines out of benchmark output.
+    "LOG_LEVEL": "WARNING",
+}
+
+def use_offline_env():
+    for key, value in OFFLINE_ENV.items():
+        os.environ.setdefault(key, value)
+    # ADK's tracing spans cross asyncio tasks in ParallelAgent, which makes
+    # OpenTelemetry log a harmless "Failed to detach context" per event.
+    logging.getLogger("opentelemetry.context").setLevel(logging.CRITICAL)
+
+class FakeLlm(BaseLlm):
+    """LLM backend that answers every request with a fixed reply after a fixed latency."""
+
+    reply: str = "no"
+    latency: float = 0.0
+
+    async def generate_content_async(self, llm_request: LlmRequest, stream: bool = False) -> AsyncGenerator[LlmResponse, None]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        yield LlmResponse(
+            content = types.Content(role = "model", parts = [types.Part(text = self.reply)]),
+            usage_metadata = types.GenerateContentResponseUsageMetadata(
+                prompt_token_count = sum(len((part.text or "").split()) for content in llm_request.contents for part in content.parts or []),
+                candidates_token_count = len(self.reply.split())
+            )
+        )
+
+def fake_llm(reply: str, latency: float = 0.0):
+    # Built-in tools such as google_search only accept Gemini 2 model names.
+    return FakeLlm(model = "gemini-2.0-flash-offline", reply = reply, latency = latency)
+
+class FakeBatchModerationLlm(BaseLlm):
+    """Batch moderator backend that answers a JSON array of prompts with a 'no' per prompt."""
+
+    latency: float = 0.0
+    calls: int = 0
+
+    async def generate_content_async(self, llm_request: LlmRequest, stream: bool = False) -> AsyncGenerator[LlmResponse, None]:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        prompts = json.loads(llm_request.contents[-1].parts[0].text)
+        yield LlmResponse(content = types.Content(role = "model", parts = [types.Part(text = json.dumps(["no"] * len(prompts)))]))
+
+class FakeSubreddit:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.display_name = name
+
+    def submit_image(self, title, image_path, **kwargs):
+        return self.reddit.submit(self.display_name, title, image_path)
+
+class FakeReddit:
+    """
+    Stand-in for `praw.Reddit` covering what the publisher uses: image submissions
+    and `auth.limits`. The first `rate_limited` submissions fail with Reddit's
+    RATELIMIT error asking to wait `rate_limit_delay` seconds.
+    """
+
+    def __init__(self, latency: float = 0.0, rate_limited: int = 0, rate_limit_delay: int = 1, requests_per_window: int = 600, window: float = 600.0):
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.rate_limit_delay = rate_limit_delay
+        self.requests_per_window = requests_per_window
+        self.window = window
+        self.lock = threading.Lock()
+        self.submissions = []
+        self.auth = SimpleNamespace(limits = {"remaining": None, "reset_timestamp": None, "used": None})
+
+    def subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+    def submit(self, subreddit, title, image_path):
+        if self.latency:
+            time.sleep(self.latency)
+        with open(image_path, "rb") as file:
+            size = len(file.read())
+        with self.lock:
+            used = (self.auth.limits["used"] or 0) + 1
+            self.auth.limits = {"remaining": self.requests_per_window - used, "reset_timestamp": time.time() + self.window, "used": used}
+            if self.rate_limited > 0:
+                self.rate_limited -= 1
+                raise RedditAPIException([["RATELIMIT", "Looks like you've been doing that a lot. Take a break for {} seconds before trying again.".format(self.rate_limit_delay), "ratelimit"]])
+            post_id = uuid.uuid4().hex[:6]
+            self.submissions.append({"id": post_id, "subreddit": subreddit, "title": title, "size": size, "time": time.time()})
+        return SimpleNamespace(id = post_id, permalink = "/r/{}/comments/{}/".format(subreddit, post_id))
+
+class FakeTarget:
+    """
+    Stand-in publish target that takes `latency` seconds per post and fails its
+    first `failures` posts. It records the size of every image it receives.
+    """
+
+    def __init__(self, name: str, latency: float = 0.0, failures: int = 0, timeout: float = 60.0):
+        self.name = name
+        self.latency = latency
+        self.failures = failures
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.posts = []
+
+    def publish(self, upload, title):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise ConnectionError("{} is unavailable".format(self.name))
+            self.posts.append({"title": title, "size": len(upload.image.data), "time": time.time()})
+            return "https://{}.example/{}".format(self.name, len(self.posts))
+
+    def rate_limits(self):
+        return None
+
+    def retry_after(self, error):
+        return None
+
+class SyntheticEncoder:
+    """Runs the feed-forward matrix products of a MiniLM-sized model over fixed-length prompts."""
+
+    def __init__(self, layers = 6, tokens = 16, dim = 384, hidden = 1536, seed = 0):
+        rng = np.random.default_rng(seed)
+        self.tokens = tokens
+        self.dim = dim
+        self.weights = [(rng.standard_normal((dim, hidden), dtype = np.float32) / np.sqrt(dim), rng.standard_normal((hidden, dim), dtype = np.float32) / np.sqrt(hidden)) for _ in range(layers)]
+
+    def encode(self, prompts, batch_size = 32, convert_to_numpy = True):
+        states = np.stack([self.embed_tokens(prompt) for prompt in prompts]).reshape(-1, self.dim)
+        for up, down in self.weights:
+            states = states + np.maximum(states @ up, 0) @ down
+            states /= np.linalg.norm(states, axis = 1, keepdims = True)
+        return states.reshape(len(prompts), self.tokens, self.dim).mean(axis = 1)
+
+    def embed_tokens(self, prompt):
+        rng = np.random.default_rng(zlib.crc32(prompt.encode("utf-8")))
+        return rng.standard_normal((self.tokens, self.dim), dtype = np.float32)
+
+def synthetic_template(index: int, width: int = 600, height: int = 600):
+    """
+    A JPEG template: a noisy picture, and for every other template a white caption
+    box over its top quarter, so both layouts of the composer are exercised.
+    """
+    rng = np.random.default_rng(index)
+    img = rng.integers(0, 200, (height, width, 3), dtype = np.uint8)
+    img = cv2.GaussianBlur(img, (0, 0), 3)
+    if index % 2 == 0:
+        img[:height // 4, :] = 255
+    ok, buffer = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return buffer.tobytes()
+
+class TemplateServer:
+    """
+    Local HTTP server standing in for i.imgflip.com. Serves `count` synthetic
+    templates at `/templates/<i>.jpg`, each after `latency` seconds.
+    """
+
+    def __init__(self, count: int = 50, latency: float = 0.0, sizes = ((600, 600), (800, 450), (500, 700))):
+        self.latency = latency
+        self.images = [synthetic_template(i, *sizes[i % len(sizes)]) for i in range(count)]
+        self.requests = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server.lock:
+                    server.requests += 1
+                name = self.path.rsplit("/", 1)[-1]
+                index = int(name.split(".")[0]) if name.split(".")[0].isdigit() else -1
+                if server.latency:
+                    time.sleep(server.latency)
+                if not 0 <= index < len(server.images):
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(server.images[index])))
+                self.end_headers()
+                self.wfile.write(server.images[index])
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    def url(self, index: int):
+        return "http://127.0.0.1:{}/templates/{}.jpg".format(self.httpd.server_port, index)
+
+    @property
+    def urls(self):
+        return [self.url(i) for i in range(len(self.images))]
+
+    def start(self):
+        self.thread = threading.Thread(target = self.httpd.serve_forever, daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+def install_offline_templates(server: TemplateServer, cache_dir = None):
+    """
+    Points the template index, template image cache and layout index at the local
+    template server: the index holds one template per served image, embedded by
+    `SyntheticEncoder`, which also encodes prompts. Caches live in `cache_dir`
+    (a fresh temporary directory by default), so every run starts cold.
+    """
+    from agents import template_cache, template_index, template_layout
+
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix = "meme_bench_")
+    encoder = SyntheticEncoder()
+    templates = [{"name": "template {}".format(i), "url": url} for i, url in enumerate(server.urls)]
+    embeddings = template_index.normalize_rows(encoder.encode([template["name"] for template in templates]))
+
+    template_index._embedding_model = encoder
+    template_index._template_index = template_index.TemplateIndex(templates, embeddings)
+    template_index.match_prompt.cache_clear()
+    template_cache._template_cache = template_cache.TemplateImageCache(cache_dir = os.path.join(cache_dir, "template_cache"))
+    template_layout._layout_index = template_layout.TemplateLayoutIndex(path = os.path.join(cache_dir, "template_layouts.json"))
+    return cache_dir
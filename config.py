@@ -0,0 +1,28 @@
+"""
+Loads the service configuration once per process.
+
+`.env` is read into the environment the first time `load_config()` runs. Every
+module that reads settings with `os.getenv` at import calls it right after its
+imports and before its own settings, so whichever of them is imported first
+loads the file, and it is parsed once instead of once per module.
+"""
+from dotenv import load_dotenv
+import threading
+import logging
+import os
+
+_config_lock = threading.Lock()
+_config_loaded = False
+
+def load_config():
+    global _config_loaded
+    if _config_loaded:
+        return
+    with _config_lock:
+        if _config_loaded:
+            return
+        load_dotenv()
+        vertex = os.getenv("GOOGLE_GENAI_USE_VERTEXAI", "").lower() in ("1", "true")
+        if not vertex and not os.getenv("GOOGLE_API_KEY"):
+            logging.getLogger(__name__).warning("GOOGLE_API_KEY is not set; LLM calls will fail")
+        _config_loaded = True
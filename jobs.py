@@ -0,0 +1,178 @@
+from collections import OrderedDict
+from typing import Optional
+import asyncio
+import logging
+import time
+import uuid
+import os
+
+from metrics import JOB_QUEUE_DEPTH
+from observability import current_request_id, request_id_var
+from pipeline import MemePipeline, PromptRejectedError, take_meme_image
+from config import load_config
+
+load_config()
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 256))
+MAX_FINISHED_JOBS = int(os.getenv("MAX_FINISHED_JOBS", 512))
+
+FINISHED_STATUSES = ("succeeded", "rejected", "failed")
+
+class JobQueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+class MemeJob:
+    def __init__(self, user_id: str, prompt: str, idempotency_key: Optional[str] = None, fresh_caption: bool = False, publish_async: bool = False):
+        self.id = uuid.uuid4().hex
+        # Id of the request that submitted the job, carried into the worker's logs.
+        self.request_id = current_request_id() or self.id
+        self.user_id = user_id
+        self.prompt = prompt
+        self.idempotency_key = idempotency_key
+        self.fresh_caption = fresh_caption
+        self.publish_async = publish_async
+        self.status = "queued"
+        self.error = None
+        self.meme_url = None
+        self.publication_id = None
+        self.publish_results = {}
+        self.image = None
+        self.media_type = "image/jpeg"
+        self.created_at = time.time()
+        self.finished_at = None
+        self.events = []
+        self.changed = asyncio.Condition()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    async def emit(self, event: dict, status: Optional[str] = None):
+        async with self.changed:
+            if status is not None:
+                self.status = status
+                if self.finished:
+                    self.finished_at = time.time()
+            self.events.append(event)
+            self.changed.notify_all()
+
+    async def set_status(self, status: str, **fields):
+        await self.emit({"stage": "job", "status": status, "timestamp": time.time(), **fields}, status = status)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "request_id": self.request_id,
+            "status": self.status,
+            "error": self.error,
+            "meme_url": self.meme_url,
+            "publish_results": self.publish_results,
+            "publication_id": self.publication_id,
+            "image_url": "/jobs/{}/image".format(self.id) if self.image is not None else None,
+            "events": len(self.events),
+            "created_at": self.created_at,
+            "finished_at": self.finished_at
+        }
+
+class JobManager:
+    """
+    Accepts meme jobs, runs them on a fixed number of worker tasks drawn from an
+    in-process queue and keeps the results of recently finished jobs.
+    Resubmitting with the same idempotency key returns the existing job instead
+    of starting the work again.
+    """
+
+    def __init__(self, pipeline: MemePipeline, workers: int = JOB_WORKERS, queue_size: int = JOB_QUEUE_SIZE, max_finished_jobs: int = MAX_FINISHED_JOBS):
+        self.pipeline = pipeline
+        self.workers = workers
+        self.max_finished_jobs = max_finished_jobs
+        self.queue = asyncio.Queue(maxsize = queue_size)
+        self.jobs = OrderedDict()
+        self.idempotency_keys = {}
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions = True)
+        self.tasks = []
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    def submit(self, user_id: str, prompt: str, idempotency_key: Optional[str] = None, fresh_caption: bool = False, publish_async: bool = False):
+        if idempotency_key:
+            job = self.jobs.get(self.idempotency_keys.get((user_id, idempotency_key)))
+            if job is not None:
+                return job
+
+        job = MemeJob(user_id, prompt, idempotency_key, fresh_caption, publish_async)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise JobQueueFullError("Job queue is full.")
+
+        self.jobs[job.id] = job
+        if idempotency_key:
+            self.idempotency_keys[(user_id, idempotency_key)] = job.id
+        self.evict_finished()
+        return job
+
+    def evict_finished(self):
+        finished = [job for job in self.jobs.values() if job.finished]
+        for job in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job.id]
+            if job.idempotency_key:
+                self.idempotency_keys.pop((job.user_id, job.idempotency_key), None)
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            token = request_id_var.set(job.request_id)
+            try:
+                await self.run_job(job)
+            finally:
+                request_id_var.reset(token)
+                self.queue.task_done()
+
+    async def run_job(self, job: MemeJob):
+        await job.set_status("running")
+        try:
+            state = await self.pipeline.run(job.user_id, job.prompt, on_event = job.emit, fresh_caption = job.fresh_caption, publish_async = job.publish_async)
+            image = take_meme_image(state)
+            job.meme_url = (state.get("meme_url") or "").strip()
+            job.publication_id = state.get("publication_id")
+            job.publish_results = state.get("publish_results") or {}
+            if image is None:
+                job.error = "Meme image was not generated."
+                await job.set_status("failed", error = job.error)
+            else:
+                job.image, job.media_type = image.data, image.media_type
+                await job.set_status("succeeded", meme_url = job.meme_url)
+        except PromptRejectedError:
+            job.error = "Prompt is not suitable for meme generation."
+            await job.set_status("rejected", error = job.error)
+        except Exception as e:
+            logger.exception("Job failed", extra = {"job_id": job.id})
+            job.error = f"An error occurred: {str(e)}"
+            await job.set_status("failed", error = job.error)
+
+    async def stream(self, job: MemeJob):
+        """Yields every progress event of the job, waiting for new ones until it finishes."""
+        index = 0
+        while True:
+            async with job.changed:
+                while index >= len(job.events) and not job.finished:
+                    await job.changed.wait()
+                events = job.events[index:]
+            for event in events:
+                yield event
+            index += len(events)
+            if job.finished and index >= len(job.events):
+                return
@@ -0,0 +1,297 @@
+"""In-process metrics rendered in the Prometheus text exposition format."""
+import threading
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(label, "") for label in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, dict(zip(self.label_names, key)), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} counter".format(self.name)]
+        lines.extend(render_sample(name, labels, value) for name, labels, value in self.samples())
+        return lines
+
+class Gauge:
+    """
+    A value that goes up and down. A gauge with a `function` is read when the
+    metrics are rendered; the function returns a number, or a dict mapping
+    label-value tuples to numbers.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names = (), function = None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(labels.get(label, "") for label in self.label_names)
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                values = self.function()
+            except Exception:
+                return []
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return [(self.name, dict(zip(self.label_names, key)), value) for key, value in sorted(values.items())]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} gauge".format(self.name)]
+        lines.extend(render_sample(name, labels, value) for name, labels, value in self.samples())
+        return lines
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names = (), buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(label, "") for label in self.label_names)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            values = sorted((key, list(entry)) for key, entry in self.values.items())
+        for key, entry in values:
+            labels = dict(zip(self.label_names, key))
+            for bound, count in zip(self.buckets, entry):
+                samples.append((self.name + "_bucket", {**labels, "le": format_value(bound)}, count))
+            samples.append((self.name + "_bucket", {**labels, "le": "+Inf"}, entry[-1]))
+            samples.append((self.name + "_sum", labels, entry[-2]))
+            samples.append((self.name + "_count", labels, entry[-1]))
+        return samples
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} histogram".format(self.name)]
+        lines.extend(render_sample(name, labels, value) for name, labels, value in self.samples())
+        return lines
+
+def render_sample(name, labels, value):
+    if not labels:
+        return "{} {}".format(name, format_value(value))
+    rendered = ",".join('{}="{}"'.format(key, str(val).replace("\\", "\\\\").replace('"', '\\"')) for key, val in labels.items())
+    return "{}{{{}}} {}".format(name, rendered, format_value(value))
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+SPECULATIVE_PREPARE_RUNS = registry.register(Counter(
+    "meme_speculative_prepare_total",
+    "Scout/caption runs started alongside moderation, by outcome (used, cancelled, discarded).",
+    ["outcome"]
+))
+
+RESULT_CACHE_LOOKUPS = registry.register(Counter(
+    "meme_result_cache_lookups_total",
+    "Prompt result cache lookups, by kind of result and outcome (hit, miss).",
+    ["kind", "result"]
+))
+
+RESULT_CACHE_SEMANTIC_MATCHES = registry.register(Counter(
+    "meme_result_cache_semantic_matches_total",
+    "Prompts that reused the cache key of a semantically similar cached prompt."
+))
+
+PUBLICATIONS = registry.register(Counter(
+    "meme_publications_total",
+    "Publish attempts by outcome (published, retried, partial, failed).",
+    ["outcome"]
+))
+
+PUBLISH_TARGET_RESULTS = registry.register(Counter(
+    "meme_publish_target_results_total",
+    "Posts to each publish target by result (published, failed, timeout).",
+    ["target", "status"]
+))
+
+REQUEST_DURATION = registry.register(Histogram(
+    "meme_http_request_duration_seconds",
+    "HTTP request latency by route, method and status code.",
+    ["route", "method", "status"]
+))
+
+STAGE_DURATION = registry.register(Histogram(
+    "meme_stage_duration_seconds",
+    "Time each pipeline stage's agent ran, excluding the wait for a stage slot, by outcome (ok, error, cancelled).",
+    ["stage", "agent", "outcome"]
+))
+
+STAGE_WAIT = registry.register(Histogram(
+    "meme_stage_wait_seconds",
+    "Time spent waiting for a concurrency slot of a pipeline stage.",
+    ["stage"]
+))
+
+STAGE_IN_FLIGHT = registry.register(Gauge(
+    "meme_stage_in_flight",
+    "Pipeline stage runs holding a concurrency slot.",
+    ["stage"]
+))
+
+STAGE_WAITING = registry.register(Gauge(
+    "meme_stage_waiting",
+    "Pipeline stage runs waiting for a concurrency slot.",
+    ["stage"]
+))
+
+TOOL_DURATION = registry.register(Histogram(
+    "meme_tool_duration_seconds",
+    "Tool call latency by tool and outcome (ok, error).",
+    ["tool", "outcome"]
+))
+
+LLM_CALLS = registry.register(Counter(
+    "meme_llm_calls_total",
+    "LLM calls by agent and outcome (ok, error).",
+    ["agent", "outcome"]
+))
+
+LLM_TOKENS = registry.register(Counter(
+    "meme_llm_tokens_total",
+    "LLM tokens by agent and kind (prompt, completion).",
+    ["agent", "kind"]
+))
+
+LLM_DURATION = registry.register(Histogram(
+    "meme_llm_duration_seconds",
+    "LLM call latency by agent.",
+    ["agent"]
+))
+
+TEMPLATE_IMAGE_CACHE_LOOKUPS = registry.register(Counter(
+    "meme_template_image_cache_lookups_total",
+    "Template image lookups by where they were served from (memory, disk, fetch).",
+    ["source"]
+))
+
+PUBLISH_TARGET_DURATION = registry.register(Histogram(
+    "meme_publish_target_duration_seconds",
+    "Time to post to each publish target, for posts that finished.",
+    ["target"]
+))
+
+JOB_QUEUE_DEPTH = registry.register(Gauge(
+    "meme_job_queue_depth",
+    "Jobs waiting for a job worker."
+))
+
+PUBLISH_QUEUE_DEPTH = registry.register(Gauge(
+    "meme_publish_queue_depth",
+    "Publications waiting or being published, by status (queued, publishing).",
+    ["status"]
+))
+
+EMBEDDING_QUEUE_DEPTH = registry.register(Gauge(
+    "meme_embedding_queue_depth",
+    "Prompts waiting for the embedding batcher."
+))
+
+STARTUP_SECONDS = registry.register(Gauge(
+    "meme_startup_seconds",
+    "Seconds spent importing the service and in each warm-up phase.",
+    ["phase"]
+))
+
+SESSIONS = registry.register(Gauge(
+    "meme_sessions",
+    "ADK sessions, by state (active for runs in flight, stored for kept sessions).",
+    ["state"]
+))
+
+SESSION_BYTES = registry.register(Gauge(
+    "meme_session_store_bytes",
+    "Serialized size of the sessions in the session store."
+))
+
+SESSION_EVICTIONS = registry.register(Counter(
+    "meme_session_evictions_total",
+    "Kept sessions evicted from the session store, by reason (ttl, size).",
+    ["reason"]
+))
+
+BATCH_ITEMS = registry.register(Counter(
+    "meme_batch_items_total",
+    "Batch items finished, by status (succeeded, rejected, failed).",
+    ["status"]
+))
+
+COMPOSE_POOL_PENDING = registry.register(Gauge(
+    "meme_compose_pool_pending",
+    "Composes running in or waiting for a compose worker process."
+))
+
+COMPOSE_POOL_REJECTED = registry.register(Counter(
+    "meme_compose_pool_rejected_total",
+    "Composes that gave up waiting for a free compose slot."
+))
+
+COMPOSE_SHARED_TEMPLATE_BYTES = registry.register(Gauge(
+    "meme_compose_shared_template_bytes",
+    "Decoded templates held in shared memory for the compose workers."
+))
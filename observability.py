@@ -0,0 +1,208 @@
+"""
+Request ids, structured logs and tracing.
+
+Every HTTP request gets a request id (taken from the `X-Request-ID` header or
+generated) that is carried through the pipeline, job workers and tool threads
+in a context variable and added to every log line and span. Logs are written as
+one JSON object per line unless `LOG_FORMAT=text`.
+
+Spans go through OpenTelemetry, next to the ones ADK records for agent runs,
+LLM calls and tool calls. They are only exported when
+`OTEL_EXPORTER_OTLP_ENDPOINT` points at a collector, e.g. `http://localhost:4318`.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from google.adk.agents import LlmAgent
+from opentelemetry import trace
+from typing import Optional
+import functools
+import threading
+import asyncio
+import logging
+import json
+import time
+import uuid
+import os
+
+from metrics import LLM_CALLS, LLM_DURATION, LLM_TOKENS, TOOL_DURATION
+from config import load_config
+
+load_config()
+
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "meme-machine")
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default = None)
+
+tracer = trace.get_tracer("meme_machine")
+
+_configure_lock = threading.Lock()
+_logging_configured = False
+_tracing_configured = False
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+def current_request_id():
+    return request_id_var.get()
+
+# Attributes every LogRecord has; anything else was passed through `extra`.
+STANDARD_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + ".{:03d}".format(int(record.msecs)),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None)
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in STANDARD_RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default = str)
+
+def configure_logging(log_format: str = LOG_FORMAT, level: str = LOG_LEVEL):
+    global _logging_configured
+    with _configure_lock:
+        if _logging_configured:
+            return
+        handler = logging.StreamHandler()
+        handler.addFilter(RequestIdFilter())
+        if log_format == "json":
+            handler.setFormatter(JsonFormatter())
+        else:
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+        root = logging.getLogger()
+        root.addHandler(handler)
+        root.setLevel(level)
+        _logging_configured = True
+
+def configure_tracing(endpoint: Optional[str] = OTEL_EXPORTER_OTLP_ENDPOINT):
+    """Exports spans, including ADK's, to an OTLP/HTTP collector when an endpoint is configured."""
+    global _tracing_configured
+    if not endpoint:
+        return False
+    with _configure_lock:
+        if _tracing_configured:
+            return True
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        except ImportError as e:
+            logging.getLogger(__name__).warning("Tracing disabled, install opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http: %s", e)
+            return False
+        provider = TracerProvider(resource = Resource.create({"service.name": OTEL_SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint = endpoint.rstrip("/") + "/v1/traces")))
+        trace.set_tracer_provider(provider)
+        _tracing_configured = True
+        return True
+
+def outcome_of(error: BaseException):
+    return "cancelled" if isinstance(error, asyncio.CancelledError) else "error"
+
+@contextmanager
+def timed_span(name: str, histogram = None, **labels):
+    """
+    Records a span carrying `labels` and the request id, and observes its
+    duration in `histogram` (with an `outcome` label if the histogram has one).
+    """
+    attributes = {key: str(value) for key, value in labels.items()}
+    request_id = request_id_var.get()
+    if request_id:
+        attributes["request_id"] = request_id
+    outcome = "ok"
+    started = time.perf_counter()
+    with tracer.start_as_current_span(name, attributes = attributes) as span:
+        try:
+            yield span
+        except BaseException as e:
+            outcome = outcome_of(e)
+            raise
+        finally:
+            if histogram is not None:
+                if "outcome" in histogram.label_names:
+                    labels["outcome"] = outcome
+                histogram.observe(time.perf_counter() - started, **labels)
+
+def traced_tool(function = None, name: Optional[str] = None):
+    """Times every call of a tool function in a span and `meme_tool_duration_seconds`."""
+    if function is None:
+        return functools.partial(traced_tool, name = name)
+    tool = name or function.__name__
+
+    @functools.wraps(function)
+    def traced(*args, **kwargs):
+        with timed_span("tool {}".format(tool), TOOL_DURATION, tool = tool):
+            return function(*args, **kwargs)
+    return traced
+
+# Start times of LLM calls in flight. Calls that raise never reach the after
+# callback, so entries older than LLM_STARTED_MAX_AGE are dropped now and then.
+_llm_started = {}
+_llm_started_lock = threading.Lock()
+LLM_STARTED_MAX_AGE = 600.0
+
+def llm_call_key(callback_context):
+    context = callback_context._invocation_context
+    return (context.invocation_id, context.branch, callback_context.agent_name)
+
+def before_model_metrics(callback_context, llm_request):
+    now = time.perf_counter()
+    with _llm_started_lock:
+        if len(_llm_started) > 1024:
+            for key in [key for key, started in _llm_started.items() if now - started > LLM_STARTED_MAX_AGE]:
+                del _llm_started[key]
+        _llm_started[llm_call_key(callback_context)] = now
+    return None
+
+def after_model_metrics(callback_context, llm_response):
+    agent = callback_context.agent_name
+    with _llm_started_lock:
+        started = _llm_started.pop(llm_call_key(callback_context), None)
+    if started is not None:
+        LLM_DURATION.observe(time.perf_counter() - started, agent = agent)
+    LLM_CALLS.inc(agent = agent, outcome = "error" if llm_response.error_code else "ok")
+    usage = llm_response.usage_metadata
+    if usage is not None:
+        LLM_TOKENS.inc(usage.prompt_token_count or 0, agent = agent, kind = "prompt")
+        LLM_TOKENS.inc(usage.candidates_token_count or 0, agent = agent, kind = "completion")
+    return None
+
+def as_callback_list(callback):
+    if callback is None:
+        return []
+    return list(callback) if isinstance(callback, list) else [callback]
+
+def instrument_agents(*agents):
+    """
+    Adds LLM call, latency and token metrics to every LLM agent in the given agent
+    trees. The metric callbacks run first and never short-circuit existing ones.
+    """
+    seen = set()
+    stack = list(agents)
+    while stack:
+        agent = stack.pop()
+        if id(agent) in seen:
+            continue
+        seen.add(id(agent))
+        if isinstance(agent, LlmAgent):
+            before = as_callback_list(agent.before_model_callback)
+            if before_model_metrics not in before:
+                agent.before_model_callback = [before_model_metrics] + before
+            after = as_callback_list(agent.after_model_callback)
+            if after_model_metrics not in after:
+                agent.after_model_callback = [after_model_metrics] + after
+        stack.extend(agent.sub_agents)
@@ -0,0 +1,228 @@
+from google.adk.agents import BaseAgent
+from google.adk.events import Event, EventActions
+from google.adk.runners import Runner
+from google.adk.sessions import BaseSessionService
+from google.genai import types
+from typing import Awaitable, Callable, Optional
+import asyncio
+import logging
+import time
+
+from agents.meme_store import meme_store
+from metrics import SPECULATIVE_PREPARE_RUNS
+from observability import timed_span
+
+logger = logging.getLogger(__name__)
+
+APP_NAME = "meme_machine"
+
+# State written by the moderation agents, copied into the main session in speculative mode.
+MODERATION_STATE_KEYS = ("moderator_response", "moderation_tier", "moderation_score")
+
+class PromptRejectedError(Exception):
+    """Raised when the moderator flags a prompt as unsuitable for a meme."""
+
+EventCallback = Callable[[dict], Awaitable[None]]
+
+class StageRunner(Runner):
+    """
+    Runner of one pipeline stage. Stages share a session, so its latest events
+    come from other stages' agents; a stage always starts at its own root agent
+    instead of looking for the agent that wrote them (which logs "Event from an
+    unknown agent" for every such event).
+    """
+
+    def _find_agent_to_run(self, session, root_agent: BaseAgent) -> BaseAgent:
+        return root_agent
+
+def progress_event(event):
+    """Summarizes an ADK event as a JSON-serializable progress update."""
+    return {
+        "stage": event.author,
+        "final": event.is_final_response(),
+        "state_keys": sorted(event.actions.state_delta) if event.actions else [],
+        "timestamp": event.timestamp
+    }
+
+def check_moderation(prompt: str, state: dict):
+    if (state.get("moderator_response") or "").strip().lower() == "yes":
+        raise PromptRejectedError(prompt)
+
+def take_meme_image(state: dict):
+    """Removes the composed meme of a finished run from the image store and returns it."""
+    meme_image_id = (state.get("meme_image_id") or "").strip()
+    if not meme_image_id:
+        return None
+    return meme_store.pop(meme_image_id)
+
+class MemePipeline:
+    """
+    Runs the moderation agent, the prepare agent (template scout and caption) and
+    the finish agent (compose and publish) for a prompt with `Runner.run_async`,
+    so a request never blocks the event loop. Runners are built once and shared
+    across requests.
+
+    In speculative mode moderation and the prepare agent start together; the
+    prepare run is cancelled as soon as moderation rejects the prompt, and the
+    finish agent only starts once moderation has passed.
+
+    With a result cache, results cached for the prompt are written into the new
+    session up front and the stages that produced them are skipped.
+
+    Every run's session is released when the run ends, so the session service
+    can drop it or keep it in a bounded store.
+    """
+
+    def __init__(self, session_service: BaseSessionService, moderation_agent: BaseAgent, prepare_agent: BaseAgent, finish_agent: BaseAgent, speculative: bool = False, result_cache = None, app_name: str = APP_NAME):
+        self.app_name = app_name
+        self.session_service = session_service
+        self.speculative = speculative
+        self.result_cache = result_cache
+        self.moderation_runner = self.build_runner(moderation_agent)
+        self.prepare_runner = self.build_runner(prepare_agent)
+        self.finish_runner = self.build_runner(finish_agent)
+
+    def build_runner(self, agent: BaseAgent):
+        return StageRunner(
+            agent = agent,
+            app_name = self.app_name,
+            session_service = self.session_service
+        )
+
+    async def run_agent(self, runner: Runner, user_id: str, session_id: str, prompt: str, on_event: Optional[EventCallback] = None):
+        content = types.Content(role = "user", parts = [types.Part(text = prompt)])
+        final_response = ""
+        async for event in runner.run_async(user_id = user_id, session_id = session_id, new_message = content):
+            if on_event is not None:
+                await on_event(progress_event(event))
+            if event.is_final_response() and event.content and event.content.parts:
+                final_response = event.content.parts[0].text or ""
+        return final_response
+
+    async def get_session(self, user_id: str, session_id: str):
+        return await self.session_service.get_session(
+            app_name = self.app_name,
+            user_id = user_id,
+            session_id = session_id
+        )
+
+    async def get_state(self, user_id: str, session_id: str):
+        session = await self.get_session(user_id, session_id)
+        return session.state
+
+    async def release_session(self, user_id: str, session_id: str):
+        """Hands a finished session back to the session service, deleting it if the service cannot keep it."""
+        release = getattr(self.session_service, "release_session", None)
+        if release is None:
+            release = self.session_service.delete_session
+        await release(app_name = self.app_name, user_id = user_id, session_id = session_id)
+
+    async def moderate(self, user_id: str, session_id: str, prompt: str, on_event: Optional[EventCallback] = None):
+        """Runs the moderation agent and returns the session state, raising if the prompt is rejected."""
+        moderator_response = await self.run_agent(self.moderation_runner, user_id, session_id, prompt, on_event)
+
+        state = await self.get_state(user_id, session_id)
+        logger.info("Moderated prompt", extra = {"moderator_response": moderator_response.strip(), "moderation_tier": state.get("moderation_tier", "llm")})
+        check_moderation(prompt, state)
+        return state
+
+    async def run_speculative(self, user_id: str, session_id: str, prompt: str, on_event: Optional[EventCallback] = None):
+        # Moderation gets its own session so the moderator never sees the
+        # scout/caption events written concurrently to the main one.
+        moderation_session = await self.session_service.create_session(
+            app_name = self.app_name,
+            user_id = user_id,
+            state = {"prompt": prompt}
+        )
+        prepare = asyncio.create_task(self.run_agent(self.prepare_runner, user_id, session_id, prompt, on_event))
+        try:
+            moderation_state = await self.moderate(user_id, moderation_session.id, prompt, on_event)
+        except BaseException:
+            outcome = "discarded" if prepare.done() else "cancelled"
+            prepare.cancel()
+            await asyncio.gather(prepare, return_exceptions = True)
+            SPECULATIVE_PREPARE_RUNS.inc(outcome = outcome)
+            raise
+        finally:
+            await self.session_service.delete_session(
+                app_name = self.app_name,
+                user_id = user_id,
+                session_id = moderation_session.id
+            )
+
+        session = await self.get_session(user_id, session_id)
+        await self.session_service.append_event(session, Event(
+            invocation_id = "inv_moderation_result",
+            author = self.moderation_runner.agent.name,
+            actions = EventActions(state_delta = {key: moderation_state[key] for key in MODERATION_STATE_KEYS if key in moderation_state}),
+            timestamp = time.time()
+        ))
+        await prepare
+        SPECULATIVE_PREPARE_RUNS.inc(outcome = "used")
+
+    async def lookup_cache(self, prompt: str, fresh_caption: bool = False, on_event: Optional[EventCallback] = None):
+        if self.result_cache is None:
+            return None
+        hit = await asyncio.to_thread(self.result_cache.lookup, prompt, fresh_caption)
+        if hit.image is not None:
+            hit.state["meme_image_id"] = meme_store.put(hit.image)
+        if hit.state and on_event is not None:
+            await on_event({
+                "stage": "result_cache",
+                "final": False,
+                "state_keys": sorted(hit.state),
+                "timestamp": time.time()
+            })
+        return hit
+
+    async def store_cache(self, prompt: str, hit, user_id: str, session_id: str):
+        if hit is None:
+            return
+        state = await self.get_state(user_id, session_id)
+        image = meme_store.get((state.get("meme_image_id") or "").strip())
+        await asyncio.to_thread(self.result_cache.store, prompt, hit, state, image)
+
+    async def run_stages(self, user_id: str, session_id: str, prompt: str, cached: dict, on_event: Optional[EventCallback] = None):
+        # The speculative run already includes the prepare agent.
+        run_prepare = not ("image_url" in cached and "caption" in cached)
+        if "moderator_response" in cached:
+            check_moderation(prompt, cached)
+        elif self.speculative and run_prepare:
+            await self.run_speculative(user_id, session_id, prompt, on_event)
+            run_prepare = False
+        else:
+            await self.moderate(user_id, session_id, prompt, on_event)
+
+        if run_prepare:
+            await self.run_agent(self.prepare_runner, user_id, session_id, prompt, on_event)
+        if not ("meme_image_id" in cached and "meme_url" in cached):
+            await self.run_agent(self.finish_runner, user_id, session_id, prompt, on_event)
+
+    async def run(self, user_id: str, prompt: str, on_event: Optional[EventCallback] = None, fresh_caption: bool = False, publish_async: bool = False):
+        """
+        Moderates the prompt, runs the meme agents and returns the final session state.
+        `on_event` receives a progress event for every ADK event produced on the way.
+        `fresh_caption` generates a new caption even when one is cached for the prompt.
+        `publish_async` returns once the meme is queued for publishing instead of
+        waiting for the post.
+        """
+        with timed_span("meme_pipeline", user_id = user_id) as span:
+            hit = await self.lookup_cache(prompt, fresh_caption, on_event)
+            cached = hit.state if hit is not None else {}
+            span.set_attribute("cached_keys", ",".join(sorted(cached)))
+            session = await self.session_service.create_session(
+                app_name = self.app_name,
+                user_id = user_id,
+                state = {"prompt": prompt, "user_id": user_id, "publish_async": publish_async, **cached}
+            )
+
+            try:
+                try:
+                    await self.run_stages(user_id, session.id, prompt, cached, on_event)
+                except PromptRejectedError:
+                    await self.store_cache(prompt, hit, user_id, session.id)
+                    raise
+                await self.store_cache(prompt, hit, user_id, session.id)
+                return dict(await self.get_state(user_id, session.id))
+            finally:
+                await self.release_session(user_id, session.id)
@@ -0,0 +1,321 @@
+"""
+Prompt-level cache of pipeline results.
+
+Moderation verdicts, selected templates, captions and composed memes are cached
+per prompt, each kind with its own TTL and byte bound (least recently used
+entries are evicted first). Prompts are keyed by their normalized text and, when
+RESULT_CACHE_SEMANTIC_THRESHOLD is set, a prompt whose MiniLM embedding is close
+enough to an already cached prompt reuses that prompt's template, caption and
+meme. Moderation verdicts are only ever reused for the same prompt, so a
+similar prompt is always moderated itself before anything is reused.
+
+Results live in memory (RESULT_CACHE=memory, the default) or in a SQLite file
+that survives restarts (RESULT_CACHE=sqlite). RESULT_CACHE=off disables the cache.
+"""
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+import threading
+import sqlite3
+import string
+import time
+import json
+import os
+import numpy as np
+
+from agents.meme_store import MemeImage
+from agents.template_index import DATA_DIR, embed_prompt, normalize_rows
+from metrics import RESULT_CACHE_LOOKUPS, RESULT_CACHE_SEMANTIC_MATCHES
+from config import load_config
+
+load_config()
+
+RESULT_CACHE_BACKEND = os.getenv("RESULT_CACHE", "memory").lower()
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", str(DATA_DIR / "result_cache.sqlite3"))
+# Cosine similarity above which a new prompt reuses the results of a cached one; 0 disables it.
+RESULT_CACHE_SEMANTIC_THRESHOLD = float(os.getenv("RESULT_CACHE_SEMANTIC_THRESHOLD", 0))
+RESULT_CACHE_SEMANTIC_SIZE = int(os.getenv("RESULT_CACHE_SEMANTIC_SIZE", 4096))
+
+class CachePolicy(NamedTuple):
+    ttl: float
+    max_bytes: int
+
+# Overridable with RESULT_CACHE_TTL_<KIND> and RESULT_CACHE_MAX_BYTES_<KIND>.
+DEFAULT_CACHE_POLICIES = {
+    "moderation": CachePolicy(24 * 3600, 4 * 1024 * 1024),
+    "template": CachePolicy(24 * 3600, 4 * 1024 * 1024),
+    # Captions draw on recent events found with google_search and go stale sooner.
+    "caption": CachePolicy(3600, 4 * 1024 * 1024),
+    "meme": CachePolicy(3600, 128 * 1024 * 1024),
+    # Embeddings of cached prompts, used for semantic matching.
+    "prompt": CachePolicy(24 * 3600, 16 * 1024 * 1024),
+}
+
+# Session state keys cached for each kind of result.
+CACHED_STATE_KEYS = {
+    "moderation": ("moderator_response", "moderation_tier", "moderation_score"),
+    "template": ("image_url",),
+    "caption": ("caption",),
+}
+
+# Kinds only reused for the same normalized prompt, never for a similar one.
+EXACT_KINDS = ("moderation",)
+
+def get_cache_policy(kind: str):
+    default = DEFAULT_CACHE_POLICIES[kind]
+    return CachePolicy(
+        float(os.getenv("RESULT_CACHE_TTL_{}".format(kind.upper()), default.ttl)),
+        int(os.getenv("RESULT_CACHE_MAX_BYTES_{}".format(kind.upper()), default.max_bytes))
+    )
+
+def normalize_prompt(prompt: str):
+    """Case-folds the prompt, collapses whitespace and strips surrounding punctuation."""
+    return " ".join(prompt.casefold().split()).strip(string.punctuation + " ")
+
+class MemoryCacheBackend:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {kind: OrderedDict() for kind in DEFAULT_CACHE_POLICIES}
+        self.sizes = {kind: 0 for kind in DEFAULT_CACHE_POLICIES}
+
+    def _remove(self, kind, key):
+        value, _ = self.entries[kind].pop(key)
+        self.sizes[kind] -= len(value)
+
+    def get(self, kind: str, key: str):
+        with self.lock:
+            entry = self.entries[kind].get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                self._remove(kind, key)
+                return None
+            self.entries[kind].move_to_end(key)
+            return value
+
+    def put(self, kind: str, key: str, value: bytes, policy: CachePolicy):
+        with self.lock:
+            entries = self.entries[kind]
+            if key in entries:
+                self._remove(kind, key)
+            entries[key] = (value, time.time() + policy.ttl)
+            self.sizes[kind] += len(value)
+            while entries and self.sizes[kind] > policy.max_bytes:
+                self._remove(kind, next(iter(entries)))
+
+    def items(self, kind: str):
+        now = time.time()
+        with self.lock:
+            return [(key, value) for key, (value, expires_at) in self.entries[kind].items() if expires_at > now]
+
+class SqliteCacheBackend:
+    def __init__(self, path = RESULT_CACHE_PATH):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_lru ON results (kind, used_at)")
+
+    def get(self, kind: str, key: str):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT value, expires_at FROM results WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self.connection.execute("DELETE FROM results WHERE kind = ? AND key = ?", (kind, key))
+                return None
+            self.connection.execute("UPDATE results SET used_at = ? WHERE kind = ? AND key = ?", (now, kind, key))
+            return bytes(row[0])
+
+    def put(self, kind: str, key: str, value: bytes, policy: CachePolicy):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO results (kind, key, value, size, expires_at, used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (kind, key, value, len(value), now + policy.ttl, now)
+                )
+                self.connection.execute("DELETE FROM results WHERE kind = ? AND expires_at <= ?", (kind, now))
+                self._evict(kind, policy.max_bytes)
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def _evict(self, kind, max_bytes):
+        (total,) = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results WHERE kind = ?", (kind,)).fetchone()
+        if total <= max_bytes:
+            return
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM results WHERE kind = ? ORDER BY used_at", (kind,)):
+            if total <= max_bytes:
+                break
+            evicted.append((kind, key))
+            total -= size
+        self.connection.executemany("DELETE FROM results WHERE kind = ? AND key = ?", evicted)
+
+    def items(self, kind: str):
+        with self.lock:
+            rows = self.connection.execute("SELECT key, value FROM results WHERE kind = ? AND expires_at > ?", (kind, time.time())).fetchall()
+        return [(key, bytes(value)) for key, value in rows]
+
+class CacheHit(NamedTuple):
+    # Key of the prompt itself, and of the cached prompt whose results are shared (the same without a semantic match).
+    exact_key: str
+    key: str
+    state: dict
+    image: Optional[MemeImage] = None
+
+    def key_for(self, kind: str):
+        return self.exact_key if kind in EXACT_KINDS else self.key
+
+def encode_meme(image: MemeImage, state: dict):
+    # JSON never contains a raw NUL byte, so it separates the header from the image.
+    header = {
+        "media_type": image.media_type,
+        "extension": image.extension,
+        "image_url": state.get("image_url"),
+        "caption": state.get("caption"),
+        "meme_url": state.get("meme_url"),
+        "publish_results": state.get("publish_results"),
+        "publication_id": state.get("publication_id")
+    }
+    return json.dumps(header).encode("utf-8") + b"\0" + image.data
+
+def decode_meme(value: bytes):
+    header, data = value.split(b"\0", 1)
+    header = json.loads(header)
+    return MemeImage(data, header["media_type"], header["extension"]), header
+
+class ResultCache:
+    """
+    Looks up and stores the results of a pipeline run under the prompt's cache key.
+    Only results computed by the run are stored, so cache hits do not extend their TTL.
+    """
+
+    def __init__(self, backend, semantic_threshold: float = RESULT_CACHE_SEMANTIC_THRESHOLD, semantic_size: int = RESULT_CACHE_SEMANTIC_SIZE):
+        self.backend = backend
+        self.semantic_threshold = semantic_threshold
+        self.semantic_size = semantic_size
+        self.lock = threading.Lock()
+        self.semantic_keys = []
+        self.semantic_slots = {}
+        self.semantic_matrix = None
+        self.next_slot = 0
+        if self.semantic:
+            for key, value in backend.items("prompt"):
+                self.add_semantic_key(key, np.frombuffer(value, dtype = np.float32))
+
+    @property
+    def semantic(self):
+        return self.semantic_threshold > 0
+
+    def add_semantic_key(self, key: str, embedding):
+        embedding = normalize_rows(np.reshape(embedding, (1, -1)))[0]
+        with self.lock:
+            if key in self.semantic_slots:
+                return
+            if self.semantic_matrix is None:
+                self.semantic_matrix = np.zeros((self.semantic_size, len(embedding)), dtype = np.float32)
+            slot = self.next_slot % self.semantic_size
+            if slot < len(self.semantic_keys):
+                del self.semantic_slots[self.semantic_keys[slot]]
+                self.semantic_keys[slot] = key
+            else:
+                self.semantic_keys.append(key)
+            self.semantic_slots[key] = slot
+            self.semantic_matrix[slot] = embedding
+            self.next_slot += 1
+
+    def resolve_key(self, prompt: str):
+        """Returns the cache key of the prompt, or of a cached prompt similar enough to it."""
+        key = normalize_prompt(prompt)
+        if not self.semantic or key in self.semantic_slots or not self.semantic_keys:
+            return key
+
+        query = normalize_rows(np.reshape(embed_prompt(prompt), (1, -1)))[0]
+        with self.lock:
+            scores = self.semantic_matrix[:len(self.semantic_keys)] @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.semantic_threshold:
+                return key
+            RESULT_CACHE_SEMANTIC_MATCHES.inc()
+            return self.semantic_keys[best]
+
+    def get(self, kind: str, key: str):
+        value = self.backend.get(kind, key)
+        RESULT_CACHE_LOOKUPS.inc(kind = kind, result = "miss" if value is None else "hit")
+        return value
+
+    def lookup(self, prompt: str, fresh_caption: bool = False):
+        """
+        Returns the cached session state for the prompt and, when the caption is
+        reused, the composed meme. `fresh_caption` skips the cached caption and
+        meme but still reuses the moderation verdict and the template. A prompt
+        that only semantically matches a cached one gets no moderation verdict,
+        so it is moderated before the shared results are used.
+        """
+        exact_key = normalize_prompt(prompt)
+        key = self.resolve_key(prompt)
+        state = {}
+        kinds = ["moderation", "template"] if fresh_caption else ["moderation", "template", "caption"]
+        for kind in kinds:
+            value = self.get(kind, exact_key if kind in EXACT_KINDS else key)
+            if value is not None:
+                state.update(json.loads(value))
+
+        image = None
+        if not fresh_caption and "image_url" in state and "caption" in state:
+            value = self.get("meme", key)
+            if value is not None:
+                image, header = decode_meme(value)
+                # The meme is only valid for the template and caption it was composed from.
+                if (header["image_url"], header["caption"]) != (state["image_url"], state["caption"]):
+                    image = None
+                elif header["meme_url"]:
+                    state["meme_url"] = header["meme_url"]
+                    state["publish_results"] = header.get("publish_results") or {}
+                elif header.get("publication_id"):
+                    # Still queued when cached; the publisher looks the post up instead of repeating it.
+                    state["publication_id"] = header["publication_id"]
+        return CacheHit(exact_key, key, state, image)
+
+    def store(self, prompt: str, hit: CacheHit, state: dict, image: Optional[MemeImage] = None):
+        """Caches the results of a finished run that did not come from `hit`."""
+        stored = False
+        for kind, keys in CACHED_STATE_KEYS.items():
+            if any(key in hit.state for key in keys) or not state.get(keys[0]):
+                continue
+            value = {key: state.get(key) for key in keys}
+            self.backend.put(kind, hit.key_for(kind), json.dumps(value).encode("utf-8"), get_cache_policy(kind))
+            stored = True
+
+        if image is not None and hit.image is None and state.get("image_url") and state.get("caption"):
+            self.backend.put("meme", hit.key, encode_meme(image, state), get_cache_policy("meme"))
+
+        if stored and self.semantic and hit.key == hit.exact_key and hit.key not in self.semantic_slots:
+            embedding = embed_prompt(prompt)
+            self.backend.put("prompt", hit.key, np.asarray(embedding, dtype = np.float32).tobytes(), get_cache_policy("prompt"))
+            self.add_semantic_key(hit.key, embedding)
+
+def build_result_cache(backend: str = RESULT_CACHE_BACKEND):
+    if backend == "off":
+        return None
+    if backend == "sqlite":
+        return ResultCache(SqliteCacheBackend(RESULT_CACHE_PATH))
+    if backend == "memory":
+        return ResultCache(MemoryCacheBackend())
+    raise ValueError("Unknown result cache backend: {}".format(backend))
@@ -0,0 +1,274 @@
+"""
+Session lifecycle for the pipeline's ADK sessions.
+
+`BoundedSessionService` holds the sessions of runs in flight as live objects
+(no per-read deep copy, unlike `InMemorySessionService`). When a run finishes
+the pipeline releases its session, which is then handled by SESSION_RETENTION:
+
+- `delete` (default): dropped, so memory no longer grows with every meme served.
+- `compact`: kept with its state but without the event history.
+- `keep`: kept with its events.
+
+Kept sessions go to a store bounded by count (SESSION_MAX_COUNT), size
+(SESSION_MAX_BYTES) and idle time (SESSION_TTL), evicting the least recently
+used first. The store lives in memory (SESSION_STORE=memory) or in a SQLite
+file that survives restarts (SESSION_STORE=sqlite).
+"""
+from collections import OrderedDict
+from google.adk.events import Event
+from google.adk.sessions import BaseSessionService, Session
+from google.adk.sessions.base_session_service import GetSessionConfig, ListSessionsResponse
+from typing import Any, Optional
+import threading
+import asyncio
+import sqlite3
+import time
+import uuid
+import os
+
+from agents.template_index import DATA_DIR
+from metrics import SESSION_BYTES, SESSION_EVICTIONS, SESSIONS
+from config import load_config
+
+load_config()
+
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE", "memory").lower()
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", str(DATA_DIR / "sessions.sqlite3"))
+SESSION_RETENTION = os.getenv("SESSION_RETENTION", "delete").lower()
+SESSION_MAX_COUNT = int(os.getenv("SESSION_MAX_COUNT", 10000))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", 64 * 1024 * 1024))
+# Seconds a kept session survives without being read or written.
+SESSION_TTL = float(os.getenv("SESSION_TTL", 3600))
+
+SESSION_RETENTIONS = ("delete", "compact", "keep")
+
+class MemorySessionBackend:
+    def __init__(self, max_count: int = SESSION_MAX_COUNT, max_bytes: int = SESSION_MAX_BYTES, ttl: float = SESSION_TTL):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (app_name, user_id, session_id) -> (value, used_at), least recently used first.
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def _remove(self, key, reason = None):
+        value, _ = self.entries.pop(key)
+        self.size -= len(value)
+        if reason is not None:
+            SESSION_EVICTIONS.inc(reason = reason)
+
+    def _expire(self, now):
+        # Every access refreshes `used_at`, so the front of the LRU expires first.
+        while self.entries:
+            key, (_, used_at) = next(iter(self.entries.items()))
+            if used_at + self.ttl > now:
+                break
+            self._remove(key, "ttl")
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries[key] = (entry[0], now)
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value: bytes):
+        now = time.time()
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, now)
+            self.size += len(value)
+            self._expire(now)
+            while self.entries and (len(self.entries) > self.max_count or self.size > self.max_bytes):
+                self._remove(next(iter(self.entries)), "size")
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def session_ids(self, app_name: str, user_id: str):
+        now = time.time()
+        with self.lock:
+            return [key[2] for key, (_, used_at) in self.entries.items() if key[:2] == (app_name, user_id) and used_at + self.ttl > now]
+
+    def stats(self):
+        with self.lock:
+            return len(self.entries), self.size
+
+class SqliteSessionBackend:
+    def __init__(self, path = SESSION_STORE_PATH, max_count: int = SESSION_MAX_COUNT, max_bytes: int = SESSION_MAX_BYTES, ttl: float = SESSION_TTL):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                app_name TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (app_name, user_id, session_id)
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_lru ON sessions (used_at)")
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT value, used_at FROM sessions WHERE app_name = ? AND user_id = ? AND session_id = ?", key).fetchone()
+            if row is None:
+                return None
+            if row[1] + self.ttl <= now:
+                self.connection.execute("DELETE FROM sessions WHERE app_name = ? AND user_id = ? AND session_id = ?", key)
+                SESSION_EVICTIONS.inc(reason = "ttl")
+                return None
+            self.connection.execute("UPDATE sessions SET used_at = ? WHERE app_name = ? AND user_id = ? AND session_id = ?", (now, *key))
+            return bytes(row[0])
+
+    def put(self, key, value: bytes):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO sessions (app_name, user_id, session_id, value, size, used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (*key, value, len(value), now)
+                )
+                expired = self.connection.execute("DELETE FROM sessions WHERE used_at <= ?", (now - self.ttl,)).rowcount
+                if expired > 0:
+                    SESSION_EVICTIONS.inc(expired, reason = "ttl")
+                self._evict()
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def _evict(self):
+        count, total = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM sessions").fetchone()
+        if count <= self.max_count and total <= self.max_bytes:
+            return
+        evicted = []
+        for app_name, user_id, session_id, size in self.connection.execute("SELECT app_name, user_id, session_id, size FROM sessions ORDER BY used_at"):
+            if count <= self.max_count and total <= self.max_bytes:
+                break
+            evicted.append((app_name, user_id, session_id))
+            count -= 1
+            total -= size
+        self.connection.executemany("DELETE FROM sessions WHERE app_name = ? AND user_id = ? AND session_id = ?", evicted)
+        SESSION_EVICTIONS.inc(len(evicted), reason = "size")
+
+    def delete(self, key):
+        with self.lock:
+            self.connection.execute("DELETE FROM sessions WHERE app_name = ? AND user_id = ? AND session_id = ?", key)
+
+    def session_ids(self, app_name: str, user_id: str):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT session_id FROM sessions WHERE app_name = ? AND user_id = ? AND used_at > ?",
+                (app_name, user_id, time.time() - self.ttl)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def stats(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM sessions").fetchone()
+
+class BoundedSessionService(BaseSessionService):
+    """
+    Session service with an explicit end of life. Sessions of runs in flight are
+    shared live objects; `release_session` hands a finished one to the bounded
+    store according to `retention`, or drops it.
+    """
+
+    def __init__(self, backend, retention: str = SESSION_RETENTION):
+        if retention not in SESSION_RETENTIONS:
+            raise ValueError("Unknown session retention: {}".format(retention))
+        self.backend = backend
+        self.retention = retention
+        self.active = {}
+
+    async def create_session(self, *, app_name: str, user_id: str, state: Optional[dict[str, Any]] = None, session_id: Optional[str] = None) -> Session:
+        session_id = (session_id or "").strip() or uuid.uuid4().hex
+        session = Session(
+            app_name = app_name,
+            user_id = user_id,
+            id = session_id,
+            state = dict(state or {}),
+            last_update_time = time.time()
+        )
+        self.active[(app_name, user_id, session_id)] = session
+        return session
+
+    async def load_stored(self, key):
+        value = await asyncio.to_thread(self.backend.get, key)
+        return Session.model_validate_json(value) if value is not None else None
+
+    async def get_session(self, *, app_name: str, user_id: str, session_id: str, config: Optional[GetSessionConfig] = None) -> Optional[Session]:
+        key = (app_name, user_id, session_id)
+        session = self.active.get(key)
+        if session is None:
+            session = await self.load_stored(key)
+        if session is None or config is None:
+            return session
+
+        events = session.events
+        if config.num_recent_events:
+            events = events[-config.num_recent_events:]
+        if config.after_timestamp:
+            events = [event for event in events if event.timestamp >= config.after_timestamp]
+        return session.model_copy(update = {"events": events})
+
+    async def list_sessions(self, *, app_name: str, user_id: str) -> ListSessionsResponse:
+        session_ids = [key[2] for key in self.active if key[:2] == (app_name, user_id)]
+        session_ids += await asyncio.to_thread(self.backend.session_ids, app_name, user_id)
+        return ListSessionsResponse(sessions = [
+            Session(app_name = app_name, user_id = user_id, id = session_id)
+            for session_id in dict.fromkeys(session_ids)
+        ])
+
+    async def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        key = (app_name, user_id, session_id)
+        self.active.pop(key, None)
+        await asyncio.to_thread(self.backend.delete, key)
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        await super().append_event(session = session, event = event)
+        session.last_update_time = event.timestamp
+        key = (session.app_name, session.user_id, session.id)
+        if key not in self.active and not event.partial:
+            # A kept session that is being continued; write it back.
+            await asyncio.to_thread(self.backend.put, key, session.model_dump_json().encode("utf-8"))
+        return event
+
+    async def release_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        """Ends the run of a session: drops it, or moves it to the bounded store."""
+        key = (app_name, user_id, session_id)
+        session = self.active.pop(key, None)
+        if session is None or self.retention == "delete":
+            return
+        if self.retention == "compact":
+            session = session.model_copy(update = {"events": []})
+        await asyncio.to_thread(self.backend.put, key, session.model_dump_json().encode("utf-8"))
+
+def build_session_service(backend: str = SESSION_STORE_BACKEND, retention: str = SESSION_RETENTION):
+    if backend == "sqlite":
+        service = BoundedSessionService(SqliteSessionBackend(SESSION_STORE_PATH), retention)
+    elif backend == "memory":
+        service = BoundedSessionService(MemorySessionBackend(), retention)
+    else:
+        raise ValueError("Unknown session store backend: {}".format(backend))
+    SESSIONS.set_function(lambda: {("active",): len(service.active), ("stored",): service.backend.stats()[0]})
+    SESSION_BYTES.set_function(lambda: service.backend.stats()[1])
+    return service
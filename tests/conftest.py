@@ -0,0 +1,4 @@
+from benchmarks.stubs import use_offline_env
+
+# The agent modules read their settings at import time.
+use_offline_env()
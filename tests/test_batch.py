@@ -0,0 +1,52 @@
+"""Resuming batches from their checkpoints, with the pipeline stages of a chunk faked out."""
+import asyncio
+import json
+
+from google.adk.agents import BaseAgent
+from google.adk.sessions import InMemorySessionService
+
+from batch import BatchCheckpoint, BatchItem, BatchRunner
+from pipeline import MemePipeline
+
+class IdleAgent(BaseAgent):
+    async def _run_async_impl(self, ctx):
+        return
+        yield
+
+def write_checkpoint(path, *records):
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+
+def build_runner():
+    pipeline = MemePipeline(InMemorySessionService(), IdleAgent(name = "moderation"), IdleAgent(name = "prepare"), IdleAgent(name = "finish"))
+    return BatchRunner(pipeline, IdleAgent(name = "batch_moderation"), IdleAgent(name = "caption"))
+
+def test_resume_reruns_failed_items_only(tmp_path, monkeypatch):
+    path = tmp_path / "batch.jsonl"
+    write_checkpoint(path,
+        {"id": "1", "prompt": "one", "status": "succeeded"},
+        {"id": "2", "prompt": "two", "status": "rejected"},
+        {"id": "3", "prompt": "three", "status": "failed", "error": "The caption does not fit on the template"})
+    items = [BatchItem("1", "one"), BatchItem("2", "two"), BatchItem("3", "three"), BatchItem("4", "four")]
+    runner = build_runner()
+    prepared = []
+
+    async def prepare(chunk, checkpoint, publish_times):
+        prepared.extend(item.id for item in chunk)
+        return [{"id": item.id, "prompt": item.prompt, "status": "succeeded"} for item in chunk], []
+
+    monkeypatch.setattr(runner, "prepare", prepare)
+    checkpoint = BatchCheckpoint(path)
+    assert [checkpoint.done(item.id) for item in items] == [True, True, False, False]
+
+    async def run():
+        return [record async for record in runner.run(items, checkpoint)]
+
+    try:
+        records = asyncio.run(run())
+    finally:
+        checkpoint.close()
+
+    assert prepared == ["3", "4"]
+    assert [record["id"] for record in records] == ["3", "4"]
+    # The retried record replaces the failed one when the checkpoint is read again.
+    assert all(BatchCheckpoint(path).done(item.id) for item in items)
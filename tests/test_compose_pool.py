@@ -0,0 +1,59 @@
+"""Shared-memory bookkeeping of the compose pool, in this process rather than in workers."""
+from multiprocessing.shared_memory import SharedMemory
+import pytest
+
+from agents import compose_pool
+
+@pytest.fixture
+def blocks(monkeypatch):
+    monkeypatch.setattr(compose_pool, "_attached", {})
+    monkeypatch.setattr(compose_pool, "_generation", 0)
+    created = [SharedMemory(create = True, size = 16) for _ in range(4)]
+    yield [memory.name for memory in created]
+    for memory in compose_pool._attached.values():
+        memory.close()
+    for memory in created:
+        memory.close()
+        memory.unlink()
+
+def test_worker_unmaps_blocks_evicted_since_its_last_task(blocks):
+    for name in blocks:
+        compose_pool.attach(name)
+
+    compose_pool.detach_evicted(2, ((1, blocks[0]), (2, blocks[1])), blocks[3])
+    assert set(compose_pool._attached) == {blocks[2], blocks[3]}
+
+    # Evictions seen before are not applied twice; only the new one is.
+    compose_pool.detach_evicted(3, ((1, blocks[0]), (2, blocks[1]), (3, blocks[2])), blocks[3])
+    assert set(compose_pool._attached) == {blocks[3]}
+
+def test_worker_that_missed_evictions_keeps_only_the_current_block(blocks):
+    for name in blocks:
+        compose_pool.attach(name)
+
+    # Generations 1 and 2 fell out of the eviction log.
+    compose_pool.detach_evicted(5, ((3, "gone"), (4, "gone too"), (5, "also gone")), blocks[1])
+
+    assert set(compose_pool._attached) == {blocks[1]}
+    assert compose_pool._generation == 5
+
+def test_shared_templates_are_not_kept_in_the_decoded_lru(tmp_path, monkeypatch):
+    from agents import template_cache
+    from benchmarks.stubs import TemplateServer
+
+    cache = template_cache.TemplateImageCache(cache_dir = tmp_path)
+    monkeypatch.setattr(template_cache, "_template_cache", cache)
+    # Room for one synthetic template (at most 600x600 BGR).
+    templates = compose_pool.SharedTemplates(max_bytes = 600 * 600 * 3)
+    with TemplateServer(2) as server:
+        first = templates.acquire(server.url(0))
+        templates.release(first)
+        second = templates.acquire(server.url(1))
+        templates.release(second)
+
+    assert cache.decoded_bytes == 0
+    # The first template was evicted to make room for the second one.
+    assert list(templates.entries) == [server.url(1)]
+    assert templates.generation == 1
+    assert templates.evictions() == (1, ((1, first.memory.name),))
+    templates.close()
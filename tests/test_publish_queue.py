@@ -0,0 +1,193 @@
+"""Publish queue against a fake PRAW client and fake targets, without the network."""
+import sqlite3
+import asyncio
+import time
+
+from agents.meme_store import MemeImage
+from agents.publish_queue import PUBLISH_RETRY_BASE, PublishQueue, PublishRateLimiter
+from agents.publish_targets import MultiTargetPublisher, RedditTarget
+from benchmarks.stubs import FakeReddit, FakeTarget
+
+IMAGE = MemeImage(b"\x89PNG fake meme", "image/png", ".png")
+
+def build_queue(*targets, path = ":memory:", max_attempts = 5):
+    return PublishQueue(MultiTargetPublisher(list(targets)), path, workers = 1, rate_limiter = PublishRateLimiter(min_interval = 0), max_attempts = max_attempts)
+
+def attempt(queue):
+    """Makes every queued publication due and runs one attempt in the calling thread."""
+    queue.execute("UPDATE publications SET next_attempt_at = 0 WHERE status = 'queued'")
+    row = queue.claim()
+    assert row is not None
+    queue.publish(row)
+    return queue.get(row["id"])
+
+def test_publishes_to_reddit():
+    reddit = FakeReddit()
+    queue = build_queue(RedditTarget("memes", reddit = reddit))
+    publication_id = queue.enqueue(IMAGE, "a title")
+
+    publication = attempt(queue)
+
+    assert publication["id"] == publication_id
+    assert publication["status"] == "published"
+    assert publication["meme_url"].startswith("https://www.reddit.com/r/memes/comments/")
+    assert [submission["title"] for submission in reddit.submissions] == ["a title"]
+
+def test_failed_attempt_is_retried_with_backoff():
+    target = FakeTarget("flaky", failures = 2)
+    queue = build_queue(target)
+    queue.enqueue(IMAGE, "a title")
+
+    before = time.time()
+    publication = attempt(queue)
+    assert publication["status"] == "queued"
+    assert publication["attempts"] == 1
+    assert "flaky is unavailable" in publication["error"]
+    assert before + 0.8 * PUBLISH_RETRY_BASE <= publication["next_attempt_at"] <= time.time() + 1.2 * PUBLISH_RETRY_BASE
+
+    publication = attempt(queue)
+    assert publication["status"] == "queued"
+    # The backoff doubles with every attempt.
+    assert publication["next_attempt_at"] >= time.time() + 0.8 * 2 * PUBLISH_RETRY_BASE
+
+    publication = attempt(queue)
+    assert publication["status"] == "published"
+    assert publication["attempts"] == 3
+    assert len(target.posts) == 1
+
+def test_reddit_rate_limit_delays_the_retry_and_pauses_the_queue():
+    reddit = FakeReddit(rate_limited = 1, rate_limit_delay = 7200)
+    queue = build_queue(RedditTarget("memes", reddit = reddit))
+    queue.enqueue(IMAGE, "a title")
+
+    publication = attempt(queue)
+
+    assert publication["status"] == "queued"
+    assert publication["next_attempt_at"] >= time.time() + 7000
+    assert queue.rate_limiter.reserve() >= 7000
+    assert reddit.submissions == []
+
+def test_retries_only_resubmit_to_targets_that_failed():
+    reddit = FakeReddit()
+    flaky = FakeTarget("flaky", failures = 1)
+    queue = build_queue(RedditTarget("memes", reddit = reddit), flaky)
+    queue.enqueue(IMAGE, "a title")
+
+    assert attempt(queue)["status"] == "queued"
+    publication = attempt(queue)
+
+    assert publication["status"] == "published"
+    assert len(reddit.submissions) == 1
+    assert len(flaky.posts) == 1
+    assert set(publication["results"]) == {"reddit:memes", "flaky"}
+
+def test_gives_up_after_max_attempts():
+    reddit = FakeReddit()
+    queue = build_queue(RedditTarget("memes", reddit = reddit), FakeTarget("down", failures = 10), max_attempts = 2)
+    publication_id = queue.enqueue(IMAGE, "a title")
+
+    attempt(queue)
+    publication = attempt(queue)
+
+    assert publication["status"] == "partial"
+    assert publication["meme_url"] is not None
+    assert queue.execute("SELECT image FROM publications WHERE id = ?", (publication_id,))[0][0] is None
+    assert len(reddit.submissions) == 1
+
+def test_publishing_rows_are_recovered_after_a_crash(tmp_path):
+    path = str(tmp_path / "publish_queue.sqlite3")
+    crashed = build_queue(FakeTarget("target"), path = path)
+    publication_id = crashed.enqueue(IMAGE, "a title")
+    assert crashed.claim()["id"] == publication_id
+    # The process dies mid-publish, leaving the row claimed.
+    crashed.connection.close()
+    assert sqlite3.connect(path).execute("SELECT status FROM publications").fetchone() == ("publishing",)
+
+    target = FakeTarget("target")
+    queue = build_queue(target, path = path)
+    queue.start()
+    try:
+        publication = queue.wait(publication_id, timeout = 10)
+    finally:
+        queue.stop()
+
+    assert publication["status"] == "published"
+    assert len(target.posts) == 1
+
+def test_worker_survives_an_exception_while_publishing(monkeypatch):
+    target = FakeTarget("target")
+    queue = build_queue(target)
+    monkeypatch.setattr(queue, "backoff", lambda attempts: 0.0)
+    publish = queue.publisher.publish
+    calls = []
+
+    def broken_once(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return publish(*args, **kwargs)
+
+    monkeypatch.setattr(queue.publisher, "publish", broken_once)
+    queue.start()
+    try:
+        first = queue.enqueue(IMAGE, "first")
+        publication = queue.wait(first, timeout = 10)
+        second = queue.wait(queue.enqueue(IMAGE, "second"), timeout = 10)
+    finally:
+        queue.stop()
+
+    assert publication["status"] == "published"
+    assert publication["attempts"] == 2
+    assert second["status"] == "published"
+    assert [post["title"] for post in target.posts] == ["first", "second"]
+
+def test_wait_async_resolves_when_published():
+    queue = build_queue(FakeTarget("target"))
+    queue.start()
+    try:
+        publication_id = queue.enqueue(IMAGE, "a title")
+        publication = asyncio.run(queue.wait_async(publication_id, timeout = 10))
+    finally:
+        queue.stop()
+    assert publication["status"] == "published"
+
+def test_missing_reddit_credentials_do_not_stop_the_queue(monkeypatch):
+    from agents import publish_targets
+
+    def no_credentials():
+        raise RuntimeError("Required configuration setting 'client_id' missing.")
+
+    monkeypatch.setattr(publish_targets, "get_reddit", no_credentials)
+    monkeypatch.setattr(publish_targets, "_reddit", None)
+    queue = build_queue(RedditTarget("memes"), FakeTarget("target"))
+    queue.enqueue(IMAGE, "a title")
+
+    publication = attempt(queue)
+
+    assert publication["status"] == "queued"
+    assert publication["results"]["reddit:memes"]["status"] == "failed"
+    assert publication["results"]["target"]["status"] == "published"
+
+def test_timed_out_targets_are_not_retried():
+    slow = FakeTarget("slow", latency = 0.5, timeout = 0.05)
+    flaky = FakeTarget("flaky", failures = 1)
+    queue = build_queue(slow, flaky)
+    queue.enqueue(IMAGE, "a title")
+
+    publication = attempt(queue)
+    assert publication["status"] == "queued"
+    assert publication["results"]["slow"]["status"] == "timeout"
+
+    publication = attempt(queue)
+    time.sleep(0.6)
+
+    # The slow upload finished after its timeout; it is not posted a second time.
+    assert publication["status"] == "partial"
+    assert "slow: Timed out after 0.05s, not retried" in publication["error"]
+    assert len(slow.posts) == 1
+    assert len(flaky.posts) == 1
+
+def test_publishing_to_no_targets_posts_nothing():
+    target = FakeTarget("target")
+    assert MultiTargetPublisher([target]).publish(IMAGE, "a title", []) == {}
+    assert target.posts == []
@@ -0,0 +1,61 @@
+"""Result cache lookups and the pipeline stages they skip, with fake agents instead of LLMs."""
+import asyncio
+from typing import Callable
+
+import pytest
+from google.adk.agents import BaseAgent
+from google.adk.events import Event, EventActions
+from google.adk.sessions import InMemorySessionService
+from pydantic import Field
+
+import result_cache
+from pipeline import MemePipeline, PromptRejectedError
+from result_cache import MemoryCacheBackend, ResultCache
+
+STATE = {"moderator_response": "no", "moderation_tier": "llm", "image_url": "https://templates.test/0.png", "caption": "top|bottom"}
+
+class StateAgent(BaseAgent):
+    """Writes the state returned by `respond` for the session's prompt and counts its runs."""
+    respond: Callable[[str], dict]
+    prompts: list = Field(default_factory = list)
+
+    async def _run_async_impl(self, ctx):
+        prompt = ctx.session.state["prompt"]
+        self.prompts.append(prompt)
+        yield Event(invocation_id = ctx.invocation_id, author = self.name, branch = ctx.branch, actions = EventActions(state_delta = self.respond(prompt)))
+
+@pytest.fixture
+def cache(monkeypatch):
+    # Every prompt about cats is a near-duplicate of every other one.
+    monkeypatch.setattr(result_cache, "embed_prompt", lambda prompt: [1.0, 0.0] if "cat" in prompt else [0.0, 1.0])
+    return ResultCache(MemoryCacheBackend(), semantic_threshold = 0.9)
+
+def test_near_duplicate_reuses_template_and_caption_but_not_moderation(cache):
+    cache.store("a cat meme", cache.lookup("a cat meme"), STATE)
+
+    hit = cache.lookup("cat memes please")
+
+    assert hit.key == "a cat meme"
+    assert hit.exact_key == "cat memes please"
+    assert hit.state == {"image_url": STATE["image_url"], "caption": STATE["caption"]}
+    assert cache.lookup("A cat meme!").state["moderator_response"] == "no"
+
+def test_near_duplicate_prompt_is_moderated_again(cache):
+    moderation = StateAgent(name = "moderation", respond = lambda prompt: {"moderator_response": "yes" if "bomb" in prompt else "no"})
+    prepare = StateAgent(name = "prepare", respond = lambda prompt: {"image_url": STATE["image_url"], "caption": STATE["caption"]})
+    finish = StateAgent(name = "finish", respond = lambda prompt: {"meme_url": "https://memes.test/" + prompt})
+    pipeline = MemePipeline(InMemorySessionService(), moderation, prepare, finish, result_cache = cache)
+
+    async def scenario():
+        await pipeline.run("user", "a cat meme")
+        with pytest.raises(PromptRejectedError):
+            await pipeline.run("user", "a cat meme with a bomb")
+        await pipeline.run("user", "a cat meme")
+
+    asyncio.run(scenario())
+
+    # The rejected near-duplicate was moderated itself and did not overwrite the verdict of the original prompt.
+    assert moderation.prompts == ["a cat meme", "a cat meme with a bomb"]
+    assert prepare.prompts == ["a cat meme"]
+    assert cache.lookup("a cat meme with a bomb").state["moderator_response"] == "yes"
+    assert cache.lookup("a cat meme").state["moderator_response"] == "no"
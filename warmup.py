@@ -0,0 +1,132 @@
+"""
+Startup warm-up: loads the embedding model, the template index and the decoded
+template images before the first request needs them.
+
+The three loads are independent and mostly release the GIL (file reads, numpy,
+torch), so they run at the same time in worker threads; matching a prompt end to
+end then runs once all of them are done. The service answers `/healthz` during
+warm-up and `/readyz` only once the required phases succeeded. Phase timings go
+to `meme_startup_seconds{phase}` and the log.
+"""
+from typing import Optional
+import asyncio
+import logging
+import time
+import os
+
+from agents.compose_pool import get_compose_pool
+from agents.template_cache import get_template_cache
+from agents.template_index import get_embedding_model, get_template_index, match_prompts
+from agents.template_layout import get_layout_index
+from metrics import STARTUP_SECONDS
+from config import load_config
+
+load_config()
+
+logger = logging.getLogger(__name__)
+
+# Warm up at startup; when disabled everything is loaded lazily by the first request.
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() != "false"
+
+WARMUP_PROMPT = "when the service finally starts"
+
+class WarmupPhase:
+    def __init__(self, name: str, function, required: bool = True):
+        self.name = name
+        self.function = function
+        # A failed optional phase is only logged; its work is redone lazily on demand.
+        self.required = required
+        self.status = "pending"
+        self.seconds: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def run(self):
+        self.status = "running"
+        started = time.perf_counter()
+        try:
+            self.function()
+            self.status = "ok"
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e) or type(e).__name__
+            logger.exception("Warm-up phase %s failed", self.name)
+        finally:
+            self.seconds = time.perf_counter() - started
+            STARTUP_SECONDS.set(self.seconds, phase = self.name)
+
+    def to_dict(self):
+        return {"status": self.status, "seconds": self.seconds, "error": self.error, "required": self.required}
+
+def load_embedding_model():
+    get_embedding_model().encode([WARMUP_PROMPT], convert_to_numpy = True)
+
+def load_template_index():
+    get_template_index().vector_index
+
+def load_template_images():
+    cache = get_template_cache()
+    # A fresh checkout has no layout index; detect the cached templates' boxes now rather than per request.
+    detected = get_layout_index().build_missing(list(cache.index))
+    pool = get_compose_pool()
+    # With compose workers, templates are decoded into their shared memory instead.
+    decoded = pool.preload(list(cache.index)) if pool is not None else cache.preload()
+    logger.info("Preloaded %d template images, detected %d template layouts", decoded, detected)
+
+def start_compose_workers():
+    pool = get_compose_pool()
+    if pool is not None:
+        pool.start()
+
+def match_warmup_prompt():
+    match_prompts([WARMUP_PROMPT])
+
+class Warmup:
+    def __init__(self, enabled: bool = STARTUP_WARMUP):
+        self.enabled = enabled
+        # Phases in a group run concurrently; groups run one after the other.
+        self.groups = [
+            [
+                WarmupPhase("embedding_model", load_embedding_model),
+                WarmupPhase("template_index", load_template_index),
+                WarmupPhase("template_images", load_template_images, required = False),
+                WarmupPhase("compose_workers", start_compose_workers, required = False),
+            ],
+            [WarmupPhase("prompt_matching", match_warmup_prompt)],
+        ]
+        self.phases = {phase.name: phase for group in self.groups for phase in group}
+        self.started_at: Optional[float] = None
+        self.seconds: Optional[float] = None
+        self.done = not enabled
+
+    @property
+    def ready(self):
+        if not self.enabled:
+            return True
+        return self.done and all(phase.status == "ok" for phase in self.phases.values() if phase.required)
+
+    async def run(self):
+        if not self.enabled:
+            return
+        self.started_at = time.perf_counter()
+        try:
+            for group in self.groups:
+                await asyncio.gather(*(asyncio.to_thread(phase.run) for phase in group))
+                if any(phase.status == "failed" and phase.required for phase in group):
+                    break
+        finally:
+            self.seconds = time.perf_counter() - self.started_at
+            self.done = True
+            STARTUP_SECONDS.set(self.seconds, phase = "warmup")
+            logger.info(
+                "Warm-up %s in %.2fs",
+                "finished" if self.ready else "failed",
+                self.seconds,
+                extra = {"phases": {name: phase.seconds for name, phase in self.phases.items()}}
+            )
+
+    def to_dict(self):
+        return {
+            "ready": self.ready,
+            "seconds": self.seconds,
+            "phases": {name: phase.to_dict() for name, phase in self.phases.items()}
+        }